@@ -41,47 +41,34 @@ path="${1%/*}"
 bold=$(tput bold)
 normal=$(tput sgr0)
 
+# Detection, alignment, triangulation, rendering and encoding all run in a single python process
+pipeline_args=""
 if [[ $align -eq 1 ]]; then
-    python my_code/landmark_detector.py --image $img1
-    python my_code/landmark_detector.py --image $img2
     echo "${bold}Aligning images${normal}"
-    python my_code/align_images.py --image $img1
-    python my_code/align_images.py --image $img2
-    rm $path/$filename1.txt $path/$filename2.txt
-    img1=$path/aligned-$filename1.png
-    img2=$path/aligned-$filename2.png
+    pipeline_args="$pipeline_args --align"
     filename1="aligned-$filename1"
     filename2="aligned-$filename2"
 else
     echo "${bold}Skipping image alignment${normal}"
 fi
 
-echo "${bold}Generating facial landmarks${normal}"
-python my_code/landmark_detector.py --image $img1
-python my_code/landmark_detector.py --image $img2
-
-echo "${bold}Drawing delaunay triangles of image1${normal}"
-python my_code/draw_delaunay.py --image $img1
-if [ -e "$path/$filename1-delaunay.jpg" ] && [ -e "$path/$filename1-voronoi.jpg" ]; then
-    echo -e "\033[1;32mCheckout delaunay triangles in $path/$filename1-delaunay.jpg and $filename1-voronoi.jpg\033[0m"
-else
-    echo -e "\033[1;41mERROR! Delaunay triangles drawing failed!\033[0m"
+# Set MORPH_DIAGNOSTICS=1 to also write the landmarks, Delaunay and Voronoi images
+if [ "$MORPH_DIAGNOSTICS" == "1" ]; then
+    pipeline_args="$pipeline_args --diagnostics"
 fi
 
-echo "${bold}Drawing delaunay triangles of image2${normal}"
-python my_code/draw_delaunay.py --image $img2
-if [ -e "$path/$filename2-delaunay.jpg" ] && [ -e "$path/$filename2-voronoi.jpg" ]; then
-    echo -e "\033[1;32mCheckout delaunay triangles in $path/$filename2-delaunay.jpg and $filename2-voronoi.jpg\033[0m"
+# Set MORPH_OUTPUT=png to keep the intermediate PNG frames and encode them afterwards
+if [ "$MORPH_OUTPUT" == "png" ]; then
+    echo "${bold}Creating morphing frames${normal}"
+    python my_code/morph_pipeline.py $img1 $img2 $fps $4 $pipeline_args --output png
+
+    echo "${bold}Generating video file${normal}"
+    ffmpeg -framerate $fps -r $fps -start_number 0 -i $path/morph-$filename1-$filename2-%04d.png -b:v 10M -pix_fmt yuv420p -vf "pad=ceil(iw/2)*2:ceil(ih/2)*2" $path/$filename1-$filename2.mp4 -y
 else
-    echo -e "\033[1;41mERROR! Delaunay triangles drawing failed!\033[0m"
+    echo "${bold}Creating morphing frames and streaming them to ffmpeg${normal}"
+    python my_code/morph_pipeline.py $img1 $img2 $fps $4 $pipeline_args --video $path/$filename1-$filename2.mp4
 fi
 
-echo "${bold}Creating morphing frames${normal}"
-python my_code/faceMorph.py --image1 $img1 --image2 $img2 --nframes $frames
-
-echo "${bold}Generating video file${normal}"
-ffmpeg -framerate $fps -r $fps -start_number 0 -i $path/morph-$filename1-$filename2-%04d.png -b:v 10M -pix_fmt yuv420p -vf "pad=ceil(iw/2)*2:ceil(ih/2)*2" $path/$filename1-$filename2.mp4 -y
-
 if [ -e "$path/$filename1-$filename2.mp4" ]; then
     echo -e "\033[1;42mFace morphing finished!\033[0m"
     echo -e "\033[1;32mCheckout morphing results in $path/$filename1-$filename2.mp4\033[0m"
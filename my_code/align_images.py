@@ -1,15 +1,16 @@
 import os
 import argparse
 import numpy as np
+import cv2
 from scipy import ndimage
 import os
 from PIL import Image
+import instrumentation
 
-def image_align(src_file, dst_file, face_landmarks, output_size=1024, transform_size=4096, 
-                enable_padding=True, x_scale=1, y_scale=1, em_scale=0.1, alpha=False):
-        # Align function from FFHQ dataset pre-processing step
-        # https://github.com/NVlabs/ffhq-dataset/blob/master/download_ffhq.py
-
+def align_quad(face_landmarks, x_scale=1, y_scale=1, em_scale=0.1):
+        """
+        Oriented crop quad (top-left, bottom-left, bottom-right, top-right) and its size, FFHQ style
+        """
         lm = np.array(face_landmarks)
         lm_chin          = lm[0  : 17]  # left-right
         lm_eyebrow_left  = lm[17 : 22]  # left-right
@@ -41,6 +42,21 @@ def image_align(src_file, dst_file, face_landmarks, output_size=1024, transform_
         quad = np.stack([c - x - y, c - x + y, c + x + y, c + x - y])
         qsize = np.hypot(*x) * 2
 
+        return quad, qsize
+
+def image_align(src_file, dst_file, face_landmarks, output_size=1024, transform_size=4096, 
+                enable_padding=True, x_scale=1, y_scale=1, em_scale=0.1, alpha=False):
+        # Align function from FFHQ dataset pre-processing step
+        # https://github.com/NVlabs/ffhq-dataset/blob/master/download_ffhq.py
+
+        with instrumentation.timer('image_align', image=src_file, output_size=output_size):
+            _image_align(src_file, dst_file, face_landmarks, output_size, transform_size, 
+                         enable_padding, x_scale, y_scale, em_scale, alpha)
+
+def _image_align(src_file, dst_file, face_landmarks, output_size, transform_size, 
+                 enable_padding, x_scale, y_scale, em_scale, alpha):
+        quad, qsize = align_quad(face_landmarks, x_scale, y_scale, em_scale)
+
         # Load in-the-wild image.
         if not os.path.isfile(src_file):
             print('\n\033[1;31mCannot find source image. Please run "--wilds" before "--align".\033[0m')
@@ -51,7 +67,7 @@ def image_align(src_file, dst_file, face_landmarks, output_size=1024, transform_
         shrink = int(np.floor(qsize / output_size * 0.5))
         if shrink > 1:
             rsize = (int(np.rint(float(img.size[0]) / shrink)), int(np.rint(float(img.size[1]) / shrink)))
-            img = img.resize(rsize, Image.ANTIALIAS)
+            img = img.resize(rsize, Image.LANCZOS)
             quad /= shrink
             qsize /= shrink
 
@@ -85,6 +101,11 @@ def image_align(src_file, dst_file, face_landmarks, output_size=1024, transform_
                 img = Image.fromarray(img, 'RGB')
             quad += pad[:2]
 
+        if instrumentation.enabled:
+            channels = len(img.getbands())
+            instrumentation.count('pixels_touched', img.size[0] * img.size[1] + transform_size * transform_size)
+            instrumentation.count('bytes_allocated', channels * (img.size[0] * img.size[1] + transform_size * transform_size))
+
         # Transform.
         img = img.transform((transform_size, transform_size), Image.QUAD, (quad + 0.5).flatten(), Image.BILINEAR)
         if output_size < transform_size:
@@ -93,6 +114,153 @@ def image_align(src_file, dst_file, face_landmarks, output_size=1024, transform_
         # Save aligned image.
         img.save(dst_file, 'PNG')
 
+# cv2.imread flags that decode at 1/2, 1/4 and 1/8 of the size (native DCT scaling for JPEG)
+REDUCED_READ_FLAGS = {1 : cv2.IMREAD_COLOR, 2 : cv2.IMREAD_REDUCED_COLOR_2, 
+                      4 : cv2.IMREAD_REDUCED_COLOR_4, 8 : cv2.IMREAD_REDUCED_COLOR_8}
+
+def image_align_single_warp(src_file, dst_file, face_landmarks, output_size=1024, transform_size=4096, 
+                            enable_padding=True, x_scale=1, y_scale=1, em_scale=0.1, alpha=False):
+        """
+        Memory-lean version of image_align with the same crop, padding and blur decisions.
+        The quad is mapped straight to output_size with a single warpAffine (reflect border
+        instead of an explicitly padded copy), so no transform_size intermediate is built.
+        Large images are decoded at reduced size and only the crop the quad needs is resampled.
+        Blur and median blending run in output space, tile by tile, only where the padding mask is set.
+        """
+        with instrumentation.timer('image_align', image=src_file, output_size=output_size, single_warp=True):
+            _image_align_single_warp(src_file, dst_file, face_landmarks, output_size, transform_size, 
+                                     enable_padding, x_scale, y_scale, em_scale, alpha)
+
+def _image_align_single_warp(src_file, dst_file, face_landmarks, output_size, transform_size, 
+                             enable_padding, x_scale, y_scale, em_scale, alpha):
+        quad, qsize = align_quad(face_landmarks, x_scale, y_scale, em_scale)
+
+        # Load in-the-wild image.
+        if not os.path.isfile(src_file):
+            print('\n\033[1;31mCannot find source image. Please run "--wilds" before "--align".\033[0m')
+            return
+
+        # Shrink while decoding.
+        shrink = int(np.floor(qsize / output_size * 0.5))
+        reduce = max(r for r in REDUCED_READ_FLAGS if r <= max(shrink, 1))
+        img = cv2.imread(src_file, REDUCED_READ_FLAGS[reduce])
+
+        out, _ = align_array(img, face_landmarks, output_size, transform_size, enable_padding, 
+                             x_scale, y_scale, em_scale, alpha, reduce)
+
+        # Save aligned image.
+        cv2.imwrite(dst_file, out)
+
+# Tile size of the padding blur
+PADDING_TILE = 128
+
+def blend_padding(out, affine, pad, crop_w, crop_h, blur, margin, tile=PADDING_TILE):
+    """
+    Blur and median blending of image_align's padding, on the warped uint8 output.
+    The padding mask is evaluated tile by tile at the crop position of every output pixel, and only
+    the tiles it touches are blurred (from the unblurred output, with margin pixels of context),
+    so float buffers stay at the tile size. Returns the blended output and the uint8 alpha mask.
+    """
+    size = out.shape[0]
+    median = np.median(out, axis=(0,1)).astype(np.float32)
+    result = out.copy()
+    alpha_mask = np.full(out.shape[:2], 255, dtype=np.uint8)
+
+    for top in range(0, size, tile):
+        for left in range(0, out.shape[1], tile):
+            bottom, right = min(top + tile, size), min(left + tile, out.shape[1])
+            ox = np.arange(left, right, dtype=np.float32)[None, :]
+            oy = np.arange(top, bottom, dtype=np.float32)[:, None]
+            u = np.float32(affine[0, 0]) * ox + np.float32(affine[0, 1]) * oy + np.float32(affine[0, 2])
+            v = np.float32(affine[1, 0]) * ox + np.float32(affine[1, 1]) * oy + np.float32(affine[1, 2])
+            mask = np.maximum(1.0 - np.minimum((u + pad[0]) / pad[0], (crop_w - 1 - u + pad[2]) / pad[2]), 
+                              1.0 - np.minimum((v + pad[1]) / pad[1], (crop_h - 1 - v + pad[3]) / pad[3]))
+            blur_weight = np.clip(mask * 3.0 + 1.0, 0.0, 1.0)
+            if not blur_weight.any():
+                continue
+
+            # Blur with enough context for the kernel, read from the unblurred output.
+            y0, x0 = max(top - margin, 0), max(left - margin, 0)
+            context = np.float32(out[y0:min(bottom + margin, size), x0:min(right + margin, out.shape[1])])
+            blurred = cv2.GaussianBlur(context, (0, 0), blur)[top - y0:bottom - y0, left - x0:right - x0]
+            block = np.float32(out[top:bottom, left:right])
+            block += (blurred - block) * blur_weight[:, :, None]
+            block += (median - block) * np.clip(mask, 0.0, 1.0)[:, :, None]
+
+            result[top:bottom, left:right] = np.uint8(np.clip(np.rint(block), 0, 255))
+            alpha_mask[top:bottom, left:right] = np.uint8(np.clip(np.rint((1 - np.clip(3.0 * mask, 0.0, 1.0)) * 255), 0, 255))
+
+    return result, alpha_mask
+
+def align_array(img, face_landmarks, output_size=1024, transform_size=4096, enable_padding=True, 
+                x_scale=1, y_scale=1, em_scale=0.1, alpha=False, reduce=1):
+    """
+    In-memory single warp alignment of a decoded BGR image, see image_align_single_warp.
+    img may be decoded at 1/reduce of the size the landmarks refer to.
+    Returns the aligned image and the 2x3 affine mapping its pixels to source pixels (landmark coordinates).
+    """
+    quad, qsize = align_quad(face_landmarks, x_scale, y_scale, em_scale)
+    quad = quad / reduce
+    qsize /= reduce
+    img_h, img_w = img.shape[:2]
+
+    # Crop, same rectangle as image_align.
+    border = max(int(np.rint(qsize * 0.1)), 3)
+    crop = (int(np.floor(min(quad[:,0]))), int(np.floor(min(quad[:,1]))), int(np.ceil(max(quad[:,0]))), int(np.ceil(max(quad[:,1]))))
+    crop = (max(crop[0] - border, 0), max(crop[1] - border, 0), min(crop[2] + border, img_w), min(crop[3] + border, img_h))
+    img = img[crop[1]:crop[3], crop[0]:crop[2]]
+    quad -= crop[0:2]
+    crop_h, crop_w = img.shape[:2]
+
+    # Pad decision, same as image_align.
+    pad = (int(np.floor(min(quad[:,0]))), int(np.floor(min(quad[:,1]))), int(np.ceil(max(quad[:,0]))), int(np.ceil(max(quad[:,1]))))
+    pad = (max(-pad[0] + border, 0), max(-pad[1] + border, 0), max(pad[2] - crop_w + border, 0), max(pad[3] - crop_h + border, 0))
+    padding = enable_padding and max(pad) > border - 4
+    if padding:
+        pad = np.maximum(pad, int(np.rint(qsize * 0.3)))
+
+    # Output pixel -> crop pixel affine (PIL QUAD to transform_size, then resize to output_size).
+    # With padding the output is extended by a margin so that the blur sees past its edges.
+    blur = output_size * 0.02
+    margin = int(np.ceil(3 * blur)) + 1 if padding else 0
+    size = output_size + 2 * margin
+    ex = quad[3] - quad[0]
+    ey = quad[1] - quad[0]
+    origin = quad[0] + (ex + ey) * (0.5 / output_size - 0.5 / transform_size) - (ex + ey) * margin / output_size
+    affine = np.float64([[ex[0], ey[0], 0], [ex[1], ey[1], 0]]) / output_size
+    affine[:, 2] = origin
+
+    # Resample the crop to about output resolution first, warpAffine does not area-average.
+    work = img
+    scale = output_size / qsize
+    if scale < 1:
+        work = cv2.resize(img, (max(int(np.rint(crop_w * scale)), 1), max(int(np.rint(crop_h * scale)), 1)), interpolation=cv2.INTER_AREA)
+    sx, sy = work.shape[1] / crop_w, work.shape[0] / crop_h
+    work_affine = affine * [[sx], [sy]]
+    work_affine[:, 2] += [0.5 * sx - 0.5, 0.5 * sy - 0.5]
+
+    if instrumentation.enabled:
+        instrumentation.count('pixels_touched', work.shape[0] * work.shape[1] + size * size)
+        instrumentation.count('bytes_allocated', img.nbytes + (work.nbytes if work is not img else 0) + size * size * (3 + 4 * padding))
+
+    # Transform.
+    border_mode = cv2.BORDER_REFLECT_101 if padding else cv2.BORDER_CONSTANT
+    out = cv2.warpAffine(work, work_affine, (size, size), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=border_mode, borderValue=0)
+
+    if padding:
+        out, mask = blend_padding(out, affine, pad, crop_w, crop_h, blur, margin)
+        out = out[margin:margin + output_size, margin:margin + output_size]
+        if alpha:
+            out = np.concatenate((out, mask[margin:margin + output_size, margin:margin + output_size, None]), axis=2)
+
+    # Output pixel -> source pixel: drop the margin, undo the crop and the reduced decode.
+    to_source = affine.copy()
+    to_source[:, 2] += affine[:, :2] @ [margin, margin] + crop[0:2]
+    to_source *= reduce
+    to_source[:, 2] += 0.5 * reduce - 0.5
+
+    return out, to_source
+
 if __name__ == "__main__":
     """
     Extracts and aligns all faces from images using DLib and a function from original FFHQ dataset preparation step
@@ -105,7 +273,11 @@ if __name__ == "__main__":
     parser.add_argument('--y_scale', default=1, help='Scaling factor for y dimension', type=float)
     parser.add_argument('--em_scale', default=0.1, help='Scaling factor for eye-mouth distance', type=float)
     parser.add_argument('--use_alpha', default=False, help='Add an alpha channel for masking', type=bool)
+    parser.add_argument('--trace', help=f'Write a Chrome trace of this run (or set {instrumentation.TRACE_ENV})')
+    parser.add_argument('--single_warp', action='store_true', help='Memory-lean alignment with a single warp to output_size')
     args, other_args = parser.parse_known_args()
+    if args.trace:
+        instrumentation.enable(args.trace)
 
     image = args.image
     img_name = os.path.split(image)[1]
@@ -128,8 +300,9 @@ if __name__ == "__main__":
         print('Starting face alignment...')
         face_img_name = f"aligned-{split_path[0]}.png"
         aligned_face_path = os.path.join(aligned_img_dir, face_img_name)
-        image_align(image, aligned_face_path, landmarks_detector, output_size=args.output_size, 
-                    x_scale=args.x_scale, y_scale=args.y_scale, em_scale=args.em_scale, alpha=args.use_alpha)
+        align = image_align_single_warp if args.single_warp else image_align
+        align(image, aligned_face_path, landmarks_detector, output_size=args.output_size, 
+              x_scale=args.x_scale, y_scale=args.y_scale, em_scale=args.em_scale, alpha=args.use_alpha)
         print(f'\033[1;32mWrote result {aligned_face_path}\n\033[0m')
     except:
         print("\033[1;41mException in face alignment!\033[0m")
\ No newline at end of file
@@ -0,0 +1,311 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import instrumentation
+from faceMorph import addAdditionalPoints, build_delaunay, render_frames, RENDERERS, SOURCE_DTYPES, TRIANGULATION_CACHE_DIR
+from frame_writer import open_writer, OUTPUTS
+from landmark_cache import LandmarkCache, LANDMARK_CACHE_DIR
+from landmark_detector import detect_landmarks
+from morph_pipeline import analyse_face
+
+def parse_bool(value) :
+    if isinstance(value, str) :
+        return value.strip().lower() in ('1', 'true', 'yes', 'y')
+    return bool(value)
+
+# Manifest fields of a job and their type, other fields are ignored
+JOB_FIELDS = {'id' : str, 'image1' : str, 'image2' : str, 'fps' : int, 'duration' : int, 'align' : parse_bool,
+              'renderer' : str, 'output' : str, 'video' : str}
+JOB_DEFAULTS = {'fps' : 25, 'duration' : 3000, 'align' : False, 'renderer' : 'triangle', 'output' : 'ffmpeg', 'video' : None}
+
+def job_id(job) :
+    """
+    The job's own id, or a hash of its settings so that the same pair with the same settings is the same job
+    """
+    if job.get('id') :
+        return job['id']
+    settings = {k : job[k] for k in sorted(JOB_FIELDS) if k != 'id'}
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+
+def read_manifest(manifest, defaults=None) :
+    """
+    Jobs of a JSONL (one object per line) or CSV (with a header line) manifest. Every job needs image1 and image2;
+    fps, duration, align, renderer, output, video and id fall back to defaults. Relative paths are resolved
+    against the manifest's directory. Jobs with the same id are only kept once.
+    """
+    base_dir = os.path.dirname(manifest)
+    with open(manifest, newline='') as file :
+        if manifest.lower().endswith('.csv') :
+            rows = list(csv.DictReader(file))
+        else :
+            rows = [json.loads(line) for line in file if line.strip() and not line.startswith('#')]
+
+    jobs = {}
+    for (line, row) in enumerate(rows, 1) :
+        job = dict(JOB_DEFAULTS, **(defaults or {}))
+        job.update({k : JOB_FIELDS[k](v) for (k, v) in row.items() if k in JOB_FIELDS and v not in (None, '')})
+        if not job.get('image1') or not job.get('image2') :
+            raise ValueError(f'{manifest}: job {line} needs image1 and image2')
+        if job['renderer'] not in RENDERERS or job['output'] not in OUTPUTS :
+            raise ValueError(f'{manifest}: job {line} has an unknown renderer or output')
+        for key in ('image1', 'image2', 'video') :
+            if job[key] :
+                job[key] = os.path.join(base_dir, job[key])
+        job['id'] = job_id(job)
+        jobs.setdefault(job['id'], job)
+
+    # Resume and done checks look at a job's output, no other job may write it
+    outputs = {}
+    for job in jobs.values() :
+        export_path, prefix = job_output(job)
+        # Videos and .npy stacks are one file, image sequences are told apart by their prefix
+        output = export_path if job['output'] in ('ffmpeg', 'npy') else os.path.join(export_path, prefix)
+        other = outputs.setdefault(output, job['id'])
+        if other != job['id'] :
+            raise ValueError(f'{manifest}: jobs {other} and {job["id"]} write the same output {output}')
+
+    return list(jobs.values())
+
+def job_output(job) :
+    """
+    (export path, frame prefix) of a job. Default names end with the job id, so that jobs on the same pair
+    with other settings never overwrite each other.
+    """
+    names = [os.path.splitext(os.path.basename(job[key]))[0] for key in ('image1', 'image2')]
+    if job['align'] :
+        names = ['aligned-' + name for name in names]
+    name = '-'.join(names) + '-' + job['id']
+    out_dir = os.path.dirname(job['image1'])
+    if job['output'] in ('ffmpeg', 'npy') :
+        return job['video'] or os.path.join(out_dir, name + ('.mp4' if job['output'] == 'ffmpeg' else '.npy')), 'morph-' + name
+
+    return out_dir, 'morph-' + name
+
+def write_json(path, data) :
+    """
+    Writes a JSON file atomically, a killed run never leaves a half-written checkpoint
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file :
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
+def job_paths(state_dir, job) :
+    """
+    Done marker, failure marker, frame checkpoint and checkpoint progress of a job
+    """
+    return {'done' : os.path.join(state_dir, 'done', job['id'] + '.json'),
+            'failed' : os.path.join(state_dir, 'failed', job['id'] + '.json'),
+            'frames' : os.path.join(state_dir, 'frames', job['id'] + '.npy'),
+            'progress' : os.path.join(state_dir, 'frames', job['id'] + '.progress')}
+
+def is_done(state_dir, job) :
+    done_path = job_paths(state_dir, job)['done']
+    if not os.path.isfile(done_path) :
+        return False
+    with open(done_path) as file :
+        return os.path.exists(json.load(file)['output'])
+
+def open_checkpoint(paths, shape) :
+    """
+    Frame checkpoint of a job as a writable (nframes, height, width, 3) memmap, and the number of frames
+    it already holds. A checkpoint of another shape (the job's settings changed) or a truncated one
+    (the run died while creating it) is started over.
+    """
+    if os.path.isfile(paths['frames']) and os.path.isfile(paths['progress']) :
+        try :
+            stack = np.load(paths['frames'], mmap_mode='r+')
+            if stack.shape == shape :
+                with open(paths['progress']) as file :
+                    return stack, json.load(file)['frames']
+            del stack
+        except (ValueError, OSError, KeyError) :
+            pass
+
+    # The progress file is only written once the frame file is complete, a checkpoint never has one without the other
+    os.makedirs(os.path.dirname(paths['frames']), exist_ok=True)
+    if os.path.exists(paths['progress']) :
+        os.remove(paths['progress'])
+    stack = np.lib.format.open_memmap(paths['frames'], mode='w+', dtype=np.uint8, shape=shape)
+    stack.flush()
+    write_json(paths['progress'], {'frames' : 0})
+    return stack, 0
+
+def run_job(job, state_dir, cache_dir=LANDMARK_CACHE_DIR, tri_cache=TRIANGULATION_CACHE_DIR, checkpoint_every=10) :
+    """
+    Renders one job into its frame checkpoint, starting after the last checkpointed frame, then writes
+    its output from the checkpoint and marks it done. Returns the done record.
+    """
+    start = time.perf_counter()
+    nframes = job['fps'] * job['duration'] // 1000
+    if nframes <= 0 :
+        raise ValueError('frames number set to 0, fps or duration might be 0')
+
+    # Landmarks come from the shared cache, filled before the jobs start
+    cache = LandmarkCache(cache_dir) if cache_dir else None
+    image1, landmarks1 = analyse_face(job['image1'], job['align'], cache=cache)
+    image2, landmarks2 = analyse_face(job['image2'], job['align'], cache=cache)
+    if image1.shape != image2.shape :
+        raise ValueError(f'images must have the same size, got {image1.shape[1]}x{image1.shape[0]} and {image2.shape[1]}x{image2.shape[0]}')
+
+    img1, img2 = SOURCE_DTYPES[job['renderer']](image1), SOURCE_DTYPES[job['renderer']](image2)
+    face1_points = addAdditionalPoints(landmarks1, img1.shape)
+    face2_points = addAdditionalPoints(landmarks2, img2.shape)
+    delaunay_group = build_delaunay(img1, face1_points, tri_cache)
+
+    paths = job_paths(state_dir, job)
+    stack, resumed_at = open_checkpoint(paths, (nframes, *image1.shape))
+    alphas = np.linspace(0, 1, nframes)
+    frames = render_frames(img1, img2, face1_points, face2_points, delaunay_group, alphas[resumed_at:], job['renderer'])
+    for (i, frame) in enumerate(frames, resumed_at) :
+        stack[i] = frame
+        if (i + 1) % checkpoint_every == 0 or i + 1 == nframes :
+            stack.flush()
+            write_json(paths['progress'], {'frames' : i + 1})
+
+    # Output, straight from the checkpoint
+    export_path, prefix = job_output(job)
+    with open_writer(job['output'], export_path, prefix, nframes, job['fps']) as writer :
+        for frame in stack :
+            writer.write(frame)
+    del stack
+
+    record = {'id' : job['id'], 'output' : export_path, 'frames' : nframes, 'resumed_at' : resumed_at,
+              'seconds' : round(time.perf_counter() - start, 3)}
+    os.makedirs(os.path.dirname(paths['done']), exist_ok=True)
+    write_json(paths['done'], record)
+    os.remove(paths['frames'])
+    os.remove(paths['progress'])
+
+    return record
+
+# Per-process batch settings, set once by _init_batch_worker
+_batch_state = {}
+
+def _init_batch_worker(state_dir, cache_dir, tri_cache, checkpoint_every, trace=False) :
+    if trace :
+        instrumentation.enable()
+        # Forked workers start with a copy of the parent's records, drop them
+        instrumentation.drain()
+    _batch_state.update(state_dir=state_dir, cache_dir=cache_dir, tri_cache=tri_cache, checkpoint_every=checkpoint_every)
+
+def _detect_task(filename) :
+    """
+    Batch task: fills the landmark cache for one image, returns (filename, error)
+    """
+    try :
+        cache = LandmarkCache(_batch_state['cache_dir']) if _batch_state['cache_dir'] else None
+        detect_landmarks(filename, cache)
+    except Exception as e :
+        return filename, f'{type(e).__name__}: {e}'
+    return filename, None
+
+def _job_task(job) :
+    """
+    Batch task: returns (job, record, error), a failing job must not stop the batch
+    """
+    try :
+        record = run_job(job, _batch_state['state_dir'], _batch_state['cache_dir'], _batch_state['tri_cache'],
+                         _batch_state['checkpoint_every'])
+    except Exception as e :
+        return job, None, f'{type(e).__name__}: {e}'
+    return job, record, None
+
+def _in_worker(task, value) :
+    """
+    A batch task plus the worker's instrumentation records if enabled
+    """
+    return task(value), instrumentation.drain() if instrumentation.enabled else None
+
+def run_batch(jobs, state_dir, workers=1, cache_dir=LANDMARK_CACHE_DIR, tri_cache=TRIANGULATION_CACHE_DIR, checkpoint_every=10) :
+    """
+    Runs the jobs that are not done yet on a pool of at most workers processes. Generator of (job, record, error).
+    Every image is detected once, before the jobs start, so that jobs sharing an image share its landmarks
+    through the landmark cache. Interrupted jobs resume from their last frame checkpoint on the next run.
+    """
+    pending = [job for job in jobs if not is_done(state_dir, job)]
+    images = sorted({job[key] for job in pending for key in ('image1', 'image2')})
+    initargs = (state_dir, cache_dir, tri_cache, checkpoint_every)
+
+    if workers <= 1 :
+        _init_batch_worker(*initargs)
+        for filename in images :
+            _detect_task(filename)
+        for job in pending :
+            yield _finish_job(state_dir, *_job_task(job))
+        return
+
+    initargs += (instrumentation.enabled,)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker, initargs=initargs) as pool :
+        # Detection errors show up again in the jobs that use the image
+        for future in as_completed([pool.submit(_in_worker, _detect_task, filename) for filename in images]) :
+            _collect(future)
+        for future in as_completed([pool.submit(_in_worker, _job_task, job) for job in pending]) :
+            yield _finish_job(state_dir, *_collect(future))
+
+def _collect(future) :
+    result, recorded = future.result()
+    if recorded is not None :
+        instrumentation.merge(recorded)
+    return result
+
+def _finish_job(state_dir, job, record, error) :
+    failed_path = job_paths(state_dir, job)['failed']
+    if error is None :
+        if os.path.exists(failed_path) :
+            os.remove(failed_path)
+    else :
+        os.makedirs(os.path.dirname(failed_path), exist_ok=True)
+        write_json(failed_path, {'id' : job['id'], 'job' : job, 'error' : error})
+    return job, record, error
+
+if __name__ == '__main__' :
+    # Input arguments
+    ap = argparse.ArgumentParser(prog='batch_morph', description='Resumable batch of face morphs')
+    ap.add_argument("manifest", help="JSONL or CSV manifest, one job per line with image1, image2 and optionally "
+                                     "fps, duration, align, renderer, output, video, id")
+    ap.add_argument("--state_dir", help="checkpoint directory (default <manifest name>.state next to the manifest)")
+    ap.add_argument("--workers", default=os.cpu_count(), type=int, help="number of worker processes")
+    ap.add_argument("--fps", default=25, type=int, help="default frame-rate of the jobs")
+    ap.add_argument("--duration", default=3000, type=int, help="default morphing duration of the jobs in miliseconds")
+    ap.add_argument("--renderer", default="triangle", choices=sorted(RENDERERS), help="default frame renderer of the jobs")
+    ap.add_argument("--output", default="ffmpeg", choices=OUTPUTS, help="default output of the jobs")
+    ap.add_argument("--checkpoint_every", default=10, type=int, help="frames rendered between two checkpoints of a job")
+    ap.add_argument("--cache_dir", default=LANDMARK_CACHE_DIR, help="directory of the landmark cache, empty string disables it")
+    ap.add_argument("--tri_cache", default=TRIANGULATION_CACHE_DIR, help="directory of the triangulation cache, empty string disables it")
+    ap.add_argument("--trace", help=f"write a Chrome trace of this run (or set {instrumentation.TRACE_ENV})")
+    args = vars(ap.parse_args())
+    if args["trace"] :
+        instrumentation.enable(args["trace"])
+
+    defaults = {k : args[k] for k in ('fps', 'duration', 'renderer', 'output')}
+    try :
+        jobs = read_manifest(args["manifest"], defaults)
+    except (ValueError, KeyError) as e :
+        print(f'\033[1;41mERROR! {e}\033[0m')
+        exit(1)
+    state_dir = args["state_dir"] or os.path.splitext(args["manifest"])[0] + '.state'
+
+    done = sum(is_done(state_dir, job) for job in jobs)
+    print(f'{len(jobs)} jobs, {done} already done, {args["workers"]} workers, checkpoints in {state_dir}')
+
+    start = time.perf_counter()
+    failed = 0
+    for (i, (job, record, error)) in enumerate(run_batch(jobs, state_dir, args["workers"], args["cache_dir"],
+                                                         args["tri_cache"], args["checkpoint_every"]), done + 1) :
+        if error is None :
+            resumed = f', resumed at frame {record["resumed_at"]}' if record['resumed_at'] else ''
+            print(f'[{i}/{len(jobs)}] {job["id"]}: {record["output"]} ({record["seconds"]:.2f} s{resumed})')
+        else :
+            failed += 1
+            print(f'\033[0;31m[{i}/{len(jobs)}] {job["id"]}: {error}\033[0m')
+
+    print(f'\033[0;32m{len(jobs) - failed}/{len(jobs)} jobs done in {time.perf_counter() - start:.2f} s\033[0m')
+    if failed :
+        exit(1)
+    print('\033[0;42mBatch Done!\033[0m')
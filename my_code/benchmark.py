@@ -0,0 +1,295 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import cv2
+from faceMorph import readPoints, readTriangles, build_delaunay, morphTriangle, morph_frame, triangle_stats, RENDERERS, SOURCE_DTYPES
+from morph_plan import MorphPlan
+from frame_writer import open_writer, OUTPUTS
+from align_images import image_align, image_align_single_warp
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REFERENCE_DIR = os.path.join(REPO_DIR, 'reference_code')
+EXAMPLE_DIR = os.path.join(REPO_DIR, 'example')
+
+# Image pairs with landmark files (80 points, border points included) shipped with reference_code
+REFERENCE_PAIRS = [('hillary_clinton.jpg', 'ted_cruz.jpg'), ('donald_trump.jpg', 'hillary_clinton.jpg')]
+STAGES = ('delaunay', 'triangle', 'render', 'lod', 'align', 'detect', 'writer', 'fidelity')
+
+def load_pair(name1, name2, scale=1) :
+    """
+    Reference image pair and landmarks, upscaled by an integer factor for the synthetic large inputs
+    """
+    images, points = [], []
+    for name in (name1, name2) :
+        img = cv2.imread(os.path.join(REFERENCE_DIR, name))
+        face_points = readPoints(os.path.join(REFERENCE_DIR, name + '.txt'))
+        if scale != 1 :
+            img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+            # Border points sit on the last row/column, keep them inside the scaled image
+            face_points = [(min(x * scale, img.shape[1] - 1), min(y * scale, img.shape[0] - 1)) for (x, y) in face_points]
+        images.append(img)
+        points.append(face_points)
+
+    return images, points
+
+def profile(step, units) :
+    """
+    Runs step(i) for i in range(units) and returns timings plus the traced peak memory of one extra step.
+    Memory is traced in a separate call so that tracemalloc does not skew the latencies; it covers
+    every NumPy buffer (including cv2 outputs) but not OpenCV's internal scratch memory.
+    """
+    latencies = []
+    for i in range(units) :
+        start = time.perf_counter()
+        step(i)
+        latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    step(0)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies = np.float64(latencies) * 1000
+    return {'units' : units,
+            'wall_s' : round(float(latencies.sum()) / 1000, 6),
+            'p50_ms' : round(float(np.percentile(latencies, 50)), 4),
+            'p90_ms' : round(float(np.percentile(latencies, 90)), 4),
+            'p99_ms' : round(float(np.percentile(latencies, 99)), 4),
+            'peak_mb' : round(peak / 2 ** 20, 3)}
+
+def bench_delaunay(images, points, repeat) :
+    return profile(lambda i : build_delaunay(images[0], points[0]), repeat)
+
+def bench_triangle(images, points, alpha=0.5) :
+    """
+    Latency of single morphTriangle calls over the whole mesh
+    """
+    img1, img2 = np.float32(images[0]), np.float32(images[1])
+    face1_points, face2_points = points
+    triangles = build_delaunay(img1, face1_points)
+    img = np.zeros(img1.shape, dtype=np.float32)
+
+    def step(t) :
+        v1, v2, v3 = triangles[t]
+        triangle1 = [face1_points[v1], face1_points[v2], face1_points[v3]]
+        triangle2 = [face2_points[v1], face2_points[v2], face2_points[v3]]
+        triangle = [tuple((1 - alpha) * np.float64(p1) + alpha * np.float64(p2)) for (p1, p2) in zip(triangle1, triangle2)]
+        morphTriangle(img1, img2, img, triangle1, triangle2, triangle, alpha)
+
+    return profile(step, len(triangles))
+
+def bench_render(images, points, nframes, renderer) :
+    """
+    Full frame loop, one unit per frame. The plan renderer gets its plan up front, as if loaded from a file.
+    """
+    img1, img2 = SOURCE_DTYPES[renderer](images[0]), SOURCE_DTYPES[renderer](images[1])
+    triangles = build_delaunay(img1, points[0])
+    alphas = np.linspace(0, 1, nframes)
+    options = {'plan' : MorphPlan.build(points[0], points[1], triangles, alphas)} if renderer == 'plan' else None
+
+    return profile(lambda f : morph_frame(img1, img2, points[0], points[1], triangles, float(alphas[f]), renderer, options), nframes)
+
+def bench_lod(images, points, nframes, lod_tile=128) :
+    """
+    Triangle renderer with the tiled background triangles, one unit per frame, plus the pixels that the
+    background triangles process at alpha 0.5 with and without tiling
+    """
+    img1, img2 = np.float32(images[0]), np.float32(images[1])
+    triangles = build_delaunay(img1, points[0])
+    alphas = np.linspace(0, 1, nframes)
+
+    record = profile(lambda f : morph_frame(img1, img2, points[0], points[1], triangles, float(alphas[f]), 
+                                            'triangle', {'lod_tile' : lod_tile}), nframes)
+    stats = triangle_stats(points[0], points[1], triangles, 0.5, img1.shape, lod_tile)
+    background = stats[stats['background']]
+    record.update(lod_tile=lod_tile, background_triangles=len(background), triangles=len(stats),
+                  background_rect_pixels=int(background['rect_pixels'].sum()),
+                  background_touched_pixels=int(background['touched_pixels'].sum()),
+                  background_area=int(background['area'].sum()))
+
+    return record
+
+def bench_align(image_path, landmarks, output_size, single_warp, repeat, tmp_dir) :
+    align = image_align_single_warp if single_warp else image_align
+    dst_file = os.path.join(tmp_dir, 'aligned.png')
+
+    return profile(lambda i : align(image_path, dst_file, landmarks, output_size=output_size), repeat)
+
+def bench_detect(image, repeat, max_side=None) :
+    from landmark_detector import get_models, detect_clearest_face
+    detector, predictor = get_models(os.path.join(REPO_DIR, 'my_code', 'shape_predictor_68_face_landmarks.dat'))
+    image_gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    return profile(lambda i : detect_clearest_face(image_gray, detector, predictor, max_side=max_side), repeat)
+
+def bench_writer(frame, nframes, output, tmp_dir) :
+    """
+    Frame output, one unit per frame written. Writers are asynchronous, so the latencies are what the
+    render loop waits for and close_s is the time spent draining the queued frames at the end.
+    """
+    export_path = {'ffmpeg' : os.path.join(tmp_dir, 'bench.mp4'), 'npy' : os.path.join(tmp_dir, 'bench.npy')}.get(output, tmp_dir)
+    # The extra memory-tracing step writes one more frame
+    writer = open_writer(output, export_path, 'bench', nframes + 1)
+
+    frame = np.uint8(frame)
+    with writer :
+        record = profile(lambda f : writer.write(frame), nframes)
+        start = time.perf_counter()
+    record['close_s'] = round(time.perf_counter() - start, 6)
+
+    return record
+
+def load_reference_module() :
+    """
+    reference_code/faceMorph.py, imported under another name so it does not shadow my_code/faceMorph.py
+    """
+    spec = importlib.util.spec_from_file_location('reference_faceMorph', os.path.join(REFERENCE_DIR, 'faceMorph.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+def bench_fidelity(images, points, renderer, alphas=(0.25, 0.5, 0.75)) :
+    """
+    PSNR (dB) of a renderer against reference_code/faceMorph.py with the reference tri.txt mesh
+    """
+    reference = load_reference_module()
+    img1, img2 = np.float32(images[0]), np.float32(images[1])
+    face1_points, face2_points = points
+    triangles = readTriangles(os.path.join(REFERENCE_DIR, 'tri.txt'))
+
+    psnr = []
+    for alpha in alphas :
+        points_alpha = [((1 - alpha) * x1 + alpha * x2, (1 - alpha) * y1 + alpha * y2)
+                        for ((x1, y1), (x2, y2)) in zip(face1_points, face2_points)]
+        expected = np.zeros(img1.shape, dtype=np.float32)
+        for (x, y, z) in triangles :
+            reference.morphTriangle(img1, img2, expected, [face1_points[x], face1_points[y], face1_points[z]],
+                                    [face2_points[x], face2_points[y], face2_points[z]],
+                                    [points_alpha[x], points_alpha[y], points_alpha[z]], alpha)
+
+        frame = morph_frame(SOURCE_DTYPES[renderer](img1), SOURCE_DTYPES[renderer](img2), 
+                            face1_points, face2_points, triangles, alpha, renderer)
+        psnr.append(cv2.PSNR(np.uint8(expected), np.uint8(frame)))
+
+    return {'alphas' : list(alphas), 'psnr_db' : [round(float(p), 3) for p in psnr], 'min_psnr_db' : round(float(min(psnr)), 3)}
+
+def environment() :
+    """
+    Metadata that identifies a result file
+    """
+    try :
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError :
+        commit = ''
+
+    return {'commit' : commit, 'time' : time.strftime('%Y-%m-%dT%H:%M:%S'), 'python' : platform.python_version(),
+            'numpy' : np.__version__, 'opencv' : cv2.__version__, 'machine' : platform.machine(), 'cpus' : os.cpu_count()}
+
+def run(stages, scales, frame_counts, renderers, repeat) :
+    results = []
+    tmp_dir = tempfile.mkdtemp(prefix='face_morphing_bench_')
+
+    def record(stage, case, measure) :
+        try :
+            result = measure()
+        except ImportError as e :
+            result = {'skipped' : str(e)}
+        results.append(dict(stage=stage, **case, **result))
+        print(json.dumps(results[-1]))
+
+    try :
+        for scale in scales :
+            images, points = load_pair(*REFERENCE_PAIRS[0], scale=scale)
+            resolution = f'{images[0].shape[1]}x{images[0].shape[0]}'
+            case = {'input' : 'reference', 'scale' : scale, 'resolution' : resolution}
+
+            if 'delaunay' in stages :
+                record('delaunay', case, lambda : bench_delaunay(images, points, repeat))
+            if 'triangle' in stages :
+                record('triangle', case, lambda : bench_triangle(images, points))
+            for nframes in frame_counts :
+                for renderer in renderers :
+                    if 'render' in stages :
+                        record('render', dict(case, frames=nframes, renderer=renderer),
+                               lambda : bench_render(images, points, nframes, renderer))
+                if 'lod' in stages :
+                    record('lod', dict(case, frames=nframes, renderer='triangle'), lambda : bench_lod(images, points, nframes))
+                for output in OUTPUTS :
+                    if 'writer' in stages and (output != 'ffmpeg' or shutil.which('ffmpeg')) :
+                        record('writer', dict(case, frames=nframes, output=output),
+                               lambda : bench_writer(images[0], nframes, output, tmp_dir))
+            if 'fidelity' in stages :
+                for renderer in renderers :
+                    record('fidelity', dict(case, renderer=renderer), lambda : bench_fidelity(images, points, renderer))
+            if 'align' in stages :
+                image_path = os.path.join(tmp_dir, f'align-{scale}.jpg')
+                cv2.imwrite(image_path, images[0])
+                for single_warp in (False, True) :
+                    record('align', dict(case, single_warp=single_warp),
+                           lambda : bench_align(image_path, points[0][:68], 1024, single_warp, repeat, tmp_dir))
+            if 'detect' in stages :
+                for max_side in (None, 1024) :
+                    record('detect', dict(case, max_side=max_side), lambda : bench_detect(images[0], repeat, max_side))
+
+        if 'detect' in stages :
+            # In-the-wild example photos, detection only: they do not ship landmarks
+            for name in ('harry.jpg', 'hermione.jpg', 'max-sharpness.jpg') :
+                image = cv2.imread(os.path.join(EXAMPLE_DIR, name))
+                case = {'input' : name, 'scale' : 1, 'resolution' : f'{image.shape[1]}x{image.shape[0]}'}
+                record('detect', dict(case, max_side=None), lambda : bench_detect(image, repeat))
+    finally :
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return results
+
+def case_key(result) :
+    return tuple(sorted((k, str(v)) for (k, v) in result.items() if k in ('stage', 'input', 'scale', 'frames', 'renderer', 'output', 'single_warp', 'max_side')))
+
+def compare(old_path, new_path) :
+    """
+    Prints wall time, p50 latency and peak memory ratios (new / old) for the cases present in both files
+    """
+    with open(old_path) as file :
+        old = {case_key(r) : r for r in json.load(file)['results']}
+    with open(new_path) as file :
+        new = json.load(file)['results']
+
+    for result in new :
+        before = old.get(case_key(result))
+        if before is None or 'wall_s' not in result or 'wall_s' not in before :
+            continue
+        name = ' '.join(f'{k}={v}' for (k, v) in case_key(result))
+        ratios = [f'{m} x{result[m] / before[m]:.2f}' for m in ('wall_s', 'p50_ms', 'peak_mb') if before[m]]
+        print(f'{name}: ' + ', '.join(ratios))
+
+if __name__ == '__main__' :
+    # Input arguments
+    ap = argparse.ArgumentParser(prog='benchmark', description='Benchmark the morphing pipeline stages')
+    ap.add_argument("--stages", default=','.join(STAGES), help=f"comma separated stages among {','.join(STAGES)}")
+    ap.add_argument("--scales", default="1,2", help="comma separated upscale factors of the reference images")
+    ap.add_argument("--frames", default="10,40", help="comma separated frame counts for the render and writer stages")
+    ap.add_argument("--renderers", default=','.join(sorted(RENDERERS)), help="comma separated renderers")
+    ap.add_argument("--repeat", default=5, type=int, help="repetitions of the single shot stages")
+    ap.add_argument("--out", default="bench_results.json", help="path of the machine-readable results")
+    ap.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files instead of running")
+    args = vars(ap.parse_args())
+
+    if args["compare"] :
+        compare(*args["compare"])
+        exit()
+
+    results = run(args["stages"].split(','), [int(s) for s in args["scales"].split(',')],
+                  [int(f) for f in args["frames"].split(',')], args["renderers"].split(','), args["repeat"])
+
+    with open(args["out"], 'w') as file :
+        json.dump({'environment' : environment(), 'results' : results}, file, indent=1)
+    print(f'\033[0;32mBenchmark results exported to {args["out"]}\033[0m')
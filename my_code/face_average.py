@@ -0,0 +1,97 @@
+import argparse
+import os
+import numpy as np
+import cv2
+import instrumentation
+from faceMorph import readPoints, addAdditionalPoints, build_delaunay, rasterize_triangles, triangle_affines, build_source_maps
+
+def mean_landmarks(landmarks, weights) :
+    """
+    Weighted mean shape of K landmark sets given as a (K, N, 2) array
+    """
+    return np.tensordot(weights, np.float64(landmarks), axes=1)
+
+def normalize_weights(weights, count) :
+    """
+    Weights as a float64 array summing to 1, uniform when weights is None
+    """
+    if weights is None :
+        return np.full(count, 1.0 / count)
+
+    weights = np.float64(weights)
+    if weights.shape != (count,) :
+        raise ValueError(f'expected {count} weights, got {weights.size}')
+    if (weights < 0).any() or weights.sum() <= 0 :
+        raise ValueError('weights must be non-negative with a positive sum')
+
+    return weights / weights.sum()
+
+def average_faces(images, landmarks, weights=None, delaunay_group=None) :
+    """
+    Weighted K-way face average: every source is warped once into the weighted mean shape and
+    accumulated into a single float32 buffer. images are paths (decoded one at a time) or BGR arrays,
+    all of the same size; landmarks is (K, N, 2) in the same point order for every face.
+    Memory stays at about one source image, one warped image and the accumulator, whatever K is.
+    Returns the uint8 average and the mean landmarks, rounded to whole pixels.
+    """
+    landmarks = np.float64(landmarks)
+    if len(images) != len(landmarks) :
+        raise ValueError(f'{len(images)} images but {len(landmarks)} landmark sets')
+    weights = normalize_weights(weights, len(images))
+
+    accumulator = None
+    for (k, (image, weight)) in enumerate(zip(images, weights)) :
+        if weight == 0 :
+            continue
+        if isinstance(image, str) :
+            filename, image = image, cv2.imread(image)
+            if image is None :
+                raise ValueError(f'cannot read {filename}')
+
+        if accumulator is None :
+            # Mean shape, its mesh and its triangle labels are shared by every source
+            size = image.shape
+            border = np.float64(addAdditionalPoints([], size))
+            # Rounded to whole pixels: build_delaunay matches the vertexes it gets back by truncated coordinates,
+            # two distinct float points truncated to the same pixel would share an index. Points that are
+            # equal once rounded (landmark files holding the border points already) are a single vertex anyway.
+            mean_points = np.concatenate([np.rint(mean_landmarks(landmarks, weights)), border])
+            if delaunay_group is None :
+                delaunay_group = build_delaunay(image, [tuple(p) for p in mean_points])
+            labels = rasterize_triangles(mean_points, delaunay_group, size)
+            accumulator = np.zeros(size, dtype=np.float32)
+        elif image.shape != size :
+            raise ValueError(f'all images must have the same size, image {k} is {image.shape[1]}x{image.shape[0]}')
+
+        with instrumentation.timer('warp_to_mean', index=k) :
+            source_points = np.concatenate([landmarks[k], border])
+            map_x, map_y = build_source_maps(labels, triangle_affines(source_points, mean_points, delaunay_group))
+            warped = cv2.remap(np.float32(image), map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+            cv2.scaleAdd(warped, float(weight), accumulator, dst=accumulator)
+
+    if accumulator is None :
+        raise ValueError('no face with a positive weight')
+
+    return np.uint8(np.clip(np.rint(accumulator), 0, 255)), mean_points[:len(landmarks[0])]
+
+if __name__ == '__main__' :
+    # Input arguments
+    ap = argparse.ArgumentParser(prog='face_average', description='Weighted average of many faces')
+    ap.add_argument("--images", nargs="+", required=True, help="paths to the input images, landmarks are read from <image>.txt files")
+    ap.add_argument("--weights", nargs="+", type=float, help="one weight per image (default: uniform)")
+    ap.add_argument("--out", required=True, help="path of the averaged image")
+    args = vars(ap.parse_args())
+
+    landmarks = []
+    for filename in args["images"] :
+        out_dir, basename = os.path.split(filename)
+        landmarks.append(readPoints(os.path.join(out_dir, os.path.splitext(basename)[0] + '.txt')))
+
+    try :
+        average, _ = average_faces(args["images"], landmarks, args["weights"])
+    except ValueError as e :
+        print(f'\033[1;41mERROR! {e}\033[0m')
+        exit(1)
+
+    cv2.imwrite(args["out"], average)
+    print(f'\033[0;32mAverage of {len(args["images"])} faces exported to {args["out"]}\033[0m')
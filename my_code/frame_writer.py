@@ -0,0 +1,336 @@
+import os
+import queue
+import shutil
+import subprocess
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+import instrumentation
+
+# Output formats of ImageSequenceWriter and the cv2.imwrite flag their compression value goes to
+IMAGE_PARAMS = {
+    'png' : cv2.IMWRITE_PNG_COMPRESSION,
+    'jpg' : cv2.IMWRITE_JPEG_QUALITY,
+}
+OUTPUTS = ('png', 'jpg', 'npy', 'ffmpeg')
+
+class ImageSequenceWriter :
+    """
+    Writes every frame as <out_dir>/<prefix>-NNNN.png (or .jpg), the layout morphing.sh used to feed ffmpeg.
+    Frames are compressed on a pool of threads (cv2 releases the GIL while encoding) with at most
+    2 * threads frames pending, so rendering goes on meanwhile; frames must not be modified once written.
+    compression is the PNG level [0-9] or the JPEG quality [0-100], None keeps OpenCV's default.
+    """
+    def __init__(self, out_dir, prefix, extension='png', compression=None, threads=2) :
+        if extension not in IMAGE_PARAMS :
+            raise ValueError(f'unsupported image format {extension}, expected one of {sorted(IMAGE_PARAMS)}')
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.extension = extension
+        self.params = [] if compression is None else [IMAGE_PARAMS[extension], int(compression)]
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(max_workers=threads) if threads > 0 else None
+        self.pending = deque()
+        self.frames_written = 0
+
+    def path(self, index) :
+        return os.path.join(self.out_dir, self.prefix + '-' + str(index).zfill(4) + '.' + self.extension)
+
+    def _encode(self, frame, index) :
+        with instrumentation.timer('write_frame', output=self.extension, index=index) :
+            if not cv2.imwrite(self.path(index), frame, self.params) :
+                raise RuntimeError(f'cannot write {self.path(index)}')
+        instrumentation.count('frames_written')
+
+    def write(self, frame, index=None) :
+        """
+        Writes the next frame, or frame number index when only some frames of a sequence are rendered
+        """
+        frame = np.asarray(frame, dtype=np.uint8)
+        index = self.frames_written if index is None else index
+        self.frames_written += 1
+        if self.pool is None :
+            self._encode(frame, index)
+            return
+
+        self.pending.append(self.pool.submit(self._encode, frame, index))
+        while len(self.pending) > 2 * self.threads :
+            self.pending.popleft().result()
+
+    def write_again(self, index) :
+        """
+        Outputs frame index again as the next frame, by linking its file instead of encoding it twice
+        """
+        self._wait()
+        src, dst = self.path(index), self.path(self.frames_written)
+        if os.path.exists(dst) :
+            os.remove(dst)
+        try :
+            os.link(src, dst)
+        except OSError :
+            shutil.copyfile(src, dst)
+        self.frames_written += 1
+        instrumentation.count('frames_written')
+
+    def _wait(self) :
+        while self.pending :
+            self.pending.popleft().result()
+
+    def close(self) :
+        try :
+            self._wait()
+        finally :
+            if self.pool is not None :
+                self.pool.shutdown()
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) :
+        if exc_type is not None and self.pool is not None :
+            # Do not hide the original error behind an encoding one
+            self.pool.shutdown(cancel_futures=True)
+            self.pending.clear()
+        self.close()
+
+class NpyStackWriter :
+    """
+    Writes all the frames into one (nframes, height, width, 3) uint8 .npy file through a memory map.
+    Downstream tools read it without decoding, np.load(npy_path, mmap_mode='r')[i] is frame i.
+    The file is created on the first frame, once the frame size is known.
+    """
+    def __init__(self, npy_path, nframes) :
+        self.npy_path = npy_path
+        self.nframes = nframes
+        self.stack = None
+        self.frames_written = 0
+
+    def write(self, frame) :
+        if self.stack is None :
+            self.stack = np.lib.format.open_memmap(self.npy_path, mode='w+', dtype=np.uint8, shape=(self.nframes, *np.shape(frame)))
+        if self.frames_written >= self.nframes :
+            raise RuntimeError(f'{self.npy_path} only holds {self.nframes} frames')
+
+        with instrumentation.timer('write_frame', output='npy', index=self.frames_written) :
+            self.stack[self.frames_written] = frame
+        self.frames_written += 1
+        instrumentation.count('frames_written')
+
+    def write_again(self, index) :
+        """
+        Outputs frame index again as the next frame, copied inside the stack
+        """
+        self.write(self.stack[index])
+
+    def close(self) :
+        if self.stack is None :
+            return
+        self.stack.flush()
+        self.stack = None
+        if self.frames_written != self.nframes :
+            raise RuntimeError(f'only {self.frames_written} of {self.nframes} frames were written to {self.npy_path}')
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, *exc) :
+        self.close()
+
+def ffmpeg_command(video_path, width, height, fps=25, bitrate='10M', pix_fmt='yuv420p', ffmpeg='ffmpeg', output_args=()) :
+    """
+    ffmpeg command encoding raw width x height BGR frames read from stdin into video_path ('-' for stdout)
+    """
+    return [ffmpeg, '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-framerate', str(fps),
+            '-i', '-',
+            '-r', str(fps), '-b:v', str(bitrate), '-pix_fmt', pix_fmt,
+            # yuv420p needs even dimensions
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+            *output_args, video_path]
+
+class FFmpegWriter :
+    """
+    Pipes raw BGR frames into an ffmpeg subprocess, no intermediate files are written.
+    ffmpeg is started on the first frame (the frame size is only known then) and encodes
+    in its own process, so rendering the next frame overlaps with encoding the previous ones.
+    """
+    def __init__(self, video_path, fps=25, bitrate='10M', pix_fmt='yuv420p', ffmpeg='ffmpeg') :
+        self.video_path = video_path
+        self.fps = fps
+        self.bitrate = bitrate
+        self.pix_fmt = pix_fmt
+        self.ffmpeg = ffmpeg
+        self.process = None
+        self.frames_written = 0
+
+    def _start(self, width, height) :
+        command = ffmpeg_command(self.video_path, width, height, self.fps, self.bitrate, self.pix_fmt, self.ffmpeg)
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frame) :
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        if self.process is None :
+            self._start(frame.shape[1], frame.shape[0])
+
+        try :
+            with instrumentation.timer('write_frame', output='ffmpeg', index=self.frames_written) :
+                self.process.stdin.write(memoryview(frame).cast('B'))
+        except BrokenPipeError :
+            raise RuntimeError(f'ffmpeg exited with code {self.process.wait()} while encoding {self.video_path}')
+        self.frames_written += 1
+        instrumentation.count('frames_written')
+        instrumentation.count('bytes_piped', frame.nbytes)
+
+    def close(self) :
+        if self.process is None :
+            return
+        with instrumentation.timer('ffmpeg_finish') :
+            self.process.stdin.close()
+            code = self.process.wait()
+        self.process = None
+        if code != 0 :
+            raise RuntimeError(f'ffmpeg exited with code {code} while encoding {self.video_path}')
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) :
+        if exc_type is not None and self.process is not None :
+            # Do not leave a half-written video behind a failed render
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+        self.close()
+
+class AsyncWriter :
+    """
+    Runs the write() calls of another writer on a background thread fed by a queue of at most max_queue frames,
+    so that rendering is only blocked when the writer falls max_queue frames behind.
+    Frames must not be modified once written. Errors of the writer are raised by the next write() or by close().
+    """
+    def __init__(self, writer, max_queue=8) :
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='frame-writer', daemon=True)
+        self.thread.start()
+        if hasattr(writer, 'write_again') :
+            self.write_again = lambda index : self._put(writer.write_again, index)
+
+    def _run(self) :
+        while True :
+            item = self.queue.get()
+            if item is None :
+                return
+            # Keep draining after an error so that the producer never blocks on a full queue
+            if self.error is None :
+                try :
+                    item[0](item[1])
+                except BaseException as e :
+                    self.error = e
+
+    def _put(self, method, value) :
+        if self.error is not None :
+            raise self.error
+        self.queue.put((method, value))
+
+    def write(self, frame) :
+        self._put(self.writer.write, frame)
+
+    def _join(self) :
+        if self.thread.is_alive() :
+            self.queue.put(None)
+            self.thread.join()
+
+    def close(self) :
+        self._join()
+        if self.error is not None :
+            self.writer.__exit__(type(self.error), self.error, None)
+            raise self.error
+        self.writer.close()
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) :
+        if exc_type is None :
+            self.close()
+            return
+        self._join()
+        self.writer.__exit__(exc_type, exc_value, traceback)
+
+def loop_indices(nframes, pingpong=False, repeat=1) :
+    """
+    Order in which nframes rendered frames are output: forward, or forward then backward with pingpong
+    (both ends are not doubled, so the cycle loops seamlessly), the whole cycle repeat times.
+    A ping-pong output ends on the first frame again.
+    """
+    cycle = list(range(nframes))
+    if pingpong :
+        cycle += list(range(nframes - 2, 0, -1))
+    order = cycle * repeat
+    if pingpong and nframes > 1 :
+        order.append(0)
+
+    return order
+
+class LoopWriter :
+    """
+    Outputs the rendered frames in loop_indices order. Frames are written once as they are rendered and
+    replayed at close, with writer.write_again when the writer can copy its own output (no encoding,
+    nothing kept in memory) or from the frames kept in memory otherwise; nothing is rendered twice.
+    """
+    def __init__(self, writer, pingpong=False, repeat=1) :
+        self.writer = writer
+        self.pingpong = pingpong
+        self.repeat = repeat
+        self.frames = None if hasattr(writer, 'write_again') else []
+        self.rendered = 0
+
+    def write(self, frame) :
+        self.writer.write(frame)
+        if self.frames is not None :
+            self.frames.append(frame)
+        self.rendered += 1
+
+    def close(self) :
+        for index in loop_indices(self.rendered, self.pingpong, self.repeat)[self.rendered:] :
+            if self.frames is None :
+                self.writer.write_again(index)
+            else :
+                self.writer.write(self.frames[index])
+        self.frames = None
+        self.writer.close()
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) :
+        if exc_type is None :
+            self.close()
+        else :
+            self.writer.__exit__(exc_type, exc_value, traceback)
+
+def open_writer(output, export_path, prefix, nframes, fps=25, bitrate='10M', pix_fmt='yuv420p',
+                compression=None, threads=2, pingpong=False, repeat=1) :
+    """
+    Frame sink for one of OUTPUTS. export_path is the frames directory for png and jpg (frames named
+    <prefix>-NNNN), the .npy or video path otherwise. nframes is the number of rendered frames, the
+    ping-pong and repeated frames are added by a LoopWriter around the sink.
+    """
+    if output not in OUTPUTS :
+        raise ValueError(f'unsupported output {output}, expected one of {OUTPUTS}')
+
+    if output == 'ffmpeg' :
+        writer = AsyncWriter(FFmpegWriter(export_path, fps, bitrate, pix_fmt))
+    elif output == 'npy' :
+        writer = NpyStackWriter(export_path, len(loop_indices(nframes, pingpong, repeat)))
+    else :
+        writer = ImageSequenceWriter(export_path, prefix, output, compression, threads)
+
+    if pingpong or repeat > 1 :
+        writer = LoopWriter(writer, pingpong, repeat)
+
+    return writer
@@ -0,0 +1,141 @@
+import argparse
+import os
+import time
+import numpy as np
+import instrumentation
+from faceMorph import addAdditionalPoints, build_delaunay, render_frames, RENDERERS, SOURCE_DTYPES, TRIANGULATION_CACHE_DIR
+from frame_writer import open_writer, OUTPUTS
+from landmark_cache import LandmarkCache, LANDMARK_CACHE_DIR
+from landmark_detector import detect_all_landmarks
+
+def face_centers(faces, size) :
+    """
+    Centers of the face rects as fractions of the image width and height, so images of different framing compare
+    """
+    rects = np.float64([rect for (_, rect, _) in faces]).reshape(-1, 4)
+    return (rects[:, :2] + rects[:, 2:]) / 2 / [size[1], size[0]]
+
+def pair_faces(faces1, size1, faces2, size2) :
+    """
+    Pairs the faces of two images by position: the two closest face centers first, then the closest
+    of the remaining faces, and so on. Returns (i, j) index pairs sorted by i, faces without a partner
+    are left out.
+    """
+    distances = np.linalg.norm(face_centers(faces1, size1)[:, None] - face_centers(faces2, size2)[None], axis=2)
+    pairs = []
+    for _ in range(min(distances.shape)) :
+        i, j = np.unravel_index(np.argmin(distances), distances.shape)
+        pairs.append((int(i), int(j)))
+        distances[i, :] = np.inf
+        distances[:, j] = np.inf
+
+    return sorted(pairs)
+
+def parse_pairs(spec, nfaces1, nfaces2) :
+    """
+    Explicit pairing such as '0:1,1:0' (face i of image 1 morphs into face j of image 2, faces numbered left to right)
+    """
+    pairs = []
+    for item in spec.split(',') :
+        i, _, j = item.partition(':')
+        pairs.append((int(i), int(j)))
+
+    first, second = [i for (i, _) in pairs], [j for (_, j) in pairs]
+    if len(set(first)) != len(first) or len(set(second)) != len(second) :
+        raise ValueError(f'a face can only be in one pair, got {spec}')
+    if not all(0 <= i < nfaces1 for i in first) or not all(0 <= j < nfaces2 for j in second) :
+        raise ValueError(f'pairs {spec} out of range, {nfaces1} and {nfaces2} faces were detected')
+
+    return pairs
+
+def group_points(faces, indexes, size) :
+    """
+    Landmarks of the given faces one after the other, then the 8 border points. Paired faces at the same
+    position in both lists make a single mesh that covers every face and the background at once.
+    """
+    points = [(int(x), int(y)) for i in indexes for (x, y) in faces[i][0]]
+    return addAdditionalPoints(points, size)
+
+def morph_group(filename1, filename2, fps, duration_ms, output='ffmpeg', video=None, renderer='triangle', workers=1,
+                bitrate='10M', pix_fmt='yuv420p', cache_dir=LANDMARK_CACHE_DIR, tri_cache=TRIANGULATION_CACHE_DIR,
+                compression=None, encoder_threads=2, pingpong=False, repeat=1, renderer_options=None, pairs=None) :
+    """
+    Morphs every face of a group photo into its partner in another photo, in one pass per frame.
+    Each image is decoded once. All paired faces and the border points are triangulated together, so
+    every frame is a single render where the background triangles are warped once, whatever the number of faces.
+    Faces without a partner stay part of the background. Returns (export path, pairs).
+    """
+    nframes = fps * duration_ms // 1000
+    if nframes <= 0 :
+        raise ValueError('frames number set to 0, fps or duration might be 0')
+
+    cache = LandmarkCache(cache_dir) if cache_dir else None
+    image1, faces1 = detect_all_landmarks(filename1, cache)
+    image2, faces2 = detect_all_landmarks(filename2, cache)
+    if image1.shape != image2.shape :
+        raise ValueError(f'images must have the same size, got {image1.shape[1]}x{image1.shape[0]} and {image2.shape[1]}x{image2.shape[0]}')
+
+    pairs = parse_pairs(pairs, len(faces1), len(faces2)) if pairs else pair_faces(faces1, image1.shape, faces2, image2.shape)
+    if not pairs :
+        raise ValueError(f'no faces to pair, {len(faces1)} detected in {filename1} and {len(faces2)} in {filename2}')
+    instrumentation.count('faces_paired', len(pairs))
+
+    img1, img2 = SOURCE_DTYPES[renderer](image1), SOURCE_DTYPES[renderer](image2)
+    face1_points = group_points(faces1, [i for (i, _) in pairs], img1.shape)
+    face2_points = group_points(faces2, [j for (_, j) in pairs], img2.shape)
+    delaunay_group = build_delaunay(img1, face1_points, tri_cache)
+
+    out_dir = os.path.dirname(filename1)
+    output_name = '-'.join(os.path.splitext(os.path.basename(f))[0] for f in (filename1, filename2)) + '-group'
+    if output in ('ffmpeg', 'npy') :
+        export_path = video or os.path.join(out_dir, output_name + ('.mp4' if output == 'ffmpeg' else '.npy'))
+    else :
+        export_path = out_dir
+
+    with open_writer(output, export_path, 'morph-' + output_name, nframes, fps, bitrate, pix_fmt,
+                     compression, encoder_threads, pingpong, repeat) as writer :
+        for frame in render_frames(img1, img2, face1_points, face2_points, delaunay_group, np.linspace(0, 1, nframes),
+                                   renderer, workers, renderer_options) :
+            writer.write(frame)
+
+    return export_path, pairs
+
+if __name__ == '__main__' :
+    # Input arguments
+    ap = argparse.ArgumentParser(prog='group_morph', description='Morph every face of a group photo into another group photo')
+    ap.add_argument("image1", help="path to input image 1")
+    ap.add_argument("image2", help="path to input image 2, same size as image 1")
+    ap.add_argument("fps", type=int, help="frame-rate in fps")
+    ap.add_argument("duration", type=int, help="morphing duration in miliseconds")
+    ap.add_argument("--pairs", help="face pairs such as 0:1,1:0, faces numbered left to right (default: pair by position)")
+    ap.add_argument("--output", default="ffmpeg", choices=OUTPUTS,
+                    help="pipe frames into ffmpeg, write a PNG or JPEG sequence or a memory-mapped .npy frame stack")
+    ap.add_argument("--video", help="output video or .npy path (default <dir1>/<name1>-<name2>-group.mp4 or .npy)")
+    ap.add_argument("--compression", type=int, help="PNG compression level [0-9] or JPEG quality [0-100]")
+    ap.add_argument("--encoder_threads", default=2, type=int, help="threads compressing PNG or JPEG frames")
+    ap.add_argument("--pingpong", action="store_true", help="morph back to image 1, reusing the rendered frames")
+    ap.add_argument("--repeat", default=1, type=int, help="number of times the morph (or ping-pong cycle) is output")
+    ap.add_argument("--bitrate", default="10M", help="video bitrate")
+    ap.add_argument("--pix_fmt", default="yuv420p", help="video pixel format")
+    ap.add_argument("--renderer", default="triangle", choices=sorted(RENDERERS), help="frame renderer")
+    ap.add_argument("--workers", default=1, type=int, help="number of rendering processes")
+    ap.add_argument("--cache_dir", default=LANDMARK_CACHE_DIR, help="directory of the landmark cache, empty string disables it")
+    ap.add_argument("--tri_cache", default=TRIANGULATION_CACHE_DIR, help="directory of the triangulation cache, empty string disables it")
+    ap.add_argument("--trace", help=f"write a Chrome trace of this run (or set {instrumentation.TRACE_ENV})")
+    args = vars(ap.parse_args())
+    if args["trace"] :
+        instrumentation.enable(args["trace"])
+
+    start = time.perf_counter()
+    try :
+        export_path, pairs = morph_group(args["image1"], args["image2"], args["fps"], args["duration"], args["output"], args["video"],
+                                         args["renderer"], args["workers"], args["bitrate"], args["pix_fmt"], args["cache_dir"],
+                                         args["tri_cache"], args["compression"], args["encoder_threads"], args["pingpong"],
+                                         args["repeat"], pairs=args["pairs"])
+    except ValueError as e :
+        print(f'\033[1;41mERROR! {e}\033[0m')
+        exit(1)
+
+    print(f'\033[0;32m{len(pairs)} face pairs ({", ".join(f"{i}:{j}" for (i, j) in pairs)})\033[0m')
+    print(f'\033[0;32mMorphing results exported in {export_path} ({time.perf_counter() - start:.2f} s)\033[0m')
+    print('\033[0;42mFace morphing Done!\033[0m')
@@ -0,0 +1,136 @@
+import atexit
+import json
+import multiprocessing
+import os
+import threading
+import time
+from collections import defaultdict
+
+# Set FACE_MORPHING_TRACE=<path> to record every run into a Chrome trace file (chrome://tracing, Perfetto)
+TRACE_ENV = 'FACE_MORPHING_TRACE'
+
+# Hot paths test this flag before computing counter values, everything below is a no-op while it is False
+enabled = False
+
+_trace_path = None
+_events = []
+_counters = defaultdict(int)
+_lock = threading.Lock()
+
+def _now_us() :
+    return time.perf_counter_ns() / 1000
+
+class _Timer :
+    """
+    Context manager recording one complete ('X') trace event
+    """
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, args) :
+        self.name = name
+        self.args = args
+
+    def __enter__(self) :
+        self.start = _now_us()
+        return self
+
+    def __exit__(self, *exc) :
+        end = _now_us()
+        event = {'name' : self.name, 'ph' : 'X', 'ts' : self.start, 'dur' : end - self.start,
+                 'pid' : os.getpid(), 'tid' : threading.get_ident()}
+        if self.args :
+            event['args'] = self.args
+        with _lock :
+            _events.append(event)
+
+class _NullTimer :
+    __slots__ = ()
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, *exc) :
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+def timer(name, **args) :
+    """
+    with timer('stage'): ... records the stage duration when instrumentation is enabled
+    """
+    if not enabled :
+        return _NULL_TIMER
+    return _Timer(name, args)
+
+def count(name, value=1) :
+    """
+    Adds value to a run-wide counter (triangles_rendered, pixels_touched, bytes_allocated, frames_written...)
+    """
+    if not enabled :
+        return
+    with _lock :
+        _counters[name] += int(value)
+
+def enable(trace_path=None) :
+    """
+    Turns instrumentation on for this process; with trace_path the trace is written when the process exits
+    """
+    global enabled, _trace_path
+    enabled = True
+    # Worker processes ship their records to the parent (drain/merge), only the main process writes the file
+    if trace_path and _trace_path is None and multiprocessing.parent_process() is None :
+        atexit.register(lambda : write_trace(_trace_path))
+    _trace_path = trace_path or _trace_path
+
+def drain() :
+    """
+    Returns and clears what this process recorded, to ship it from a worker to the parent process
+    """
+    global _events, _counters
+    with _lock :
+        events, counters = _events, dict(_counters)
+        _events, _counters = [], defaultdict(int)
+    return events, counters
+
+def merge(recorded) :
+    """
+    Adds the output of drain() from another process
+    """
+    events, counters = recorded
+    with _lock :
+        _events.extend(events)
+        for (name, value) in counters.items() :
+            _counters[name] += value
+
+def summary() :
+    """
+    Total duration and number of calls per stage, in milliseconds, plus the counters
+    """
+    stages = defaultdict(lambda : {'calls' : 0, 'total_ms' : 0.0})
+    with _lock :
+        for event in _events :
+            stages[event['name']]['calls'] += 1
+            stages[event['name']]['total_ms'] += event['dur'] / 1000
+        counters = dict(_counters)
+
+    return {'stages' : {name : dict(calls=s['calls'], total_ms=round(s['total_ms'], 3)) for (name, s) in stages.items()},
+            'counters' : counters}
+
+def write_trace(path) :
+    """
+    Writes the Chrome trace JSON, with the stage summary and counters under otherData
+    """
+    with _lock :
+        events = list(_events)
+    if events :
+        # Final counter values as counter events, so they show up as tracks too
+        end = max(e['ts'] + e['dur'] for e in events)
+        for (name, value) in sorted(summary()['counters'].items()) :
+            events.append({'name' : name, 'ph' : 'C', 'ts' : end, 'pid' : os.getpid(), 'args' : {name : value}})
+
+    with open(path, 'w') as file :
+        json.dump({'traceEvents' : events, 'displayTimeUnit' : 'ms', 'otherData' : summary()}, file)
+    print(f'\033[0;32mTrace exported to {path}\033[0m')
+
+if os.environ.get(TRACE_ENV) :
+    enable(os.environ[TRACE_ENV])
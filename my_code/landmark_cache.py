@@ -0,0 +1,103 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+# Default location of the on-disk landmark cache
+LANDMARK_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'face_morphing', 'landmarks')
+
+# One fixed-size record per image: 68 (x, y) landmarks, detection rect (left, top, right, bottom) and sharpness
+LANDMARK_RECORD = np.dtype([('landmarks', np.int32, (68, 2)),
+                            ('rect', np.int32, (4,)),
+                            ('sharpness', np.float64)])
+
+def landmark_key(image_bytes, params) :
+    """
+    Content address of a detection: hash of the encoded image file and of the detector parameters
+    """
+    digest = hashlib.sha1(image_bytes)
+    digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+
+    return digest.hexdigest()
+
+class LandmarkCache :
+    """
+    Directory of <key>.npy records (LANDMARK_RECORD), loaded memory-mapped.
+    The directory is kept under max_bytes by evicting the least recently used records.
+    """
+    def __init__(self, cache_dir=LANDMARK_CACHE_DIR, max_bytes=64 * 1024 * 1024) :
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def _path(self, key) :
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key) :
+        """
+        Returns the cached record for key or None
+        """
+        records = self.get_all(key)
+        return records[0] if records is not None and len(records) else None
+
+    def get_all(self, key) :
+        """
+        Returns every cached record for key (possibly none, for an image without faces) or None
+        """
+        path = self._path(key)
+        try :
+            records = np.load(path, mmap_mode='r')
+        except (FileNotFoundError, ValueError) :
+            return None
+
+        # Mark as recently used for eviction, the mapped records stay valid if another process evicted the file meanwhile
+        try :
+            os.utime(path)
+        except FileNotFoundError :
+            pass
+        return records
+
+    def put(self, key, landmarks, rect, sharpness) :
+        """
+        Stores a detection and returns its record
+        """
+        return self.put_all(key, [(landmarks, rect, sharpness)])[0]
+
+    def put_all(self, key, faces) :
+        """
+        Stores any number of (landmarks, rect, sharpness) detections and returns their records
+        """
+        records = np.zeros(len(faces), dtype=LANDMARK_RECORD)
+        for (record, (landmarks, rect, sharpness)) in zip(records, faces) :
+            record['landmarks'] = landmarks
+            record['rect'] = rect
+            record['sharpness'] = sharpness
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        tmp_path = path + '.' + str(os.getpid()) + '.tmp.npy'
+        np.save(tmp_path, records)
+        os.replace(tmp_path, path)
+
+        self.evict()
+        return records
+
+    def evict(self) :
+        """
+        Deletes least recently used records until the cache fits in max_bytes
+        """
+        entries = []
+        with os.scandir(self.cache_dir) as it :
+            for entry in it :
+                if entry.name.endswith('.npy') and not entry.name.endswith('.tmp.npy') :
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in sorted(entries) :
+            if total <= self.max_bytes :
+                break
+            try :
+                os.remove(path)
+            except FileNotFoundError :
+                pass
+            total -= size
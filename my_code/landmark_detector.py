@@ -1,79 +1,346 @@
 import argparse
-import dlib
 import cv2
 import os
-from imutils import face_utils
-
-# Input arguments
-ap = argparse.ArgumentParser()
-ap.add_argument("--image", required=True, help="path to input image")
-args = vars(ap.parse_args())
-
-filename = args["image"]
-out_dir, basename = os.path.split(filename)
-name, extension = os.path.splitext(basename)
-
-print(f'Searching facial landmarks for image {filename}')
-
-# initialize dlib's face detector (HOG-based) and then create the facial landmark predictor
-detector = dlib.get_frontal_face_detector()
-predictor = dlib.shape_predictor("my_code/shape_predictor_68_face_landmarks.dat")
-
-# load the input image and convert it to grayscale
-image = cv2.imread(filename)
-image_gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-# detect faces in the gray-scale image
-print('Detecting faces...')
-dets = detector(image_gray, 1)
-
-# check if any faces have been detected
-if len(dets) == 0 : 
-    print('\033[0;31mWarning! no faces have been detected\033[0m')
-    exit()
-
-# initialize variables to keep track of the clearest face found so far
-max_sharpness = -1
-max_sharpness_shape = None
-max_sharpness_rect = None
-
-# loop over the detected faces
-for (i, rect) in enumerate(dets):
-    # detect the facial landmarks for the face region, 
-    # and convert (x, y)-coordinates to a NumPy array
-    shape = face_utils.shape_to_np(predictor(image_gray, rect))
-
-    # calculate the sharpness of the current face
-    sharpness = cv2.Laplacian(image_gray[rect.top():rect.bottom(), rect.left():rect.right()], cv2.CV_64F).var()
-
-    # if this is the first face or if it's sharper than the previous ones, update the variables
-    if sharpness > max_sharpness:
-        max_sharpness = sharpness
-        max_sharpness_shape = shape
-        max_sharpness_rect = rect
-
-# check if any faces have been found
-if max_sharpness_shape is None:
-    print('\033[0;31mWarning! no faces have been detected\033[0m')
-    exit()
-
-# draw the bounding box and face number for the clearest face
-green = (0, 255, 0) 
-(x, y, w, h) = face_utils.rect_to_bb(max_sharpness_rect)
-cv2.rectangle(image, (x, y), (x + w, y + h), green, 2)
-cv2.putText(image, "Clearest Face", (x - 10, y - 10),
-            cv2.FONT_HERSHEY_SIMPLEX, 0.5, green, 2)
-
-# write the landmarks for the clearest face to a file
-landmarks_file = out_dir + '/' + name + '.txt'      
-f = open(landmarks_file, 'wb')
-for (x, y) in max_sharpness_shape:
-    f.write(str(x).encode("utf-8") + b' ' + str(y).encode("utf-8") + b'\n')
-f.close()
-print(f'\033[0;32mLandmarks exported to {landmarks_file}\033[0m')    
-
-# show the output image with the face detections + facial landmarks
-cv2.imwrite(out_dir + '/' + name + '_landmarks.jpg', image)
-
-print(f'\033[0;32mImage with landmarks exported to {out_dir}/{name}_landmarks.jpg\033[0m')
-print('\033[0;37;42mDetected Done!\033[0m')
\ No newline at end of file
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from landmark_cache import LandmarkCache, LANDMARK_CACHE_DIR, landmark_key
+import instrumentation
+
+PREDICTOR_PATH = "my_code/shape_predictor_68_face_landmarks.dat"
+UPSAMPLE = 1
+# Largest side of the face crop used for the sharpness ranking in pyramid mode
+SHARPNESS_MAX_SIDE = 256
+
+def detector_params(predictor_path=PREDICTOR_PATH, upsample=UPSAMPLE, max_side=None) :
+    """
+    Parameters that change the detection result, part of the landmark cache key
+    """
+    params = {'predictor' : os.path.basename(predictor_path),
+              'predictor_size' : os.path.getsize(predictor_path),
+              'upsample' : upsample}
+    if max_side :
+        params['max_side'] = max_side
+        params['sharpness_max_side'] = SHARPNESS_MAX_SIDE
+
+    return params
+
+def load_models(predictor_path=PREDICTOR_PATH) :
+    """
+    Initialize dlib's face detector (HOG-based) and the facial landmark predictor
+    """
+    with instrumentation.timer('load_models') :
+        import dlib
+        return dlib.get_frontal_face_detector(), dlib.shape_predictor(predictor_path)
+
+# Models already loaded in this process, by predictor path
+_models = {}
+
+def get_models(predictor_path=PREDICTOR_PATH) :
+    """
+    Returns (detector, predictor), loading them only the first time in each process
+    """
+    if predictor_path not in _models :
+        _models[predictor_path] = load_models(predictor_path)
+
+    return _models[predictor_path]
+
+def scale_rect(rect, scale) :
+    """
+    dlib rectangle with every coordinate multiplied by scale
+    """
+    import dlib
+    return dlib.rectangle(int(round(rect.left() * scale)), int(round(rect.top() * scale)),
+                          int(round(rect.right() * scale)), int(round(rect.bottom() * scale)))
+
+def face_sharpness(image_gray, rect, max_side=None) :
+    """
+    Variance of the Laplacian inside the face rect, computed on a copy of at most max_side pixels per side
+    """
+    crop = image_gray[max(rect.top(), 0):rect.bottom(), max(rect.left(), 0):rect.right()]
+    if max_side and crop.size and max(crop.shape) > max_side :
+        scale = max_side / max(crop.shape)
+        crop = cv2.resize(crop, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    return cv2.Laplacian(crop, cv2.CV_64F).var()
+
+def detect_faces(image_gray, detector, predictor, upsample=UPSAMPLE, max_side=None) :
+    """
+    Detects every face and returns a list of (landmarks, rect, sharpness), in detection order.
+    landmarks is a (68, 2) array and rect is (left, top, right, bottom).
+
+    With max_side, faces are searched on a copy downscaled to at most max_side pixels per side,
+    their rects are mapped back and the predictor still runs on the full resolution image.
+    The sharpness ranking then uses crops of at most SHARPNESS_MAX_SIDE pixels.
+    """
+    from imutils import face_utils
+
+    # detect faces in the gray-scale image, or on a downscaled copy of it
+    scale = 1.0
+    detect_image = image_gray
+    if max_side and max(image_gray.shape) > max_side :
+        scale = max_side / max(image_gray.shape)
+        detect_image = cv2.resize(image_gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    with instrumentation.timer('dlib_detect', width=detect_image.shape[1], height=detect_image.shape[0]) :
+        dets = detector(detect_image, upsample)
+    instrumentation.count('faces_detected', len(dets))
+    if scale != 1.0 :
+        dets = [scale_rect(rect, 1.0 / scale) for rect in dets]
+
+    faces = []
+    for rect in dets :
+        # detect the facial landmarks for the face region,
+        # and convert (x, y)-coordinates to a NumPy array
+        with instrumentation.timer('dlib_predict') :
+            shape = face_utils.shape_to_np(predictor(image_gray, rect))
+
+        sharpness = face_sharpness(image_gray, rect, SHARPNESS_MAX_SIDE if max_side else None)
+        faces.append((shape, (rect.left(), rect.top(), rect.right(), rect.bottom()), sharpness))
+
+    return faces
+
+def detect_clearest_face(image_gray, detector, predictor, upsample=UPSAMPLE, max_side=None) :
+    """
+    Detects every face and returns (landmarks, rect, sharpness) of the clearest one, None if there is no face.
+    The first of the equally sharp faces wins.
+    """
+    faces = detect_faces(image_gray, detector, predictor, upsample, max_side)
+    if not faces :
+        return None
+
+    return max(faces, key=lambda face : face[2])
+
+def detect_landmarks(filename, cache=None, predictor_path=PREDICTOR_PATH, max_side=None) :
+    """
+    Loads an image and returns (image, face) where face is (landmarks, rect, sharpness) of the
+    clearest face or None. The cache is looked up first, dlib is only used on a miss.
+    """
+    with instrumentation.timer('detect_landmarks', image=filename) :
+        return _detect_landmarks(filename, cache, predictor_path, max_side)
+
+def read_image(filename) :
+    """
+    Returns (file contents, decoded BGR image), the contents address the landmark cache
+    """
+    with open(filename, 'rb') as file :
+        image_bytes = file.read()
+    image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None :
+        raise ValueError(f'cannot read {filename}')
+    instrumentation.count('bytes_allocated', image.nbytes)
+
+    return image_bytes, image
+
+def _detect_landmarks(filename, cache, predictor_path, max_side) :
+    # load the input image, its contents address the landmark cache
+    image_bytes, image = read_image(filename)
+
+    key = landmark_key(image_bytes, detector_params(predictor_path, max_side=max_side))
+    # An image without faces is cached as an empty record list
+    records = cache.get_all(key) if cache else None
+    if records is not None :
+        instrumentation.count('landmark_cache_hits')
+        if not len(records) :
+            return image, None
+        record = records[0]
+        return image, (record['landmarks'], tuple(int(v) for v in record['rect']), float(record['sharpness']))
+
+    detector, predictor = get_models(predictor_path)
+    face = detect_clearest_face(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), detector, predictor, max_side=max_side)
+    if cache :
+        cache.put_all(key, [face] if face is not None else [])
+
+    return image, face
+
+def detect_all_landmarks(filename, cache=None, predictor_path=PREDICTOR_PATH, max_side=None) :
+    """
+    Loads an image and returns (image, faces) with faces the (landmarks, rect, sharpness) of every
+    face, ordered left to right. The cache holds them under their own key, next to the clearest-face records.
+    """
+    with instrumentation.timer('detect_all_landmarks', image=filename) :
+        image_bytes, image = read_image(filename)
+
+        key = landmark_key(image_bytes, dict(detector_params(predictor_path, max_side=max_side), all_faces=True))
+        records = cache.get_all(key) if cache else None
+        if records is not None :
+            instrumentation.count('landmark_cache_hits')
+            return image, [(r['landmarks'], tuple(int(v) for v in r['rect']), float(r['sharpness'])) for r in records]
+
+        detector, predictor = get_models(predictor_path)
+        faces = detect_faces(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), detector, predictor, max_side=max_side)
+        faces.sort(key=lambda face : face[1][0])
+        if cache :
+            cache.put_all(key, faces)
+
+        return image, faces
+
+def export_landmarks(filename, image, landmarks, rect) :
+    """
+    Writes <name>.txt with the landmarks and <name>_landmarks.jpg with the face rect next to the image
+    """
+    out_dir, basename = os.path.split(filename)
+    name, extension = os.path.splitext(basename)
+
+    # draw the bounding box and face number for the clearest face
+    green = (0, 255, 0)
+    (left, top, right, bottom) = [int(v) for v in rect]
+    image = image.copy()
+    cv2.rectangle(image, (left, top), (right, bottom), green, 2)
+    cv2.putText(image, "Clearest Face", (left - 10, top - 10),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.5, green, 2)
+
+    # write the landmarks for the clearest face to a file
+    landmarks_file = os.path.join(out_dir, name + '.txt')
+    with open(landmarks_file, 'wb') as f :
+        for (x, y) in landmarks:
+            f.write(str(x).encode("utf-8") + b' ' + str(y).encode("utf-8") + b'\n')
+
+    # show the output image with the face detections + facial landmarks
+    landmarks_image = os.path.join(out_dir, name + '_landmarks.jpg')
+    cv2.imwrite(landmarks_image, image)
+
+    return landmarks_file, landmarks_image
+
+# Image extensions picked up from a directory, and suffixes of files this project writes itself
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+OUTPUT_SUFFIXES = ('_landmarks', '-delaunay', '-voronoi')
+
+def list_images(directory=None, manifest=None) :
+    """
+    Image paths of a directory (non recursive) or of a manifest file with one path per line.
+    Relative manifest paths are resolved against the manifest's directory.
+    """
+    if directory is not None :
+        images = []
+        for entry in sorted(os.listdir(directory)) :
+            name, extension = os.path.splitext(entry)
+            if extension.lower() in IMAGE_EXTENSIONS and not name.endswith(OUTPUT_SUFFIXES) :
+                images.append(os.path.join(directory, entry))
+        return images
+
+    images = []
+    base_dir = os.path.dirname(manifest)
+    with open(manifest) as file :
+        for line in file :
+            line = line.strip()
+            if line and not line.startswith('#') :
+                images.append(os.path.join(base_dir, line))
+    return images
+
+# Per-process batch settings, set once by _init_batch_worker
+_batch_state = {}
+
+def _init_batch_worker(cache_dir, predictor_path, max_side, trace=False) :
+    if trace :
+        instrumentation.enable()
+        # Forked workers start with a copy of the parent's records, drop them
+        instrumentation.drain()
+    _batch_state['cache'] = LandmarkCache(cache_dir) if cache_dir else None
+    _batch_state['predictor_path'] = predictor_path
+    _batch_state['max_side'] = max_side
+
+def _detect_and_export(filename) :
+    """
+    Batch task: returns (filename, found, seconds, error), a broken image must not stop the batch
+    """
+    start = time.perf_counter()
+    try :
+        image, face = detect_landmarks(filename, _batch_state['cache'], _batch_state['predictor_path'], _batch_state['max_side'])
+        if face is not None :
+            export_landmarks(filename, image, face[0], face[1])
+    except Exception as e :
+        return filename, False, time.perf_counter() - start, f'{type(e).__name__}: {e}'
+
+    return filename, face is not None, time.perf_counter() - start, None
+
+def _detect_and_export_in_worker(filename) :
+    """
+    _detect_and_export plus the worker's instrumentation records if enabled
+    """
+    return _detect_and_export(filename), instrumentation.drain() if instrumentation.enabled else None
+
+def detect_batch(images, workers=1, cache_dir=LANDMARK_CACHE_DIR, predictor_path=PREDICTOR_PATH, max_side=None) :
+    """
+    Detects and exports landmarks of many images on a pool of workers that keep the models loaded.
+    Generator of (filename, found, seconds, error) in input order.
+    """
+    initargs = (cache_dir, predictor_path, max_side)
+    if workers <= 1 :
+        _init_batch_worker(*initargs)
+        for filename in images :
+            yield _detect_and_export(filename)
+        return
+
+    initargs += (instrumentation.enabled,)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker, initargs=initargs) as pool :
+        for (result, recorded) in pool.map(_detect_and_export_in_worker, images) :
+            if recorded is not None :
+                instrumentation.merge(recorded)
+            yield result
+
+if __name__ == '__main__' :
+    # Input arguments
+    ap = argparse.ArgumentParser()
+    group = ap.add_mutually_exclusive_group(required=True)
+    group.add_argument("--image", help="path to input image")
+    group.add_argument("--dir", help="detect every image of a directory")
+    group.add_argument("--manifest", help="detect every image listed in a text file, one path per line")
+    ap.add_argument("--workers", default=os.cpu_count(), type=int, help="number of detection processes for --dir/--manifest")
+    ap.add_argument("--cache_dir", default=LANDMARK_CACHE_DIR,
+                    help="directory of the landmark cache, empty string disables it")
+    ap.add_argument("--max_side", default=0, type=int,
+                    help="search faces on a copy downscaled to this many pixels per side (0 uses the full image)")
+    ap.add_argument("--trace", help=f"write a Chrome trace of this run (or set {instrumentation.TRACE_ENV})")
+    ap.add_argument("--check_pyramid", action="store_true",
+                    help="with --image and --max_side, also detect at full resolution and print the landmark error")
+    args = vars(ap.parse_args())
+    if args["trace"] :
+        instrumentation.enable(args["trace"])
+
+    if args["image"] is None :
+        images = list_images(args["dir"], args["manifest"])
+        print(f'Searching facial landmarks for {len(images)} images with {args["workers"]} workers')
+
+        start = time.perf_counter()
+        missing = 0
+        for (i, (filename, found, seconds, error)) in enumerate(detect_batch(images, args["workers"], args["cache_dir"], max_side=args["max_side"])) :
+            if found :
+                print(f'[{i + 1}/{len(images)}] {filename}: {seconds:.3f} s')
+            else :
+                missing += 1
+                print(f'\033[0;31m[{i + 1}/{len(images)}] {filename}: {error or "no faces have been detected"}\033[0m')
+        elapsed = time.perf_counter() - start
+
+        print(f'\033[0;32m{len(images) - missing}/{len(images)} images in {elapsed:.2f} s, '
+              f'{len(images) / max(elapsed, 1e-9):.2f} images/s\033[0m')
+        print('\033[0;37;42mDetected Done!\033[0m')
+        exit()
+
+    filename = args["image"]
+    print(f'Searching facial landmarks for image {filename}')
+
+    cache = LandmarkCache(args["cache_dir"]) if args["cache_dir"] else None
+    try :
+        image, face = detect_landmarks(filename, cache, max_side=args["max_side"])
+    except ValueError as e :
+        print(f'\033[1;41mERROR! {e}\033[0m')
+        exit(1)
+
+    # check if any faces have been found
+    if face is None :
+        print('\033[0;31mWarning! no faces have been detected\033[0m')
+        exit()
+
+    if args["check_pyramid"] and args["max_side"] :
+        _, full_face = detect_landmarks(filename, cache)
+        if full_face is None :
+            print('\033[0;31mWarning! no faces have been detected at full resolution\033[0m')
+        else :
+            error = np.hypot(*(np.float64(face[0]) - np.float64(full_face[0])).T)
+            print(f'Pyramid landmark error: mean {error.mean():.2f} px, max {error.max():.2f} px')
+
+    landmarks_file, landmarks_image = export_landmarks(filename, image, face[0], face[1])
+    print(f'\033[0;32mLandmarks exported to {landmarks_file}\033[0m')
+    print(f'\033[0;32mImage with landmarks exported to {landmarks_image}\033[0m')
+    print('\033[0;37;42mDetected Done!\033[0m')
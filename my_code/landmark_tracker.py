@@ -0,0 +1,178 @@
+import argparse
+import os
+import time
+import numpy as np
+import cv2
+import instrumentation
+from landmark_detector import PREDICTOR_PATH, get_models, detect_clearest_face
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm', '.m4v')
+TIMELINE_SUFFIX = '_timeline.npy'
+
+# Where the landmarks of a timeline frame come from
+LOST, DETECTED, TRACKED = 0, 1, 2
+
+# One record per video frame, saved with np.save
+TIMELINE_RECORD = np.dtype([('landmarks', np.float32, (68, 2)), ('rect', np.int32, (4,)),
+                            ('source', np.uint8), ('confidence', np.float32)])
+
+# Pyramidal Lucas-Kanade parameters
+LK_WINDOW = (21, 21)
+LK_LEVELS = 3
+LK_CRITERIA = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03)
+
+def is_video(filename) :
+    return os.path.splitext(filename)[1].lower() in VIDEO_EXTENSIONS
+
+def read_video(video_path) :
+    """
+    Generator of the BGR frames of a video, decoded one at a time
+    """
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened() :
+        raise ValueError(f'cannot open video {video_path}')
+
+    try :
+        while True :
+            with instrumentation.timer('decode_frame') :
+                ok, frame = capture.read()
+            if not ok :
+                return
+            yield frame
+    finally :
+        capture.release()
+
+def video_fps(video_path) :
+    capture = cv2.VideoCapture(video_path)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    capture.release()
+    return fps or 25
+
+def track_face(prev_gray, gray, landmarks, rect, max_error=1.0) :
+    """
+    Follows a face from one frame to the next with forward-backward pyramidal Lucas-Kanade.
+    Returns (landmarks, rect, confidence), confidence being the fraction of the points that track back
+    within max_error pixels. The rect follows the similarity transform fitted on those reliable points.
+    """
+    p0 = np.float32(landmarks).reshape(-1, 1, 2)
+    p1, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, p0, None, winSize=LK_WINDOW,
+                                             maxLevel=LK_LEVELS, criteria=LK_CRITERIA)
+    back, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, prev_gray, p1, None, winSize=LK_WINDOW,
+                                                    maxLevel=LK_LEVELS, criteria=LK_CRITERIA)
+    error = np.linalg.norm((back - p0).reshape(-1, 2), axis=1)
+    good = (status.ravel() == 1) & (back_status.ravel() == 1) & (error < max_error)
+    confidence = float(good.mean())
+
+    transform = None
+    if good.sum() >= 3 :
+        transform, _ = cv2.estimateAffinePartial2D(p0[good], p1[good])
+    if transform is not None :
+        (left, top, right, bottom) = rect
+        corners = np.float64([[left, top], [right, top], [left, bottom], [right, bottom]]) @ transform[:, :2].T + transform[:, 2]
+        rect = tuple(int(round(v)) for v in (*corners.min(axis=0), *corners.max(axis=0)))
+
+    return p1.reshape(-1, 2), rect, confidence
+
+def refit_landmarks(image_gray, rect, predictor) :
+    """
+    Runs the 68-point shape predictor inside rect, without the face detector
+    """
+    import dlib
+    from imutils import face_utils
+
+    with instrumentation.timer('dlib_predict') :
+        return np.float32(face_utils.shape_to_np(predictor(image_gray, dlib.rectangle(*rect))))
+
+def track_video(frames, keyframe_interval=30, min_confidence=0.8, refit=True, predictor_path=PREDICTOR_PATH, max_side=None) :
+    """
+    Generator of (frame, record) with record a TIMELINE_RECORD for every frame of frames.
+    The full HOG detection only runs on keyframes (every keyframe_interval frames) and when fewer than
+    min_confidence of the points track reliably; the frames in between track the 68 points with optical
+    flow and, with refit, run the shape predictor again inside the tracked rect to stop drift.
+    """
+    detector, predictor = get_models(predictor_path)
+
+    last = None
+    prev_gray = None
+    since_detection = 0
+    for (index, frame) in enumerate(frames) :
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        record = np.zeros(1, dtype=TIMELINE_RECORD)[0]
+
+        face = None
+        if last is not None and since_detection < keyframe_interval :
+            with instrumentation.timer('track_face', frame=index) :
+                landmarks, rect, confidence = track_face(prev_gray, gray, *last)
+            if confidence >= min_confidence :
+                if refit :
+                    landmarks = refit_landmarks(gray, rect, predictor)
+                face = (landmarks, rect, confidence, TRACKED)
+
+        if face is None :
+            found = detect_clearest_face(gray, detector, predictor, max_side=max_side)
+            since_detection = 0
+            if found is not None :
+                face = (np.float32(found[0]), found[1], 1.0, DETECTED)
+
+        if face is None :
+            last = None
+        else :
+            record['landmarks'], record['rect'], record['confidence'], record['source'] = face
+            last = (record['landmarks'], face[1])
+            since_detection += 1
+        instrumentation.count(('frames_lost', 'frames_detected', 'frames_tracked')[record['source']])
+
+        prev_gray = gray
+        yield frame, record
+
+def landmark_timeline(video_path, keyframe_interval=30, min_confidence=0.8, refit=True, predictor_path=PREDICTOR_PATH, max_side=None) :
+    """
+    Tracks the clearest face through a whole video and returns its timeline, one TIMELINE_RECORD per frame
+    """
+    with instrumentation.timer('landmark_timeline', video=video_path) :
+        records = [record for (_, record) in track_video(read_video(video_path), keyframe_interval, min_confidence,
+                                                          refit, predictor_path, max_side)]
+
+    return np.array(records, dtype=TIMELINE_RECORD)
+
+def fill_lost(timeline) :
+    """
+    (F, 68, 2) landmarks of a timeline where lost frames hold the landmarks of the closest earlier frame
+    with a face (of the first face for the frames before it)
+    """
+    found = np.flatnonzero(timeline['source'] != LOST)
+    if not found.size :
+        raise ValueError('no face found in the whole video')
+
+    # Index of the last frame with a face at or before each frame
+    nearest = np.maximum.accumulate(np.where(timeline['source'] != LOST, np.arange(len(timeline)), -1))
+    nearest[nearest < 0] = found[0]
+
+    return timeline['landmarks'][nearest]
+
+if __name__ == '__main__' :
+    # Input arguments
+    ap = argparse.ArgumentParser(prog='landmark_tracker', description='Landmark timeline of the clearest face of a video')
+    ap.add_argument("--video", required=True, help="path to the input video")
+    ap.add_argument("--out", help=f"timeline path (default <video name>{TIMELINE_SUFFIX} next to the video)")
+    ap.add_argument("--keyframe_interval", default=30, type=int, help="frames between two full detections")
+    ap.add_argument("--min_confidence", default=0.8, type=float, help="fraction of reliably tracked points below which the face is detected again")
+    ap.add_argument("--no_refit", action="store_true", help="keep the optical flow points, without the predictor refit")
+    ap.add_argument("--max_side", type=int, help="search faces on a copy downscaled to at most this many pixels per side")
+    ap.add_argument("--trace", help=f"write a Chrome trace of this run (or set {instrumentation.TRACE_ENV})")
+    args = vars(ap.parse_args())
+    if args["trace"] :
+        instrumentation.enable(args["trace"])
+
+    start = time.perf_counter()
+    timeline = landmark_timeline(args["video"], args["keyframe_interval"], args["min_confidence"],
+                                 not args["no_refit"], max_side=args["max_side"])
+    seconds = time.perf_counter() - start
+
+    out = args["out"] or os.path.splitext(args["video"])[0] + TIMELINE_SUFFIX
+    np.save(out, timeline)
+
+    sources = np.bincount(timeline['source'], minlength=3)
+    print(f'\033[0;32m{len(timeline)} frames in {seconds:.2f} s ({len(timeline) / max(seconds, 1e-9):.1f} fps): '
+          f'{sources[DETECTED]} detected, {sources[TRACKED]} tracked, {sources[LOST]} without a face\033[0m')
+    print(f'\033[0;32mLandmark timeline exported to {out}\033[0m')
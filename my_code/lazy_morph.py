@@ -0,0 +1,142 @@
+import os
+import numpy as np
+import cv2
+from collections import OrderedDict
+import instrumentation
+from faceMorph import readPoints, addAdditionalPoints, build_delaunay, morph_frame, render_frames, SOURCE_DTYPES, TRIANGULATION_CACHE_DIR
+from landmark_cache import LandmarkCache, LANDMARK_CACHE_DIR
+
+class LazyMorph :
+    """
+    Morph between two faces that renders frames only when they are asked for.
+    morph.frame(alpha) renders any alpha [0-1], morph.at(ms) any time of a duration_ms long morph,
+    morph[i] the i-th of nframes frames (the frames of faceMorph.py and morph_pipeline.py) and iterating
+    yields them in order. The last cache_size rendered frames are kept (least recently used evicted first),
+    so scrubbing back and forth renders each frame once. Frames are read-only uint8 arrays, copy them to edit.
+    """
+    def __init__(self, img1, img2, face1_points, face2_points, delaunay_group=None, nframes=None, fps=25, duration_ms=3000,
+                 renderer='triangle', renderer_options=None, cache_size=32, tri_cache=None) :
+        if img1.shape != img2.shape :
+            raise ValueError(f'images must have the same size, got {img1.shape[1]}x{img1.shape[0]} and {img2.shape[1]}x{img2.shape[0]}')
+
+        self.img1 = SOURCE_DTYPES[renderer](img1)
+        self.img2 = SOURCE_DTYPES[renderer](img2)
+        self.face1_points = face1_points
+        self.face2_points = face2_points
+        self.delaunay_group = delaunay_group if delaunay_group is not None else build_delaunay(img1, face1_points, tri_cache)
+        self.fps = fps
+        self.duration_ms = duration_ms
+        self.nframes = nframes if nframes is not None else fps * duration_ms // 1000
+        if self.nframes <= 0 :
+            raise ValueError('frames number set to 0, fps or duration might be 0')
+        self.renderer = renderer
+        self.renderer_options = renderer_options
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) :
+        return self.nframes
+
+    def alpha(self, index) :
+        """
+        Alpha of frame index, the same values as np.linspace(0, 1, nframes)
+        """
+        if not -self.nframes <= index < self.nframes :
+            raise IndexError(f'frame {index} out of range for {self.nframes} frames')
+        return float(np.linspace(0, 1, self.nframes)[index])
+
+    def frame(self, alpha) :
+        """
+        Frame at alpha [0-1], from the cache when it was rendered recently
+        """
+        alpha = float(alpha)
+        if not 0 <= alpha <= 1 :
+            raise ValueError(f'alpha must be in [0, 1], got {alpha}')
+
+        if alpha in self.cache :
+            self.cache.move_to_end(alpha)
+            self.hits += 1
+            instrumentation.count('frame_cache_hits')
+            return self.cache[alpha]
+
+        self.misses += 1
+        frame = np.uint8(morph_frame(self.img1, self.img2, self.face1_points, self.face2_points, self.delaunay_group,
+                                     alpha, self.renderer, self.renderer_options))
+        self._keep(alpha, frame)
+        return frame
+
+    def at(self, ms) :
+        """
+        Frame at time ms of the morph, times past the ends hold the first or last face
+        """
+        return self.frame(min(max(ms / self.duration_ms, 0.0), 1.0))
+
+    def __getitem__(self, index) :
+        return self.frame(self.alpha(index))
+
+    def frames(self, start=0, stop=None, step=1, workers=1) :
+        """
+        Generator of frames start, start + step, ... up to stop (excluded). Only the frames being yielded
+        are held besides the cache; with workers > 1 the frames missing from the cache are rendered by a process pool.
+        Each such call starts its own pool and copies the sources to shared memory, which takes longer than
+        a frame or two: use workers > 1 for long ranges, and frame() or morph[i] to scrub.
+        """
+        indexes = range(*slice(start, stop, step).indices(self.nframes))
+        if workers <= 1 :
+            for index in indexes :
+                yield self[index]
+            return
+
+        alphas = [self.alpha(index) for index in indexes]
+        # The list keeps the rendering order, the set is for lookups
+        missing = [alpha for alpha in alphas if alpha not in self.cache]
+        missing_set = set(missing)
+        rendered = zip(missing, render_frames(self.img1, self.img2, self.face1_points, self.face2_points, self.delaunay_group,
+                                              missing, self.renderer, workers, self.renderer_options))
+        for alpha in alphas :
+            if alpha in missing_set :
+                # render_frames yields the missing frames in order
+                _, frame = next(rendered)
+                self.misses += 1
+                self._keep(alpha, frame)
+                yield frame
+            else :
+                yield self.frame(alpha)
+
+    def __iter__(self) :
+        return self.frames()
+
+    def _keep(self, alpha, frame) :
+        # Frames are shared with the cache, nobody may modify them in place
+        frame.flags.writeable = False
+        if self.cache_size <= 0 :
+            return
+        self.cache[alpha] = frame
+        while len(self.cache) > self.cache_size :
+            self.cache.popitem(last=False)
+
+def open_morph(filename1, filename2, fps=25, duration_ms=3000, nframes=None, align=False, renderer='triangle', renderer_options=None,
+               cache_size=32, landmarks='detect', cache_dir=LANDMARK_CACHE_DIR, tri_cache=TRIANGULATION_CACHE_DIR) :
+    """
+    LazyMorph between two image files. With landmarks='detect' the faces are detected (and optionally aligned)
+    like in morph_pipeline.py; with landmarks='txt' they are read from the <name>.txt files next to the images
+    like faceMorph.py does. Nothing is rendered until a frame is asked for.
+    """
+    if landmarks == 'detect' :
+        from morph_pipeline import analyse_face
+        cache = LandmarkCache(cache_dir) if cache_dir else None
+        (img1, points1), (img2, points2) = [analyse_face(f, align, cache=cache) for f in (filename1, filename2)]
+    elif landmarks == 'txt' :
+        img1, img2 = cv2.imread(filename1), cv2.imread(filename2)
+        if img1 is None or img2 is None :
+            raise ValueError(f'cannot read {filename1 if img1 is None else filename2}')
+        points1, points2 = [readPoints(os.path.splitext(f)[0] + '.txt') for f in (filename1, filename2)]
+    else :
+        raise ValueError(f"landmarks must be 'detect' or 'txt', got {landmarks}")
+
+    face1_points = addAdditionalPoints(points1, img1.shape)
+    face2_points = addAdditionalPoints(points2, img2.shape)
+    return LazyMorph(img1, img2, face1_points, face2_points, None, nframes, fps, duration_ms, renderer, renderer_options,
+                     cache_size, tri_cache)
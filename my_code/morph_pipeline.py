@@ -0,0 +1,240 @@
+import argparse
+import os
+import time
+import numpy as np
+import cv2
+import instrumentation
+from faceMorph import addAdditionalPoints, build_delaunay, preview_inputs, morph_frame, render_frames, RENDERERS, SOURCE_DTYPES, TRIANGULATION_CACHE_DIR
+from frame_writer import open_writer, AsyncWriter, FFmpegWriter, OUTPUTS
+from landmark_cache import LandmarkCache, LANDMARK_CACHE_DIR
+from landmark_detector import detect_landmarks, export_landmarks
+from landmark_tracker import is_video, read_video, video_fps, landmark_timeline, fill_lost
+
+def analyse_face(filename, align=False, output_size=1024, cache=None) :
+    """
+    Detects the clearest face of an image and optionally aligns it, all in memory.
+    Returns (image, landmarks) with the 68 landmarks as integer (x, y) tuples in image coordinates.
+    Aligned landmarks are the detected ones mapped through the alignment transform, no second detection is needed.
+    """
+    image, face = detect_landmarks(filename, cache)
+    if face is None :
+        raise ValueError(f'no faces have been detected in {filename}')
+    landmarks = np.float64(face[0])
+
+    if align :
+        # scipy and PIL are only needed here
+        from align_images import align_array
+        with instrumentation.timer('image_align', image=filename, output_size=output_size, single_warp=True) :
+            image, to_source = align_array(image, landmarks, output_size)
+        to_aligned = cv2.invertAffineTransform(to_source)
+        landmarks = landmarks @ to_aligned[:, :2].T + to_aligned[:, 2]
+        landmarks = np.clip(landmarks, 0, [image.shape[1] - 1, image.shape[0] - 1])
+
+    return image, [(int(x), int(y)) for (x, y) in np.rint(landmarks)]
+
+def write_diagnostics(out_dir, name, image, landmarks) :
+    """
+    The Delaunay/Voronoi renders of draw_delaunay.py and the landmarks overlay of landmark_detector.py
+    """
+    import draw_delaunay
+
+    subdiv = cv2.Subdiv2D((0, 0, image.shape[1], image.shape[0]))
+    for point in landmarks :
+        subdiv.insert(point)
+
+    img_delaunay = image.copy()
+    draw_delaunay.draw_delaunay(img_delaunay, subdiv, (255, 255, 255))
+    for point in landmarks :
+        draw_delaunay.draw_point(img_delaunay, point, (0, 0, 255))
+    img_voronoi = np.zeros(image.shape, dtype=image.dtype)
+    draw_delaunay.draw_voronoi(img_voronoi, subdiv)
+
+    cv2.imwrite(os.path.join(out_dir, name + '-delaunay.jpg'), img_delaunay)
+    cv2.imwrite(os.path.join(out_dir, name + '-voronoi.jpg'), img_voronoi)
+    # The landmarks' box, in (left, top, right, bottom) like the detection rects: it also fits aligned images
+    x, y, w, h = cv2.boundingRect(np.int32(landmarks))
+    export_landmarks(os.path.join(out_dir, name + '.png'), image, landmarks, (x, y, x + w, y + h))
+
+def morph_images(filename1, filename2, fps, duration_ms, align=False, output='ffmpeg', video=None,
+                 renderer='triangle', workers=1, bitrate='10M', pix_fmt='yuv420p', diagnostics=False,
+                 output_size=1024, cache_dir=LANDMARK_CACHE_DIR, tri_cache=TRIANGULATION_CACHE_DIR,
+                 compression=None, encoder_threads=2, pingpong=False, repeat=1, renderer_options=None, preview=None) :
+    """
+    Whole morph job in one process: detect -> align -> triangulate -> render -> encode.
+    Images and landmarks stay in memory between stages. Returns the video or .npy path, or the
+    frames directory for output='png' or 'jpg' (frames named morph-<name1>-<name2>-NNNN.png).
+    """
+    return morph_sequence([filename1, filename2], fps, duration_ms, align, output, video, renderer, workers,
+                          bitrate, pix_fmt, diagnostics, output_size, cache_dir, tri_cache,
+                          compression, encoder_threads, pingpong, repeat, renderer_options, preview)
+
+def morph_sequence(filenames, fps, duration_ms, align=False, output='ffmpeg', video=None,
+                   renderer='triangle', workers=1, bitrate='10M', pix_fmt='yuv420p', diagnostics=False,
+                   output_size=1024, cache_dir=LANDMARK_CACHE_DIR, tri_cache=TRIANGULATION_CACHE_DIR,
+                   compression=None, encoder_threads=2, pingpong=False, repeat=1, renderer_options=None, preview=None) :
+    """
+    Chain morph A -> B -> C -> ... rendered into one continuous frame stream, duration_ms per segment.
+    Every face is analysed and triangulated once and shared by the two segments around it,
+    only two decoded faces are held at any time. The first frame of each segment after the first
+    is the last frame of the previous one, so it is not repeated. With pingpong the chain plays back
+    to the first face and with repeat it is output several times, from the frames already rendered.
+    With preview, frames are rendered at most preview pixels per side (preview-* frames or a *-preview video) from the
+    full-resolution triangulations, so they line up with the full-resolution render.
+    """
+    nframes = fps * duration_ms // 1000
+    if nframes <= 0 :
+        raise ValueError('frames number set to 0, fps or duration might be 0')
+    if len(filenames) < 2 :
+        raise ValueError('at least two images are needed')
+
+    out_dir = os.path.dirname(filenames[0])
+    names = [os.path.splitext(os.path.basename(f))[0] for f in filenames]
+    if align :
+        names = ['aligned-' + name for name in names]
+    output_name = '-'.join(names) + ('-preview' if preview else '')
+    # Frame names of faceMorph.py, preview frames are preview-<names>-NNNN
+    prefix = 'preview-' + '-'.join(names) if preview else 'morph-' + output_name
+
+    if output in ('ffmpeg', 'npy') :
+        export_path = video or os.path.join(out_dir, output_name + ('.mp4' if output == 'ffmpeg' else '.npy'))
+    else :
+        export_path = out_dir
+    rendered = nframes + (len(filenames) - 2) * (nframes - 1)
+    writer = open_writer(output, export_path, prefix, rendered, fps, bitrate, pix_fmt,
+                         compression, encoder_threads, pingpong, repeat)
+
+    cache = LandmarkCache(cache_dir) if cache_dir else None
+
+    def analyse(i) :
+        image, landmarks = analyse_face(filenames[i], align, output_size, cache)
+        if diagnostics :
+            if align :
+                cv2.imwrite(os.path.join(out_dir, names[i] + '.png'), image)
+            write_diagnostics(out_dir, names[i], image, landmarks)
+
+        image = SOURCE_DTYPES[renderer](image)
+        points = addAdditionalPoints(landmarks, image.shape)
+        # The last face never starts a segment
+        delaunay_group = build_delaunay(image, points, tri_cache) if i < len(filenames) - 1 else None
+        if preview :
+            image, points = preview_inputs(image, points, preview)
+        return image, points, delaunay_group
+
+    alphas = np.linspace(0, 1, nframes)
+    with writer :
+        img1, face1_points, delaunay_group = analyse(0)
+        for i in range(1, len(filenames)) :
+            img2, face2_points, next_delaunay_group = analyse(i)
+            if img1.shape != img2.shape :
+                raise ValueError(f'images must have the same size, got {img1.shape[1]}x{img1.shape[0]} '
+                                 f'for {filenames[i - 1]} and {img2.shape[1]}x{img2.shape[0]} for {filenames[i]}')
+
+            segment_alphas = alphas if i == 1 else alphas[1:]
+            with instrumentation.timer('segment', index=i - 1, frames=len(segment_alphas)) :
+                for frame in render_frames(img1, img2, face1_points, face2_points, delaunay_group, 
+                                           segment_alphas, renderer, workers, renderer_options) :
+                    writer.write(frame)
+
+            # Face i starts the next segment, its analysis and triangulation are reused
+            img1, face1_points, delaunay_group = img2, face2_points, next_delaunay_group
+
+    return export_path
+
+def morph_videos(video1, video2, renderer='triangle', video=None, bitrate='10M', pix_fmt='yuv420p',
+                 keyframe_interval=30, min_confidence=0.8, refit=True, timeline1=None, timeline2=None, renderer_options=None) :
+    """
+    Morphs a video clip into another while both play: frame i blends frame i of each clip at alpha i / (n - 1)
+    over their n common frames, at the frame-rate of video1. The landmarks come from the tracking timelines
+    (computed here unless given), the mesh is triangulated once on the first frame of video1 and reused
+    since the landmark order never changes. Frames with no face hold the closest earlier landmarks.
+    """
+    if timeline1 is None :
+        timeline1 = landmark_timeline(video1, keyframe_interval, min_confidence, refit)
+    if timeline2 is None :
+        timeline2 = landmark_timeline(video2, keyframe_interval, min_confidence, refit)
+    landmarks1, landmarks2 = fill_lost(timeline1), fill_lost(timeline2)
+    nframes = min(len(landmarks1), len(landmarks2))
+
+    names = [os.path.splitext(os.path.basename(f))[0] for f in (video1, video2)]
+    export_path = video or os.path.join(os.path.dirname(video1), '-'.join(names) + '.mp4')
+
+    alphas = np.linspace(0, 1, nframes)
+    delaunay_group = None
+    with AsyncWriter(FFmpegWriter(export_path, video_fps(video1), bitrate, pix_fmt)) as writer :
+        for (i, (frame1, frame2)) in enumerate(zip(read_video(video1), read_video(video2))) :
+            if i >= nframes :
+                break
+            if frame1.shape != frame2.shape :
+                raise ValueError(f'videos must have the same size, got {frame1.shape[1]}x{frame1.shape[0]} '
+                                 f'for {video1} and {frame2.shape[1]}x{frame2.shape[0]} for {video2}')
+
+            face1_points = addAdditionalPoints([tuple(p) for p in np.float64(landmarks1[i])], frame1.shape)
+            face2_points = addAdditionalPoints([tuple(p) for p in np.float64(landmarks2[i])], frame2.shape)
+            if delaunay_group is None :
+                delaunay_group = build_delaunay(frame1, [(int(x), int(y)) for (x, y) in np.rint(face1_points)])
+
+            img1, img2 = SOURCE_DTYPES[renderer](frame1), SOURCE_DTYPES[renderer](frame2)
+            writer.write(np.uint8(morph_frame(img1, img2, face1_points, face2_points, delaunay_group, float(alphas[i]), 
+                                         renderer, renderer_options)))
+
+    return export_path
+
+if __name__ == '__main__' :
+    # Input arguments
+    ap = argparse.ArgumentParser(prog='morph_pipeline', description='Face morphing between two or more images in a single process')
+    ap.add_argument("images", nargs="+", help="paths to the input images, more than two morphs them in a chain, or two videos")
+    ap.add_argument("fps", type=int, help="frame-rate in fps (video input: ignored, the clip frame-rate is kept)")
+    ap.add_argument("duration", type=int, help="morphing duration in miliseconds, per pair of images (video input: ignored, the morph lasts the shorter clip)")
+    ap.add_argument("--align", action="store_true", help="align and crop the faces before morphing")
+    ap.add_argument("--output_size", default=1024, type=int, help="size of the aligned images")
+    ap.add_argument("--output", default="ffmpeg", choices=OUTPUTS, 
+                    help="pipe frames into ffmpeg, write a PNG or JPEG sequence or a memory-mapped .npy frame stack")
+    ap.add_argument("--video", help="output video or .npy path (default <dir1>/<name1>-<name2>[-...].mp4 or .npy)")
+    ap.add_argument("--compression", type=int, help="PNG compression level [0-9] or JPEG quality [0-100]")
+    ap.add_argument("--encoder_threads", default=2, type=int, help="threads compressing PNG or JPEG frames")
+    ap.add_argument("--pingpong", action="store_true", help="morph back to the first image, reusing the rendered frames")
+    ap.add_argument("--repeat", default=1, type=int, help="number of times the morph (or ping-pong cycle) is output")
+    ap.add_argument("--bitrate", default="10M", help="video bitrate")
+    ap.add_argument("--pix_fmt", default="yuv420p", help="video pixel format")
+    ap.add_argument("--renderer", default="triangle", choices=sorted(RENDERERS), help="frame renderer")
+    ap.add_argument("--workers", default=1, type=int, help="number of rendering processes")
+    ap.add_argument("--preview", type=int, metavar="SIZE", help="quick preview with frames of at most SIZE pixels per side")
+    ap.add_argument("--tile_size", type=int, help="tile size in pixels of the tiled renderer")
+    ap.add_argument("--lod_tile", type=int, help="triangle renderer: process the background triangles in tiles of this size")
+    ap.add_argument("--diagnostics", action="store_true", help="also write landmarks, Delaunay and Voronoi images")
+    ap.add_argument("--cache_dir", default=LANDMARK_CACHE_DIR, help="directory of the landmark cache, empty string disables it")
+    ap.add_argument("--tri_cache", default=TRIANGULATION_CACHE_DIR, help="directory of the triangulation cache, empty string disables it")
+    ap.add_argument("--keyframe_interval", default=30, type=int, help="video input: frames between two full face detections")
+    ap.add_argument("--min_confidence", default=0.8, type=float, help="video input: tracking confidence below which the face is detected again")
+    ap.add_argument("--no_refit", action="store_true", help="video input: keep the optical flow landmarks, without the predictor refit")
+    ap.add_argument("--trace", help=f"write a Chrome trace of this run (or set {instrumentation.TRACE_ENV})")
+    args = vars(ap.parse_args())
+    if args["trace"] :
+        instrumentation.enable(args["trace"])
+
+    renderer_options = {}
+    if args["renderer"] == "tiled" and args["tile_size"] :
+        renderer_options['tile_size'] = args["tile_size"]
+    if args["renderer"] == "triangle" and args["lod_tile"] :
+        renderer_options['lod_tile'] = args["lod_tile"]
+
+    start = time.perf_counter()
+    try :
+        if any(is_video(f) for f in args["images"]) :
+            if len(args["images"]) != 2 or not all(is_video(f) for f in args["images"]) :
+                raise ValueError('videos can only be morphed two at a time, into another video')
+            export_path = morph_videos(*args["images"], args["renderer"], args["video"], args["bitrate"], args["pix_fmt"],
+                                       args["keyframe_interval"], args["min_confidence"], not args["no_refit"],
+                                       renderer_options=renderer_options)
+        else :
+            export_path = morph_sequence(args["images"], args["fps"], args["duration"], args["align"],
+                                         args["output"], args["video"], args["renderer"], args["workers"], args["bitrate"],
+                                         args["pix_fmt"], args["diagnostics"], args["output_size"], args["cache_dir"], args["tri_cache"],
+                                         args["compression"], args["encoder_threads"], args["pingpong"], args["repeat"], renderer_options,
+                                         args["preview"])
+    except ValueError as e :
+        print(f'\033[1;41mERROR! {e}\033[0m')
+        exit(1)
+
+    print(f'\033[0;32mMorphing results exported in {export_path} ({time.perf_counter() - start:.2f} s)\033[0m')
+    print('\033[0;42mFace morphing Done!\033[0m')
@@ -0,0 +1,150 @@
+import numpy as np
+import instrumentation
+
+# Bumped whenever the saved arrays change meaning
+PLAN_VERSION = 1
+
+def bounding_rects(triangles) :
+    """
+    cv2.boundingRect of every float32 triangle of a (..., 3, 2) array, as (..., 4) int32 (x, y, w, h)
+    """
+    triangles = np.float32(triangles)
+    low = np.floor(triangles.min(axis=-2))
+    high = np.floor(triangles.max(axis=-2))
+    return np.int32(np.concatenate([low, high - low + 1], axis=-1))
+
+def affine_transforms(src, dst) :
+    """
+    cv2.getAffineTransform for every pair of (..., 3, 2) triangles (broadcast together), as (..., 2, 3) float64.
+    Same 6x6 system and same LU elimination order as OpenCV, batched over the triangles, so the
+    matrices are bit-identical and the warps give the same pixels. Flat triangles get a zero matrix like in OpenCV.
+    """
+    src, dst = np.broadcast_arrays(np.float64(np.float32(src)), np.float64(np.float32(dst)))
+    shape = src.shape[:-2]
+    src, dst = src.reshape(-1, 3, 2), dst.reshape(-1, 3, 2)
+    rows = np.arange(len(src))
+
+    # Rows 2i and 2i + 1 are the x and y equations of vertex i
+    A = np.zeros((len(src), 6, 6))
+    A[:, 0::2, 0:2] = src
+    A[:, 0::2, 2] = 1
+    A[:, 1::2, 3:5] = src
+    A[:, 1::2, 5] = 1
+    b = np.zeros((len(src), 6))
+    b[:, 0::2] = dst[:, :, 0]
+    b[:, 1::2] = dst[:, :, 1]
+
+    singular = np.zeros(len(src), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore') :
+        for i in range(6) :
+            # Partial pivoting, the first of the largest pivots wins
+            k = i + np.argmax(np.abs(A[:, i:, i]), axis=1)
+            singular |= np.abs(A[rows, k, i]) < np.finfo(np.float64).eps * 10
+            A[rows, i], A[rows, k] = A[rows, k].copy(), A[rows, i].copy()
+            b[rows, i], b[rows, k] = b[rows, k].copy(), b[rows, i].copy()
+
+            d = -1 / A[:, i, i]
+            for j in range(i + 1, 6) :
+                alpha = A[:, j, i] * d
+                for c in range(i + 1, 6) :
+                    A[:, j, c] += alpha * A[:, i, c]
+                b[:, j] += alpha * b[:, i]
+
+        x = np.zeros((len(src), 6))
+        for i in range(5, -1, -1) :
+            s = b[:, i].copy()
+            for c in range(i + 1, 6) :
+                s -= A[:, i, c] * x[:, c]
+            x[:, i] = s / A[:, i, i]
+
+    x[singular] = 0
+    return x.reshape(shape + (2, 3))
+
+class MorphPlan :
+    """
+    Geometry of morphTriangle for every triangle of every planned frame, computed with batched NumPy
+    instead of per-triangle cv2 calls:
+    rects1, rects2 (T, 4) source bounding rects, the same for every frame,
+    rects (F, T, 4) morphed bounding rects, polygons (F, T, 3, 2) int32 morphed triangles offset into their
+    rect (the mask polygon), affines1, affines2 (F, T, 2, 3) source rect -> morphed rect transforms.
+    It only depends on the landmarks, the triangulation and the alphas, and saves to a compressed .npz.
+    """
+    def __init__(self, face1_points, face2_points, delaunay_group, alphas, rects1, rects2, rects, polygons, affines1, affines2) :
+        self.face1_points = face1_points
+        self.face2_points = face2_points
+        self.delaunay_group = delaunay_group
+        self.alphas = np.float64(alphas)
+        self.rects1, self.rects2 = rects1, rects2
+        self.rects, self.polygons = rects, polygons
+        self.affines1, self.affines2 = affines1, affines2
+        self.index = {float(alpha) : i for (i, alpha) in enumerate(self.alphas)}
+
+    @classmethod
+    def build(cls, face1_points, face2_points, delaunay_group, alphas) :
+        """
+        Plans the frames at alphas [0-1] in one batch: (F, T) rects, polygons and affines
+        """
+        with instrumentation.timer('build_plan', frames=len(alphas), triangles=len(delaunay_group)) :
+            triangles = np.asarray(delaunay_group, dtype=np.int64)
+            points1, points2 = np.float64(face1_points), np.float64(face2_points)
+            triangles1, triangles2 = points1[triangles], points2[triangles]  # (T, 3, 2)
+            rects1, rects2 = bounding_rects(triangles1), bounding_rects(triangles2)
+            offset1 = triangles1 - rects1[:, None, :2]
+            offset2 = triangles2 - rects2[:, None, :2]
+
+            # Same float64 operations as morphFrameTriangles' weighted average
+            alphas = np.float64(alphas)[:, None, None, None]
+            morphed = (1 - alphas) * triangles1 + alphas * triangles2  # (F, T, 3, 2)
+            rects = bounding_rects(morphed)
+            offset = morphed - rects[..., None, :2]
+
+            plan = cls(face1_points, face2_points, delaunay_group, alphas.ravel(), rects1, rects2, rects,
+                       offset.astype(np.int32), affine_transforms(offset1, offset), affine_transforms(offset2, offset))
+        return plan
+
+    def __len__(self) :
+        return len(self.alphas)
+
+    def __contains__(self, alpha) :
+        return float(alpha) in self.index
+
+    def frame(self, alpha) :
+        """
+        (rects, polygons, affines1, affines2) of the planned frame at alpha
+        """
+        i = self.index[float(alpha)]
+        return self.rects[i], self.polygons[i], self.affines1[i], self.affines2[i]
+
+    def for_alphas(self, alphas) :
+        """
+        Plan of other alphas (another frame-rate or duration): frames planned already are reused
+        and the others are planned in one batch
+        """
+        alphas = np.float64(alphas)
+        missing = [float(alpha) for alpha in alphas if float(alpha) not in self.index]
+        extra = MorphPlan.build(self.face1_points, self.face2_points, self.delaunay_group, missing) if missing else None
+
+        sources = [(self, self.index[float(alpha)]) if float(alpha) in self.index else (extra, extra.index[float(alpha)])
+                   for alpha in alphas]
+        def gather(name) :
+            return np.stack([getattr(plan, name)[i] for (plan, i) in sources]) if sources else getattr(self, name)[:0]
+        return MorphPlan(self.face1_points, self.face2_points, self.delaunay_group, alphas, self.rects1, self.rects2,
+                         gather('rects'), gather('polygons'), gather('affines1'), gather('affines2'))
+
+    def save(self, path) :
+        # Through a file object, np.savez would add .npz to any other extension
+        with open(path, 'wb') as file :
+            np.savez_compressed(file, version=PLAN_VERSION, face1_points=np.float64(self.face1_points),
+                                face2_points=np.float64(self.face2_points), delaunay_group=np.int32(self.delaunay_group),
+                                alphas=self.alphas, rects1=self.rects1, rects2=self.rects2, rects=self.rects,
+                                polygons=self.polygons, affines1=self.affines1, affines2=self.affines2)
+
+    @classmethod
+    def load(cls, path) :
+        with np.load(path) as data :
+            if int(data['version']) != PLAN_VERSION :
+                raise ValueError(f'{path} is a version {int(data["version"])} morph plan, expected version {PLAN_VERSION}')
+            # Points as tuples and the triangulation as lists, like readPoints and build_delaunay return them
+            return cls([tuple(p) for p in data['face1_points'].tolist()], [tuple(p) for p in data['face2_points'].tolist()],
+                       data['delaunay_group'].tolist(), data['alphas'], data['rects1'], data['rects2'], data['rects'],
+                       data['polygons'], data['affines1'], data['affines2'])
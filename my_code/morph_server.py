@@ -0,0 +1,450 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+import numpy as np
+import cv2
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from urllib.parse import urlsplit, parse_qsl
+from batch_morph import parse_bool
+from faceMorph import addAdditionalPoints, build_delaunay, morph_frame, RENDERERS, SOURCE_DTYPES, TRIANGULATION_CACHE_DIR
+from frame_writer import ffmpeg_command, IMAGE_PARAMS
+from landmark_cache import LandmarkCache, LANDMARK_CACHE_DIR
+from landmark_detector import get_models
+from morph_pipeline import analyse_face
+
+# Response formats: multipart image streams or a fragmented MP4 stream
+FORMATS = ('png', 'jpg', 'mp4')
+BOUNDARY = 'frame'
+STATUS = {200 : 'OK', 400 : 'Bad Request', 404 : 'Not Found', 405 : 'Method Not Allowed', 500 : 'Internal Server Error'}
+# Latency samples kept per metric
+METRIC_SAMPLES = 1000
+
+class Metrics :
+    """
+    Request counters, latency samples (the last METRIC_SAMPLES of each) and queue depths of the service
+    """
+    def __init__(self) :
+        self.counters = defaultdict(int)
+        self.latencies = defaultdict(lambda : deque(maxlen=METRIC_SAMPLES))
+        self.depths = defaultdict(int)
+
+    def observe(self, name, seconds) :
+        self.latencies[name].append(seconds)
+
+    def snapshot(self) :
+        latencies = {}
+        for (name, samples) in self.latencies.items() :
+            values = np.float64(samples)
+            latencies[name] = {'count' : len(values), 'mean' : round(values.mean(), 6), 'p50' : round(np.percentile(values, 50), 6),
+                               'p95' : round(np.percentile(values, 95), 6), 'max' : round(values.max(), 6)}
+        return {'counters' : dict(self.counters), 'queue_depth' : dict(self.depths), 'latency_s' : latencies}
+
+# Per-process state of the rendering workers: shared source images attached so far, by shared memory name
+_attached = OrderedDict()
+# Shared images a worker keeps attached, the images of about 4 requests
+MAX_ATTACHED = 8
+
+def _attach(name, shape, dtype) :
+    if name not in _attached :
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+        while len(_attached) > MAX_ATTACHED :
+            _, (old, _) = _attached.popitem(last=False)
+            old.close()
+    _attached.move_to_end(name)
+    return _attached[name][1]
+
+def _render_frame(job, alpha) :
+    """
+    Worker task: renders one frame of a job whose sources are in shared memory. Returns the frame
+    encoded in the job's image format, or as raw uint8 BGR for video.
+    """
+    img1, img2 = (_attach(*image) for image in job['images'])
+    frame = np.uint8(morph_frame(img1, img2, job['face1_points'], job['face2_points'], job['delaunay_group'],
+                                 alpha, job['renderer']))
+    if job['format'] == 'mp4' :
+        return frame
+    params = [] if job['compression'] is None else [IMAGE_PARAMS[job['format']], job['compression']]
+    ok, encoded = cv2.imencode('.' + job['format'], frame, params)
+    if not ok :
+        raise RuntimeError(f'cannot encode frame at alpha {alpha}')
+    return encoded.tobytes()
+
+class RequestError(Exception) :
+    def __init__(self, status, message) :
+        super().__init__(message)
+        self.status = status
+
+class MorphService :
+    """
+    Long-running morph service. The dlib models, the landmark cache and the recently analysed images stay
+    in memory. Concurrent detection requests are grouped into batches run by a single detection thread,
+    and frames are rendered by a process pool that reads the sources from shared memory.
+    """
+    def __init__(self, workers=1, cache_dir=LANDMARK_CACHE_DIR, tri_cache=TRIANGULATION_CACHE_DIR, batch_window=0.01,
+                 max_batch=16, max_frames=1000, analysed_cache=32) :
+        self.workers = workers
+        self.cache = LandmarkCache(cache_dir) if cache_dir else None
+        self.tri_cache = tri_cache
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_frames = max_frames
+        self.analysed_cache = analysed_cache
+        self.analysed = OrderedDict()
+        self.metrics = Metrics()
+        # dlib is used by one thread only
+        self.detect_executor = ThreadPoolExecutor(max_workers=1)
+        self.render_pool = ProcessPoolExecutor(max_workers=workers)
+        self.detect_queue = None
+
+    async def start(self) :
+        """
+        Loads the models and starts the render workers before the first request
+        """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        await loop.run_in_executor(self.detect_executor, get_models)
+        await asyncio.gather(*[loop.run_in_executor(self.render_pool, int) for _ in range(self.workers)])
+        self.metrics.observe('startup', time.perf_counter() - start)
+        self.detect_queue = asyncio.Queue()
+        self.batcher = asyncio.create_task(self.batch_detections())
+
+    def close(self) :
+        self.batcher.cancel()
+        self.render_pool.shutdown(cancel_futures=True)
+        self.detect_executor.shutdown()
+
+    # Detection
+
+    def analyse(self, filename, align) :
+        """
+        analyse_face with an in-memory LRU of the last analysed_cache images, keyed by path, modification time and align
+        """
+        key = (os.path.abspath(filename), os.path.getmtime(filename), align)
+        if key in self.analysed :
+            self.analysed.move_to_end(key)
+            self.metrics.counters['analysed_hits'] += 1
+        else :
+            self.analysed[key] = analyse_face(filename, align, cache=self.cache)
+            while len(self.analysed) > self.analysed_cache :
+                self.analysed.popitem(last=False)
+        return self.analysed[key]
+
+    def analyse_batch(self, keys) :
+        """
+        Runs in the detection thread: every distinct (filename, align) of a batch is analysed once
+        """
+        results = {}
+        for key in keys :
+            try :
+                results[key] = self.analyse(*key)
+            except Exception as e :
+                results[key] = e
+        return results
+
+    async def batch_detections(self) :
+        """
+        Groups the detection requests that arrive within batch_window of each other, up to max_batch of them
+        """
+        loop = asyncio.get_running_loop()
+        while True :
+            batch = [await self.detect_queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch :
+                try :
+                    batch.append(await asyncio.wait_for(self.detect_queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError :
+                    break
+            self.metrics.depths['detection'] = self.detect_queue.qsize()
+
+            keys = list(dict.fromkeys(key for (key, _) in batch))
+            self.metrics.counters['detection_batches'] += 1
+            self.metrics.counters['detections_batched'] += len(batch)
+            try :
+                results = await loop.run_in_executor(self.detect_executor, self.analyse_batch, keys)
+            except Exception as e :
+                results = {key : e for key in keys}
+            for (key, future) in batch :
+                if not future.done() :
+                    future.set_result(results[key])
+
+    async def detect(self, filename, align) :
+        future = asyncio.get_running_loop().create_future()
+        await self.detect_queue.put(((filename, align), future))
+        self.metrics.depths['detection'] = self.detect_queue.qsize()
+        result = await future
+        if isinstance(result, FileNotFoundError) :
+            raise RequestError(404, str(result))
+        if isinstance(result, Exception) :
+            raise RequestError(400, f'{type(result).__name__}: {result}')
+        return result
+
+    # Rendering
+
+    def parse_job(self, params) :
+        """
+        Morph parameters of a request: image1, image2 (paths on this machine), nframes or fps and duration,
+        align, renderer, format and compression
+        """
+        try :
+            job = {'image1' : params['image1'], 'image2' : params['image2'],
+                   'fps' : int(params.get('fps', 25)), 'align' : parse_bool(params.get('align', False)),
+                   'renderer' : params.get('renderer', 'triangle'), 'format' : params.get('format', 'jpg'),
+                   'compression' : None if params.get('compression') is None else int(params['compression'])}
+            job['nframes'] = int(params['nframes']) if 'nframes' in params else job['fps'] * int(params.get('duration', 3000)) // 1000
+        except KeyError as e :
+            raise RequestError(400, f'missing parameter {e}')
+        except ValueError as e :
+            raise RequestError(400, str(e))
+        if job['renderer'] not in RENDERERS :
+            raise RequestError(400, f'unknown renderer {job["renderer"]}, expected one of {sorted(RENDERERS)}')
+        if job['format'] not in FORMATS :
+            raise RequestError(400, f'unknown format {job["format"]}, expected one of {list(FORMATS)}')
+        if not 0 < job['nframes'] <= self.max_frames :
+            raise RequestError(400, f'the number of frames must be in [1, {self.max_frames}], got {job["nframes"]}')
+        return job
+
+    async def prepare(self, job) :
+        """
+        Landmarks of both images (batched with the other requests) and the morph mesh
+        """
+        start = time.perf_counter()
+        (image1, landmarks1), (image2, landmarks2) = await asyncio.gather(self.detect(job['image1'], job['align']),
+                                                                          self.detect(job['image2'], job['align']))
+        self.metrics.observe('detect', time.perf_counter() - start)
+        if image1.shape != image2.shape :
+            raise RequestError(400, f'images must have the same size, got {image1.shape[1]}x{image1.shape[0]} '
+                                    f'and {image2.shape[1]}x{image2.shape[0]}')
+
+        # addAdditionalPoints appends in place, the analysed landmarks are shared by later requests
+        face1_points = addAdditionalPoints(list(landmarks1), image1.shape)
+        face2_points = addAdditionalPoints(list(landmarks2), image2.shape)
+        delaunay_group = await asyncio.get_running_loop().run_in_executor(None, build_delaunay, image1, face1_points, self.tri_cache)
+        return (image1, image2), {'face1_points' : face1_points, 'face2_points' : face2_points, 'delaunay_group' : delaunay_group,
+                                  'renderer' : job['renderer'], 'format' : job['format'], 'compression' : job['compression']}
+
+    async def render(self, images, task, nframes) :
+        """
+        Async generator of the rendered frames in order. The sources go to shared memory once per request,
+        and at most 2 * workers frames of the request are in flight.
+        """
+        loop = asyncio.get_running_loop()
+        shared = []
+        pending = deque()
+
+        def frame_done(_) :
+            self.metrics.depths['render'] -= 1
+
+        try :
+            for image in images :
+                image = SOURCE_DTYPES[task['renderer']](image)
+                shm = shared_memory.SharedMemory(create=True, size=image.nbytes)
+                np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)[:] = image
+                shared.append(shm)
+                task.setdefault('images', []).append((shm.name, image.shape, image.dtype.str))
+
+            for alpha in np.linspace(0, 1, nframes) :
+                future = loop.run_in_executor(self.render_pool, _render_frame, task, float(alpha))
+                self.metrics.depths['render'] += 1
+                future.add_done_callback(frame_done)
+                pending.append((time.perf_counter(), future))
+                if len(pending) >= 2 * self.workers :
+                    yield await self.collect(*pending.popleft())
+            while pending :
+                yield await self.collect(*pending.popleft())
+        finally :
+            # A client that went away must not leave frames rendering for nobody
+            for (_, future) in pending :
+                future.cancel()
+            await asyncio.gather(*[future for (_, future) in pending], return_exceptions=True)
+            for shm in shared :
+                shm.close()
+                shm.unlink()
+
+    async def collect(self, submitted, future) :
+        frame = await future
+        self.metrics.observe('frame', time.perf_counter() - submitted)
+        self.metrics.counters['frames_rendered'] += 1
+        return frame
+
+    # HTTP
+
+    async def handle(self, reader, writer) :
+        """
+        One HTTP/1.1 request per connection: GET /health, GET /metrics, GET or POST /morph
+        (parameters in the query string and/or a JSON body)
+        """
+        start = time.perf_counter()
+        route = None
+        try :
+            request_line = (await reader.readline()).decode('latin-1').split()
+            if len(request_line) != 3 :
+                return
+            method, target, _ = request_line
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b'') :
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            length = headers.get('content-length', '0')
+            if not length.isdigit() :
+                raise RequestError(400, f'invalid Content-Length {length}')
+            body = await reader.readexactly(int(length))
+
+            url = urlsplit(target)
+            route = url.path
+            self.metrics.counters['requests'] += 1
+            if route == '/health' :
+                await self.send_json(writer, 200, {'status' : 'ok'})
+            elif route == '/metrics' :
+                await self.send_json(writer, 200, self.metrics.snapshot())
+            elif route == '/morph' :
+                if method not in ('GET', 'POST') :
+                    raise RequestError(405, f'{method} /morph is not supported')
+                params = dict(parse_qsl(url.query))
+                if body :
+                    data = json.loads(body)
+                    if not isinstance(data, dict) :
+                        raise RequestError(400, f'the JSON body must be an object, got {type(data).__name__}')
+                    params.update(data)
+                await self.morph(writer, self.parse_job(params), start)
+            else :
+                raise RequestError(404, f'no route {route}')
+        except RequestError as e :
+            self.metrics.counters['errors'] += 1
+            await self.send_json(writer, e.status, {'error' : str(e)})
+        except json.JSONDecodeError as e :
+            self.metrics.counters['errors'] += 1
+            await self.send_json(writer, 400, {'error' : f'invalid JSON body: {e}'})
+        except (ConnectionError, asyncio.IncompleteReadError) :
+            self.metrics.counters['disconnects'] += 1
+        except Exception as e :
+            self.metrics.counters['errors'] += 1
+            print(f'\033[0;31m{route}: {type(e).__name__}: {e}\033[0m')
+            if not writer.is_closing() :
+                await self.send_json(writer, 500, {'error' : f'{type(e).__name__}: {e}'})
+        finally :
+            if route is not None :
+                self.metrics.observe(f'request {route}', time.perf_counter() - start)
+            writer.close()
+
+    async def send_json(self, writer, status, data) :
+        try :
+            body = json.dumps(data).encode()
+            writer.write(f'HTTP/1.1 {status} {STATUS[status]}\r\nContent-Type: application/json\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except ConnectionError :
+            pass
+
+    async def send_chunk(self, writer, data) :
+        writer.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        await writer.drain()
+
+    async def morph(self, writer, job, start) :
+        """
+        Streams the morph as each frame is rendered: a multipart/x-mixed-replace stream of PNG or JPEG
+        frames, or a fragmented MP4 produced by ffmpeg, both sent with chunked transfer encoding
+        """
+        images, task = await self.prepare(job)
+        content_type = 'video/mp4' if job['format'] == 'mp4' else f'multipart/x-mixed-replace; boundary={BOUNDARY}'
+        writer.write(f'HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\nTransfer-Encoding: chunked\r\n'
+                     f'X-Frames: {job["nframes"]}\r\nConnection: close\r\n\r\n'.encode())
+
+        frames = self.render(images, task, job['nframes'])
+        try :
+            if job['format'] == 'mp4' :
+                await self.stream_video(writer, frames, job, start)
+            else :
+                await self.stream_images(writer, frames, job, start)
+        except ConnectionError :
+            raise
+        except Exception as e :
+            # The status line is already sent, the client only sees the stream end without its last chunk
+            self.metrics.counters['errors'] += 1
+            print(f'\033[0;31m/morph: {type(e).__name__}: {e}\033[0m')
+            return
+        finally :
+            await frames.aclose()
+        await self.send_chunk(writer, b'')
+        self.metrics.counters['morphs'] += 1
+
+    async def stream_images(self, writer, frames, job, start) :
+        index = 0
+        async for frame in frames :
+            if index == 0 :
+                self.metrics.observe('first_frame', time.perf_counter() - start)
+            part = (f'--{BOUNDARY}\r\nContent-Type: image/{"jpeg" if job["format"] == "jpg" else "png"}\r\n'
+                    f'Content-Length: {len(frame)}\r\nX-Frame-Index: {index}\r\n\r\n').encode() + frame + b'\r\n'
+            await self.send_chunk(writer, part)
+            index += 1
+        await self.send_chunk(writer, f'--{BOUNDARY}--\r\n'.encode())
+
+    async def stream_video(self, writer, frames, job, start) :
+        """
+        Pipes the frames into ffmpeg and forwards its fragmented MP4 output as soon as ffmpeg writes it
+        """
+        first = await anext(frames)
+        height, width = first.shape[:2]
+        command = ffmpeg_command('-', width, height, job['fps'], output_args=('-movflags', 'frag_keyframe+empty_moov', '-f', 'mp4'))
+        process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+
+        async def feed() :
+            try :
+                process.stdin.write(first.tobytes())
+                await process.stdin.drain()
+                async for frame in frames :
+                    process.stdin.write(frame.tobytes())
+                    await process.stdin.drain()
+            finally :
+                process.stdin.close()
+
+        feeder = asyncio.create_task(feed())
+        try :
+            first_chunk = True
+            while chunk := await process.stdout.read(1 << 16) :
+                if first_chunk :
+                    self.metrics.observe('first_frame', time.perf_counter() - start)
+                    first_chunk = False
+                await self.send_chunk(writer, chunk)
+            await feeder
+            if await process.wait() != 0 :
+                raise RuntimeError(f'ffmpeg exited with code {process.returncode}')
+        finally :
+            feeder.cancel()
+            if process.returncode is None :
+                process.kill()
+                await process.wait()
+
+async def serve(host, port, service) :
+    await service.start()
+    server = await asyncio.start_server(service.handle, host, port)
+    print(f'\033[0;32mMorph service listening on http://{host}:{port} ({service.workers} render workers)\033[0m')
+    try :
+        async with server :
+            await server.serve_forever()
+    finally :
+        service.close()
+
+if __name__ == '__main__' :
+    # Input arguments
+    ap = argparse.ArgumentParser(prog='morph_server', description='Local HTTP face morphing service')
+    ap.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    ap.add_argument("--port", default=8765, type=int, help="port to listen on")
+    ap.add_argument("--workers", default=os.cpu_count(), type=int, help="number of rendering processes")
+    ap.add_argument("--batch_window", default=10, type=float, help="miliseconds a detection waits for others to batch with")
+    ap.add_argument("--max_batch", default=16, type=int, help="largest detection batch")
+    ap.add_argument("--max_frames", default=1000, type=int, help="largest number of frames of a request")
+    ap.add_argument("--cache_dir", default=LANDMARK_CACHE_DIR, help="directory of the landmark cache, empty string disables it")
+    ap.add_argument("--tri_cache", default=TRIANGULATION_CACHE_DIR, help="directory of the triangulation cache, empty string disables it")
+    args = vars(ap.parse_args())
+
+    service = MorphService(args["workers"], args["cache_dir"], args["tri_cache"], args["batch_window"] / 1000,
+                           args["max_batch"], args["max_frames"])
+    try :
+        asyncio.run(serve(args["host"], args["port"], service))
+    except KeyboardInterrupt :
+        print('\033[0;32mMorph service stopped\033[0m')
@@ -0,0 +1,52 @@
+import os
+import shutil
+import sys
+import cv2
+import numpy as np
+import pytest
+
+# The scripts of my_code import each other as top-level modules
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'my_code'))
+
+from faceMorph import readPoints, build_delaunay
+from landmark_cache import LandmarkCache, landmark_key
+from landmark_detector import detector_params
+
+REFERENCE_DIR = os.path.join(REPO_DIR, 'reference_code')
+
+@pytest.fixture(scope='session')
+def face_pair() :
+    """
+    uint8 images, landmarks (with the 8 border points the reference files already hold) and triangulation
+    of two reference faces
+    """
+    img1 = cv2.imread(os.path.join(REFERENCE_DIR, 'donald_trump.jpg'))
+    img2 = cv2.imread(os.path.join(REFERENCE_DIR, 'hillary_clinton.jpg'))
+    face1_points = readPoints(os.path.join(REFERENCE_DIR, 'donald_trump.jpg.txt'))
+    face2_points = readPoints(os.path.join(REFERENCE_DIR, 'hillary_clinton.jpg.txt'))
+    delaunay_group = build_delaunay(img1, face1_points)
+
+    return img1, img2, face1_points, face2_points, delaunay_group
+
+@pytest.fixture
+def face_files(tmp_path, monkeypatch) :
+    """
+    Copies of the three reference faces in tmp_path/faces and a landmark cache directory holding their
+    landmarks, so that the pipeline runs without dlib. Runs from the repository root, where the default
+    predictor path points.
+    """
+    monkeypatch.chdir(REPO_DIR)
+    os.makedirs(tmp_path / 'faces')
+    cache = LandmarkCache(str(tmp_path / 'landmarks'))
+
+    filenames = []
+    for name in ('donald_trump', 'hillary_clinton', 'ted_cruz') :
+        filename = str(tmp_path / 'faces' / (name + '.jpg'))
+        shutil.copyfile(os.path.join(REFERENCE_DIR, name + '.jpg'), filename)
+        landmarks = readPoints(os.path.join(REFERENCE_DIR, name + '.jpg.txt'))[:68]
+        with open(filename, 'rb') as file :
+            cache.put(landmark_key(file.read(), detector_params()), np.int32(landmarks), (0, 0, 1, 1), 1.0)
+        filenames.append(filename)
+
+    return filenames, cache.cache_dir
@@ -0,0 +1,52 @@
+import cv2
+import numpy as np
+from align_images import align_array, blend_padding
+
+def test_to_source_maps_output_pixels_to_the_source(face_pair) :
+    img1, _, face1_points, _, _ = face_pair
+    landmarks = np.float64(face1_points[:68])
+
+    out, to_source = align_array(img1, landmarks, output_size=256, alpha=True)
+    assert out.shape == (256, 256, 4)
+
+    # Outside the padding, the output is the source resampled through to_source
+    expected = cv2.warpAffine(img1, to_source, (256, 256), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+    inside = out[:, :, 3] == 255
+    assert inside.mean() > 0.5
+    assert cv2.PSNR(np.ascontiguousarray(out[:, :, :3][inside]), expected[inside]) > 28
+
+    # The eyes end up centered and level
+    to_output = cv2.invertAffineTransform(to_source)
+    points = landmarks @ to_output[:, :2].T + to_output[:, 2]
+    left_eye, right_eye = points[36:42].mean(axis=0), points[42:48].mean(axis=0)
+    assert abs((left_eye[0] + right_eye[0]) / 2 - 128) < 3
+    assert abs(left_eye[1] - right_eye[1]) < 4
+
+def test_reduced_decode_maps_to_full_resolution_pixels(face_pair) :
+    img1, _, face1_points, _, _ = face_pair
+    landmarks = np.float64(face1_points[:68])
+    half = cv2.resize(img1, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+
+    _, full_to_source = align_array(img1, landmarks, output_size=128)
+    reduced, reduced_to_source = align_array(half, landmarks, output_size=128, alpha=True, reduce=2)
+
+    # Same geometry, up to the half pixel of the reduced decode's pixel centers
+    assert np.allclose(reduced_to_source[:, :2], full_to_source[:, :2])
+    assert np.abs(reduced_to_source[:, 2] - full_to_source[:, 2]).max() <= 0.5
+    expected = cv2.warpAffine(img1, reduced_to_source, (128, 128), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+    inside = reduced[:, :, 3] == 255
+    assert cv2.PSNR(np.ascontiguousarray(reduced[:, :, :3][inside]), expected[inside]) > 28
+
+def test_padding_tiles_match_one_tile(face_pair) :
+    img1, _, face1_points, _, _ = face_pair
+    out = cv2.resize(img1, (300, 300))
+    affine = np.float64([[2, 0, -150], [0, 2, -100]])
+    pad = (120, 120, 120, 120)
+
+    tiled, tiled_mask = blend_padding(out, affine, pad, 400, 400, 6, 19)
+    whole, whole_mask = blend_padding(out, affine, pad, 400, 400, 6, 19, tile=300)
+
+    assert np.abs(tiled.astype(np.int16) - whole).max() <= 1
+    assert np.array_equal(tiled_mask, whole_mask)
+    # Pixels inside the crop are left alone
+    assert np.array_equal(tiled[100:200, 100:240], out[100:200, 100:240])
@@ -0,0 +1,74 @@
+import json
+import os
+import numpy as np
+import pytest
+import batch_morph
+from batch_morph import job_paths, read_manifest, run_batch, run_job
+
+def write_manifest(path, jobs) :
+    with open(path, 'w') as file :
+        for job in jobs :
+            file.write(json.dumps(job) + '\n')
+
+def test_manifest_jobs(face_files, tmp_path) :
+    manifest = str(tmp_path / 'faces' / 'jobs.jsonl')
+    write_manifest(manifest, [{'image1' : 'donald_trump.jpg', 'image2' : 'hillary_clinton.jpg', 'fps' : '5'},
+                              {'image1' : 'donald_trump.jpg', 'image2' : 'hillary_clinton.jpg', 'fps' : '5'},
+                              {'id' : 'slow', 'image1' : 'donald_trump.jpg', 'image2' : 'hillary_clinton.jpg', 'fps' : 2}])
+
+    jobs = read_manifest(manifest, {'output' : 'npy'})
+    # The same settings make the same job
+    assert len(jobs) == 2 and jobs[1]['id'] == 'slow'
+    assert jobs[0]['fps'] == 5 and jobs[0]['output'] == 'npy'
+    assert jobs[0]['image1'] == str(tmp_path / 'faces' / 'donald_trump.jpg')
+    assert batch_morph.job_output(jobs[1])[0] == str(tmp_path / 'faces' / 'donald_trump-hillary_clinton-slow.npy')
+
+def test_jobs_writing_the_same_output_are_rejected(tmp_path) :
+    manifest = str(tmp_path / 'jobs.jsonl')
+    write_manifest(manifest, [{'image1' : 'a.jpg', 'image2' : 'b.jpg', 'video' : 'out.mp4'},
+                              {'image1' : 'a.jpg', 'image2' : 'c.jpg', 'video' : 'out.mp4'}])
+
+    with pytest.raises(ValueError, match='write the same output') :
+        read_manifest(manifest)
+
+def test_crashed_job_resumes_from_its_checkpoint(face_files, tmp_path, monkeypatch) :
+    (filename1, filename2, _), cache_dir = face_files
+    job = {'id' : 'crash', 'image1' : filename1, 'image2' : filename2, 'fps' : 7, 'duration' : 1000, 'align' : False,
+           'renderer' : 'triangle', 'output' : 'npy', 'video' : str(tmp_path / 'crash.npy')}
+    expected = run_job(dict(job, id='whole', video=str(tmp_path / 'whole.npy')), str(tmp_path / 'state'), cache_dir, '')
+    assert expected['resumed_at'] == 0
+
+    render_frames = batch_morph.render_frames
+    def crash_after_5(*args) :
+        for (i, frame) in enumerate(render_frames(*args)) :
+            if i == 5 :
+                raise KeyboardInterrupt
+            yield frame
+    monkeypatch.setattr(batch_morph, 'render_frames', crash_after_5)
+    with pytest.raises(KeyboardInterrupt) :
+        run_job(job, str(tmp_path / 'state'), cache_dir, '', checkpoint_every=2)
+    paths = job_paths(str(tmp_path / 'state'), job)
+    with open(paths['progress']) as file :
+        assert json.load(file) == {'frames' : 4}
+
+    monkeypatch.setattr(batch_morph, 'render_frames', render_frames)
+    record = run_job(job, str(tmp_path / 'state'), cache_dir, '', checkpoint_every=2)
+
+    assert record['resumed_at'] == 4 and record['frames'] == 7
+    assert np.array_equal(np.load(record['output']), np.load(expected['output']))
+    # The checkpoint is dropped once the job is done
+    assert not os.path.exists(paths['frames']) and not os.path.exists(paths['progress'])
+
+def test_done_jobs_are_skipped_and_failures_recorded(face_files, tmp_path) :
+    (filename1, filename2, _), cache_dir = face_files
+    job = {'id' : 'ok', 'image1' : filename1, 'image2' : filename2, 'fps' : 2, 'duration' : 1000, 'align' : False,
+           'renderer' : 'triangle', 'output' : 'npy', 'video' : None}
+    broken = dict(job, id='broken', image2=str(tmp_path / 'missing.jpg'))
+    state_dir = str(tmp_path / 'state')
+
+    results = {job['id'] : (record, error) for (job, record, error) in run_batch([job, broken], state_dir, 1, cache_dir, '')}
+    assert results['ok'][1] is None and results['broken'][0] is None
+    assert os.path.isfile(job_paths(state_dir, broken)['failed'])
+
+    # Only the failed job runs again
+    assert [job['id'] for (job, _, _) in run_batch([job, broken], state_dir, 1, cache_dir, '')] == ['broken']
@@ -0,0 +1,35 @@
+import json
+import numpy as np
+from benchmark import profile, bench_fidelity, run, compare
+
+def test_profile_reports_latencies_and_peak_memory() :
+    steps = []
+    record = profile(lambda i : steps.append(np.ones(2 ** 20, dtype=np.uint8)), 4)
+
+    # One extra step is run under tracemalloc
+    assert len(steps) == 5
+    assert record['units'] == 4
+    assert 0 <= record['p50_ms'] <= record['p90_ms'] <= record['p99_ms']
+    assert record['peak_mb'] >= 1
+
+def test_triangle_renderer_matches_the_reference(face_pair) :
+    img1, img2, face1_points, face2_points, _ = face_pair
+
+    record = bench_fidelity([img1, img2], [face1_points, face2_points], 'triangle')
+    assert record['min_psnr_db'] > 40
+
+def test_run_and_compare(tmp_path, capsys) :
+    results = run(['delaunay', 'render'], [1], [3], ['triangle'], 2)
+    assert [(r['stage'], r['units']) for r in results] == [('delaunay', 2), ('render', 3)]
+    assert results[1]['frames'] == 3 and results[1]['resolution'] == '600x800'
+
+    old = dict(results[1], wall_s=2 * results[1]['wall_s'])
+    for (name, records) in (('old.json', [old]), ('new.json', results)) :
+        with open(tmp_path / name, 'w') as file :
+            json.dump({'results' : records}, file)
+    capsys.readouterr()
+    compare(str(tmp_path / 'old.json'), str(tmp_path / 'new.json'))
+
+    # Only the case found in both files is compared
+    (line,) = capsys.readouterr().out.splitlines()
+    assert 'stage=render' in line and 'wall_s x0.50' in line
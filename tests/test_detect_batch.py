@@ -0,0 +1,47 @@
+import os
+import cv2
+import numpy as np
+from faceMorph import readPoints
+from landmark_cache import LandmarkCache, landmark_key
+from landmark_detector import detect_batch, detector_params, list_images
+
+def test_list_images_skips_other_files_and_outputs(tmp_path) :
+    for name in ('b.JPG', 'a.png', 'a.txt', 'a_landmarks.jpg', 'a-delaunay.jpg', 'notes.md') :
+        (tmp_path / name).write_bytes(b'')
+
+    assert list_images(str(tmp_path)) == [str(tmp_path / 'a.png'), str(tmp_path / 'b.JPG')]
+
+def test_manifest_paths_are_relative_to_the_manifest(tmp_path) :
+    manifest = tmp_path / 'list' / 'images.txt'
+    manifest.parent.mkdir()
+    manifest.write_text('# portraits\n\nfaces/a.jpg\n  /abs/b.jpg  \n')
+
+    assert list_images(manifest=str(manifest)) == [str(tmp_path / 'list' / 'faces' / 'a.jpg'), '/abs/b.jpg']
+
+def test_batch_exports_cached_landmarks_in_input_order(face_pair, tmp_path) :
+    img1, img2, face1_points, face2_points, _ = face_pair
+    predictor_path = str(tmp_path / 'predictor.dat')
+    (tmp_path / 'predictor.dat').write_bytes(b'model')
+    cache_dir = str(tmp_path / 'cache')
+    cache = LandmarkCache(cache_dir)
+
+    images = []
+    for (i, (image, points)) in enumerate([(img1, face1_points), (img2, face2_points)] * 2) :
+        path = str(tmp_path / f'{i}.png')
+        # Each copy is another file, slightly different so that it gets its own cache record
+        cv2.imwrite(path, cv2.add(image, i))
+        with open(path, 'rb') as file :
+            cache.put(landmark_key(file.read(), detector_params(predictor_path)), np.int32(points[:68]), (1, 2, 3, 4), 1.0)
+        images.append((path, points[:68]))
+    broken = str(tmp_path / 'broken.png')
+    (tmp_path / 'broken.png').write_bytes(b'not an image')
+
+    for workers in (1, 2) :
+        results = list(detect_batch([path for (path, _) in images] + [broken], workers, cache_dir, predictor_path))
+
+        assert [filename for (filename, *_) in results] == [path for (path, _) in images] + [broken]
+        assert all(found and error is None for (_, found, _, error) in results[:-1])
+        assert results[-1][1] is False and results[-1][3] == f'ValueError: cannot read {broken}'
+        for (path, points) in images :
+            assert readPoints(os.path.splitext(path)[0] + '.txt') == points
+            assert os.path.isfile(os.path.splitext(path)[0] + '_landmarks.jpg')
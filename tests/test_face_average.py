@@ -0,0 +1,44 @@
+import os
+import cv2
+import numpy as np
+import pytest
+from faceMorph import morph_frame
+from face_average import average_faces, normalize_weights
+
+def test_two_face_average_is_the_half_way_morph(face_pair) :
+    img1, img2, face1_points, face2_points, delaunay_group = face_pair
+
+    average, mean_points = average_faces([img1, img2], [face1_points, face2_points])
+    frame = np.uint8(morph_frame(np.float32(img1), np.float32(img2), face1_points, face2_points, delaunay_group, 0.5))
+
+    assert average.dtype == np.uint8 and average.shape == img1.shape
+    # Same warps, up to the mesh (the morph triangulates face 1) and the mean shape rounded to whole pixels
+    assert cv2.PSNR(average, frame) > 28
+    assert np.array_equal(mean_points, np.rint((np.float64(face1_points) + face2_points) / 2))
+
+def test_zero_weight_images_are_not_read(face_pair, tmp_path) :
+    img1, _, face1_points, face2_points, _ = face_pair
+    filename = str(tmp_path / 'face.png')
+    cv2.imwrite(filename, img1)
+
+    average, mean_points = average_faces([filename, str(tmp_path / 'missing.png')],
+                                         [face1_points[:68], face2_points[:68]], [2, 0])
+
+    assert cv2.PSNR(average, img1) > 40
+    assert np.array_equal(mean_points, face1_points[:68])
+
+def test_unreadable_image_is_an_error(face_pair, tmp_path) :
+    img1, _, face1_points, face2_points, _ = face_pair
+    filename = str(tmp_path / 'broken.png')
+    with open(filename, 'wb') as file :
+        file.write(b'not an image')
+
+    with pytest.raises(ValueError, match=f'cannot read {filename}') :
+        average_faces([img1, filename], [face1_points[:68], face2_points[:68]])
+
+def test_weights_are_validated() :
+    assert np.array_equal(normalize_weights(None, 4), [0.25] * 4)
+    assert np.array_equal(normalize_weights([1, 3], 2), [0.25, 0.75])
+    for weights in ([1], [1, -1], [0, 0]) :
+        with pytest.raises(ValueError) :
+            normalize_weights(weights, 2)
@@ -0,0 +1,42 @@
+import shutil
+import cv2
+import numpy as np
+import pytest
+from frame_writer import FFmpegWriter, ffmpeg_command
+
+def test_ffmpeg_command_reads_raw_bgr_frames_from_stdin() :
+    command = ffmpeg_command('out.mp4', 601, 800, fps=30)
+
+    assert command[0] == 'ffmpeg' and command[-1] == 'out.mp4'
+    assert command[command.index('-s') + 1] == '601x800'
+    assert command[command.index('-pix_fmt') + 1] == 'bgr24'
+    assert command[command.index('-i') + 1] == '-'
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='ffmpeg is not installed')
+def test_frames_are_piped_into_one_video(tmp_path) :
+    video_path = str(tmp_path / 'morph.mp4')
+    frames = [np.full((64, 48, 3), 40 * i, dtype=np.uint8) for i in range(5)]
+
+    with FFmpegWriter(video_path, fps=10) as writer :
+        for frame in frames :
+            writer.write(frame)
+    assert writer.frames_written == 5
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['morph.mp4']
+
+    capture = cv2.VideoCapture(video_path)
+    decoded = []
+    while (frame := capture.read()[1]) is not None :
+        decoded.append(frame)
+    assert len(decoded) == len(frames)
+    for (frame, expected) in zip(decoded, frames) :
+        assert abs(float(frame.mean()) - float(expected.mean())) < 3
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='ffmpeg is not installed')
+def test_failed_render_kills_ffmpeg_and_raises(tmp_path) :
+    video_path = str(tmp_path / 'morph.mp4')
+
+    with pytest.raises(ZeroDivisionError) :
+        with FFmpegWriter(video_path) as writer :
+            writer.write(np.zeros((16, 16, 3), dtype=np.uint8))
+            1 / 0
+    assert writer.process is None
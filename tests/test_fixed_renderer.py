@@ -0,0 +1,13 @@
+import numpy as np
+from faceMorph import morphFrameTriangles, morphFrameFixed
+
+def test_fixed_frames_within_2_levels_of_triangle_renderer(face_pair) :
+    img1, img2, face1_points, face2_points, delaunay_group = face_pair
+
+    for alpha in np.linspace(0, 1, 6) :
+        expected = np.uint8(morphFrameTriangles(np.float32(img1), np.float32(img2), face1_points, face2_points,
+                                                delaunay_group, alpha))
+        frame = morphFrameFixed(img1, img2, face1_points, face2_points, delaunay_group, alpha)
+
+        assert frame.dtype == np.uint8
+        assert np.abs(frame.astype(np.int16) - expected).max() <= 2
@@ -0,0 +1,60 @@
+import os
+import cv2
+import numpy as np
+import pytest
+from frame_writer import AsyncWriter, ImageSequenceWriter, loop_indices, open_writer
+
+def small_frames(image, count) :
+    return [np.ascontiguousarray(image[40 * i:40 * i + 64, 40 * i:40 * i + 48]) for i in range(count)]
+
+def test_loop_order() :
+    assert loop_indices(4) == [0, 1, 2, 3]
+    assert loop_indices(4, pingpong=True) == [0, 1, 2, 3, 2, 1, 0]
+    assert loop_indices(3, repeat=2) == [0, 1, 2, 0, 1, 2]
+    assert loop_indices(3, pingpong=True, repeat=2) == [0, 1, 2, 1, 0, 1, 2, 1, 0]
+    assert loop_indices(1, pingpong=True) == [0]
+
+def test_threaded_png_frames_keep_their_order(face_pair, tmp_path) :
+    img1, _, _, _, _ = face_pair
+    frames = small_frames(img1, 10)
+
+    with ImageSequenceWriter(str(tmp_path), 'morph', threads=3) as writer :
+        for frame in frames :
+            writer.write(frame)
+
+    assert sorted(os.listdir(tmp_path)) == [f'morph-{i:04d}.png' for i in range(10)]
+    for (i, frame) in enumerate(frames) :
+        assert np.array_equal(cv2.imread(writer.path(i)), frame)
+
+def test_repeated_frames_are_hard_links(face_pair, tmp_path) :
+    img1, _, _, _, _ = face_pair
+    frames = small_frames(img1, 4)
+
+    with open_writer('png', str(tmp_path), 'morph', len(frames), pingpong=True, repeat=2) as writer :
+        for frame in frames :
+            writer.write(frame)
+
+    order = loop_indices(4, pingpong=True, repeat=2)
+    assert len(os.listdir(tmp_path)) == len(order)
+    for (i, index) in enumerate(order) :
+        path = str(tmp_path / f'morph-{i:04d}.png')
+        assert os.path.samefile(path, str(tmp_path / f'morph-{index:04d}.png'))
+        assert np.array_equal(cv2.imread(path), frames[index])
+
+def test_npy_stack_replays_the_loop(face_pair, tmp_path) :
+    img1, _, _, _, _ = face_pair
+    frames = small_frames(img1, 3)
+    npy_path = str(tmp_path / 'morph.npy')
+
+    with open_writer('npy', npy_path, 'morph', len(frames), pingpong=True) as writer :
+        for frame in frames :
+            writer.write(frame)
+
+    assert np.array_equal(np.load(npy_path), np.stack([frames[i] for i in loop_indices(3, pingpong=True)]))
+
+def test_async_writer_raises_the_writer_error(tmp_path) :
+    writer = AsyncWriter(ImageSequenceWriter(str(tmp_path / 'missing'), 'morph', threads=0))
+    writer.write(np.zeros((8, 8, 3), dtype=np.uint8))
+
+    with pytest.raises(RuntimeError, match='cannot write') :
+        writer.close()
@@ -0,0 +1,56 @@
+import cv2
+import numpy as np
+import pytest
+from faceMorph import addAdditionalPoints
+from group_morph import group_points, morph_group, pair_faces, parse_pairs
+from landmark_cache import LandmarkCache, landmark_key
+from landmark_detector import detector_params
+
+def face(left, top, right, bottom) :
+    return (np.zeros((68, 2), dtype=np.int32), (left, top, right, bottom), 1.0)
+
+def test_faces_are_paired_by_position() :
+    faces1 = [face(0, 0, 100, 100), face(400, 0, 500, 100), face(800, 0, 900, 100)]
+    # Same framing at twice the resolution, one face less
+    faces2 = [face(1700, 0, 1900, 200), face(100, 0, 300, 200)]
+
+    assert pair_faces(faces1, (500, 1000), faces2, (1000, 2000)) == [(0, 1), (2, 0)]
+    assert pair_faces(faces1, (500, 1000), [], (1000, 2000)) == []
+
+def test_explicit_pairs_are_checked() :
+    assert parse_pairs('0:1,1:0', 2, 2) == [(0, 1), (1, 0)]
+    for spec in ('0:1,0:0', '0:1,1:1', '2:0', '0:-1') :
+        with pytest.raises(ValueError) :
+            parse_pairs(spec, 2, 2)
+
+def test_group_points_follow_the_pair_order(face_pair) :
+    _, _, face1_points, face2_points, _ = face_pair
+    faces = [(face1_points[:68], (0, 0, 600, 800), 1.0), (np.int32(face2_points[:68]) + [600, 0], (600, 0, 1200, 800), 1.0)]
+
+    points = group_points(faces, [1, 0], (800, 1200))
+    assert len(points) == 2 * 68 + 8
+    assert points[0] == (face2_points[0][0] + 600, face2_points[0][1]) and points[68] == face1_points[0]
+    assert points[-8:] == addAdditionalPoints([], (800, 1200))
+
+def test_group_photo_faces_swap_places(face_pair, face_files, tmp_path) :
+    img1, img2, face1_points, face2_points, _ = face_pair
+    _, cache_dir = face_files
+    cache = LandmarkCache(cache_dir)
+
+    # Two group photos with the two faces side by side, in the other order in the second one
+    filenames = []
+    for (name, images, points) in (('a', (img1, img2), (face1_points, face2_points)), ('b', (img2, img1), (face2_points, face1_points))) :
+        filename = str(tmp_path / f'{name}.png')
+        cv2.imwrite(filename, np.hstack(images))
+        faces = [(np.int32(points[0][:68]), (0, 0, 600, 800), 1.0), (np.int32(points[1][:68]) + [600, 0], (600, 0, 1200, 800), 1.0)]
+        with open(filename, 'rb') as file :
+            cache.put_all(landmark_key(file.read(), dict(detector_params(), all_faces=True)), faces)
+        filenames.append(filename)
+
+    npy_path, pairs = morph_group(*filenames, 4, 1000, output='npy', cache_dir=cache_dir, tri_cache='')
+    frames = np.load(npy_path)
+
+    assert pairs == [(0, 0), (1, 1)]
+    assert frames.shape == (4, 800, 1200, 3)
+    assert np.array_equal(frames[0], cv2.imread(filenames[0])) and np.array_equal(frames[-1], cv2.imread(filenames[1]))
+
@@ -0,0 +1,55 @@
+import json
+import numpy as np
+import pytest
+import instrumentation
+from faceMorph import render_frames
+
+@pytest.fixture
+def recording(monkeypatch) :
+    """
+    Instrumentation enabled for one test, with empty records before and after it
+    """
+    monkeypatch.setattr(instrumentation, 'enabled', True)
+    instrumentation.drain()
+    yield
+    instrumentation.drain()
+
+def test_disabled_instrumentation_records_nothing() :
+    assert not instrumentation.enabled
+    with instrumentation.timer('stage') :
+        instrumentation.count('frames_written')
+
+    assert instrumentation.drain() == ([], {})
+
+def test_timers_and_counters_are_summarized(recording) :
+    for _ in range(3) :
+        with instrumentation.timer('stage', frame=1) :
+            instrumentation.count('frames_written')
+            instrumentation.count('bytes_allocated', 10)
+
+    summary = instrumentation.summary()
+    assert summary['stages']['stage']['calls'] == 3
+    assert summary['counters'] == {'frames_written' : 3, 'bytes_allocated' : 30}
+
+    events, counters = instrumentation.drain()
+    assert instrumentation.summary() == {'stages' : {}, 'counters' : {}}
+    instrumentation.merge((events, counters))
+    instrumentation.merge((events[:1], {'frames_written' : 2}))
+    assert instrumentation.summary()['stages']['stage']['calls'] == 4
+    assert instrumentation.summary()['counters']['frames_written'] == 5
+
+def test_workers_records_reach_the_trace(face_pair, recording, tmp_path) :
+    img1, img2, face1_points, face2_points, delaunay_group = face_pair
+
+    frames = list(render_frames(np.float32(img1), np.float32(img2), face1_points, face2_points, delaunay_group,
+                                np.linspace(0, 1, 3), workers=2))
+    trace_path = str(tmp_path / 'trace.json')
+    instrumentation.write_trace(trace_path)
+
+    with open(trace_path) as file :
+        trace = json.load(file)
+    assert len(frames) == 3
+    assert trace['otherData']['stages']['morph_frame']['calls'] == 3
+    assert trace['otherData']['counters']['triangles_rendered'] == 3 * len(delaunay_group)
+    assert {e['ph'] for e in trace['traceEvents']} == {'X', 'C'}
+    assert all(e['dur'] >= 0 for e in trace['traceEvents'] if e['ph'] == 'X')
@@ -0,0 +1,76 @@
+import os
+import cv2
+import numpy as np
+import landmark_detector
+from landmark_cache import LandmarkCache, landmark_key
+from landmark_detector import detect_landmarks, detector_params
+
+def test_key_depends_on_image_and_params() :
+    key = landmark_key(b'image', {'upsample' : 1, 'predictor' : 'a.dat'})
+
+    assert landmark_key(b'image', {'predictor' : 'a.dat', 'upsample' : 1}) == key
+    assert landmark_key(b'imagf', {'upsample' : 1, 'predictor' : 'a.dat'}) != key
+    assert landmark_key(b'image', {'upsample' : 2, 'predictor' : 'a.dat'}) != key
+
+def test_put_get_round_trip(face_pair, tmp_path) :
+    _, _, face1_points, _, _ = face_pair
+    cache = LandmarkCache(str(tmp_path))
+    landmarks = np.int32(face1_points[:68])
+
+    cache.put('face', landmarks, (10, 20, 300, 400), 12.5)
+    cache.put_all('no_face', [])
+    record = cache.get('face')
+
+    assert np.array_equal(record['landmarks'], landmarks)
+    assert tuple(record['rect']) == (10, 20, 300, 400) and record['sharpness'] == 12.5
+    assert cache.get('missing') is None and cache.get_all('missing') is None
+    assert cache.get('no_face') is None and len(cache.get_all('no_face')) == 0
+    # Records are written to a temporary file and renamed, none is left behind
+    assert sorted(os.listdir(tmp_path)) == ['face.npy', 'no_face.npy']
+
+def test_least_recently_used_records_are_evicted(tmp_path) :
+    cache = LandmarkCache(str(tmp_path))
+    landmarks = np.zeros((68, 2), dtype=np.int32)
+    for (i, key) in enumerate(('a', 'b', 'c')) :
+        cache.put(key, landmarks, (0, 0, 1, 1), 0.0)
+        os.utime(cache._path(key), (i, i))
+    record_size = os.path.getsize(cache._path('a'))
+
+    # Reading 'a' makes 'b' the least recently used record
+    cache.get('a')
+    cache.max_bytes = 3 * record_size
+    cache.put('d', landmarks, (0, 0, 1, 1), 0.0)
+
+    assert sorted(os.listdir(tmp_path)) == ['a.npy', 'c.npy', 'd.npy']
+
+def test_detect_landmarks_hits_and_misses(face_pair, tmp_path, monkeypatch) :
+    img1, _, face1_points, _, _ = face_pair
+    image_path = str(tmp_path / 'face.png')
+    cv2.imwrite(image_path, img1)
+    predictor_path = str(tmp_path / 'predictor.dat')
+    with open(predictor_path, 'wb') as file :
+        file.write(b'model')
+    cache = LandmarkCache(str(tmp_path / 'cache'))
+    landmarks = np.int32(face1_points[:68])
+
+    detections = []
+    def fake_detect(image_gray, detector, predictor, upsample, max_side) :
+        detections.append(image_gray.shape)
+        return [(landmarks, (1, 2, 3, 4), 5.0)] if len(detections) == 1 else []
+    monkeypatch.setattr(landmark_detector, 'get_models', lambda predictor_path : (None, None))
+    monkeypatch.setattr(landmark_detector, 'detect_faces', fake_detect)
+
+    # Miss, then hit
+    for _ in range(2) :
+        image, face = detect_landmarks(image_path, cache, predictor_path)
+        assert np.array_equal(image, img1)
+        assert np.array_equal(face[0], landmarks) and face[1:] == ((1, 2, 3, 4), 5.0)
+    assert len(detections) == 1
+
+    # Other detector parameters are another key, its "no face" result is cached too
+    for _ in range(2) :
+        assert detect_landmarks(image_path, cache, predictor_path, max_side=128)[1] is None
+    assert len(detections) == 2
+    with open(image_path, 'rb') as file :
+        key = landmark_key(file.read(), detector_params(predictor_path, max_side=128))
+    assert len(cache.get_all(key)) == 0
@@ -0,0 +1,47 @@
+import cv2
+import numpy as np
+import pytest
+import landmark_tracker
+from landmark_tracker import track_face, track_video, fill_lost, TIMELINE_RECORD, LOST, DETECTED, TRACKED
+
+def shifted(image, dx, dy) :
+    return cv2.warpAffine(image, np.float64([[1, 0, dx], [0, 1, dy]]), image.shape[1::-1], borderMode=cv2.BORDER_REPLICATE)
+
+def test_optical_flow_follows_a_moving_face(face_pair) :
+    img1, _, face1_points, _, _ = face_pair
+    gray = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
+    landmarks = np.float32(face1_points[:68])
+
+    tracked, rect, confidence = track_face(gray, shifted(gray, 6, -4), landmarks, (100, 200, 500, 600))
+
+    assert confidence > 0.8
+    assert np.median(np.linalg.norm(tracked - (landmarks + [6, -4]), axis=1)) < 0.5
+    assert rect == (106, 196, 506, 596)
+
+def test_detection_only_runs_on_keyframes(face_pair, monkeypatch) :
+    img1, _, face1_points, _, _ = face_pair
+    landmarks = np.float32(face1_points[:68])
+    frames = [shifted(img1, 2 * i, i) for i in range(7)]
+    detections = []
+
+    def detect(gray, detector, predictor, max_side) :
+        detections.append(len(detections))
+        return (landmarks, (100, 200, 500, 600), 1.0)
+    monkeypatch.setattr(landmark_tracker, 'get_models', lambda predictor_path : (None, None))
+    monkeypatch.setattr(landmark_tracker, 'detect_clearest_face', detect)
+
+    records = [record for (_, record) in track_video(frames, keyframe_interval=3, refit=False)]
+
+    assert len(detections) == 3
+    assert [int(r['source']) for r in records] == [DETECTED, TRACKED, TRACKED] * 2 + [DETECTED]
+    # Tracked frames follow the motion, the detector always returns the first frame's landmarks here
+    assert np.median(np.linalg.norm(records[2]['landmarks'] - (landmarks + [4, 2]), axis=1)) < 0.5
+
+def test_lost_frames_reuse_the_closest_earlier_face() :
+    timeline = np.zeros(5, dtype=TIMELINE_RECORD)
+    timeline['source'] = [LOST, DETECTED, LOST, TRACKED, LOST]
+    timeline['landmarks'] = np.arange(5)[:, None, None]
+
+    assert fill_lost(timeline)[:, 0, 0].tolist() == [1, 1, 1, 3, 3]
+    with pytest.raises(ValueError) :
+        fill_lost(np.zeros(3, dtype=TIMELINE_RECORD))
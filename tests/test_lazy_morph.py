@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from faceMorph import render_frames
+from lazy_morph import LazyMorph, open_morph
+
+def test_recently_rendered_frames_are_cached(face_pair) :
+    img1, img2, face1_points, face2_points, delaunay_group = face_pair
+    morph = LazyMorph(img1, img2, face1_points, face2_points, delaunay_group, nframes=5, cache_size=2)
+
+    first = morph[1]
+    assert morph[1] is first
+    morph[2]
+    morph[1]
+    # Frame 2 is now the least recently used, frame 3 evicts it
+    morph[3]
+    assert list(morph.cache) == [morph.alpha(1), morph.alpha(3)]
+    assert (morph.hits, morph.misses) == (2, 3)
+    morph[2]
+    assert morph.misses == 4
+
+    with pytest.raises(ValueError) :
+        first[0, 0] = 0
+
+def test_frames_match_render_frames(face_pair) :
+    img1, img2, face1_points, face2_points, delaunay_group = face_pair
+    morph = LazyMorph(img1, img2, face1_points, face2_points, delaunay_group, fps=5, duration_ms=1000)
+    expected = list(render_frames(np.float32(img1), np.float32(img2), face1_points, face2_points, delaunay_group,
+                                  np.linspace(0, 1, 5)))
+
+    morph[2]
+    frames = list(morph.frames(workers=2))
+    assert len(morph) == len(frames) == 5
+    assert all(np.array_equal(frame, e) for (frame, e) in zip(frames, expected))
+    # Frame 2 came from the cache, the others were rendered by the pool
+    assert (morph.hits, morph.misses) == (1, 5)
+    odd = list(morph.frames(1, 5, 2))
+    assert len(odd) == 2 and odd[0] is morph[1] and odd[1] is morph[3]
+    assert np.array_equal(morph.at(-10), img1) and np.array_equal(morph.at(5000), img2)
+    with pytest.raises(IndexError) :
+        morph[5]
+
+def test_open_morph_detects_faces_through_the_cache(face_files, tmp_path) :
+    (filename1, filename2, _), cache_dir = face_files
+
+    morph = open_morph(filename1, filename2, nframes=3, cache_dir=cache_dir, tri_cache='')
+    assert morph.cache == {} and len(morph) == 3
+    assert np.array_equal(morph[0], morph.img1) and np.array_equal(morph[-1], morph.img2)
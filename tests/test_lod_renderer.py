@@ -0,0 +1,25 @@
+import numpy as np
+from faceMorph import morphFrameTriangles, triangle_stats
+
+def test_lod_frames_within_1_level_of_untiled(face_pair) :
+    img1, img2, face1_points, face2_points, delaunay_group = face_pair
+    img1, img2 = np.float32(img1), np.float32(img2)
+
+    for alpha in (0.0, 0.35, 0.8) :
+        expected = morphFrameTriangles(img1, img2, face1_points, face2_points, delaunay_group, alpha)
+        frame = morphFrameTriangles(img1, img2, face1_points, face2_points, delaunay_group, alpha, lod_tile=64)
+
+        assert np.abs(np.int16(np.uint8(frame)) - np.uint8(expected)).max() <= 1
+
+def test_lod_only_skips_background_pixels(face_pair) :
+    img1, _, face1_points, face2_points, delaunay_group = face_pair
+
+    stats = triangle_stats(face1_points, face2_points, delaunay_group, 0.5, img1.shape, lod_tile=64)
+    face, background = stats[~stats['background']], stats[stats['background']]
+
+    assert len(stats) == len(delaunay_group) and background.size and face.size
+    # The mesh covers the whole frame
+    assert abs(stats['area'].sum() - img1.shape[0] * img1.shape[1]) < 0.01 * img1.shape[0] * img1.shape[1]
+    assert np.array_equal(face['touched_pixels'], face['rect_pixels'])
+    assert np.all(background['touched_pixels'] <= background['rect_pixels'])
+    assert background['touched_pixels'].sum() < background['rect_pixels'].sum()
@@ -0,0 +1,56 @@
+import os
+import cv2
+import numpy as np
+import pytest
+from faceMorph import addAdditionalPoints, build_delaunay, render_frames
+from landmark_cache import LandmarkCache, landmark_key
+from landmark_detector import detector_params
+from morph_pipeline import analyse_face, morph_images
+
+def test_analyse_face_reads_cached_landmarks(face_pair, face_files) :
+    img1, _, face1_points, _, _ = face_pair
+    (filename1, _, _), cache_dir = face_files
+
+    image, landmarks = analyse_face(filename1, cache=LandmarkCache(cache_dir))
+    assert np.array_equal(image, img1)
+    assert landmarks == face1_points[:68]
+
+def test_aligned_landmarks_are_mapped_into_the_aligned_image(face_files) :
+    (filename1, _, _), cache_dir = face_files
+
+    image, landmarks = analyse_face(filename1, align=True, output_size=256, cache=LandmarkCache(cache_dir))
+    assert image.shape == (256, 256, 3)
+    points = np.int32(landmarks)
+    assert points.min() >= 0 and points.max() < 256
+    # The eyes end up centered
+    assert abs(points[36:48, 0].mean() - 128) < 4
+
+def test_morph_images_renders_the_faceMorph_frames(face_files, tmp_path) :
+    (filename1, filename2, _), cache_dir = face_files
+    tri_cache = str(tmp_path / 'triangulation')
+
+    npy_path = morph_images(filename1, filename2, 5, 1000, output='npy', cache_dir=cache_dir, tri_cache=tri_cache)
+    assert npy_path == os.path.join(os.path.dirname(filename1), 'donald_trump-hillary_clinton.npy')
+
+    sources = []
+    for filename in (filename1, filename2) :
+        image, landmarks = analyse_face(filename, cache=LandmarkCache(cache_dir))
+        sources.append((np.float32(image), addAdditionalPoints(landmarks, image.shape)))
+    (img1, face1_points), (img2, face2_points) = sources
+    delaunay_group = build_delaunay(img1, face1_points)
+    expected = list(render_frames(img1, img2, face1_points, face2_points, delaunay_group, np.linspace(0, 1, 5)))
+
+    assert np.array_equal(np.load(npy_path), np.stack(expected))
+    # The triangulation of the first face was cached
+    assert len(os.listdir(tri_cache)) == 1
+
+def test_image_without_face_is_an_error(face_files, tmp_path) :
+    (filename1, _, _), cache_dir = face_files
+    blank = str(tmp_path / 'blank.png')
+    cv2.imwrite(blank, np.zeros((800, 600, 3), dtype=np.uint8))
+    cache = LandmarkCache(cache_dir)
+    with open(blank, 'rb') as file :
+        cache.put_all(landmark_key(file.read(), detector_params()), [])
+
+    with pytest.raises(ValueError, match='no faces have been detected') :
+        morph_images(filename1, blank, 5, 1000, output='npy', cache_dir=cache_dir, tri_cache='')
@@ -0,0 +1,54 @@
+import cv2
+import numpy as np
+from faceMorph import morphFrameTriangles, morphFramePlanned
+from morph_plan import MorphPlan, affine_transforms, bounding_rects
+
+def test_affine_transforms_match_opencv() :
+    rng = np.random.default_rng(0)
+    src = np.float32(rng.uniform(0, 500, (500, 3, 2)))
+    dst = np.float32(rng.uniform(0, 500, (500, 3, 2)))
+
+    expected = np.stack([cv2.getAffineTransform(s, d) for (s, d) in zip(src, dst)])
+    assert np.array_equal(affine_transforms(src, dst), expected)
+
+def test_affine_transforms_of_flat_triangles_are_zero() :
+    src = np.float32([[[0, 0], [1, 1], [2, 2]]])
+    dst = np.float32([[[0, 0], [1, 0], [0, 1]]])
+
+    assert np.array_equal(affine_transforms(src, dst), cv2.getAffineTransform(src[0], dst[0])[None])
+
+def test_bounding_rects_match_opencv() :
+    rng = np.random.default_rng(1)
+    triangles = rng.uniform(0, 500, (500, 3, 2))
+
+    expected = np.int32([cv2.boundingRect(np.float32([triangle])) for triangle in triangles])
+    assert np.array_equal(bounding_rects(triangles), expected)
+
+def test_planned_frames_match_triangle_renderer(face_pair) :
+    img1, img2, face1_points, face2_points, delaunay_group = face_pair
+    img1, img2 = np.float32(img1), np.float32(img2)
+    alphas = [0.0, 0.3, 1.0]
+    plan = MorphPlan.build(face1_points, face2_points, delaunay_group, alphas)
+
+    for alpha in alphas :
+        assert np.array_equal(morphFramePlanned(img1, img2, face1_points, face2_points, delaunay_group, alpha, plan),
+                              morphFrameTriangles(img1, img2, face1_points, face2_points, delaunay_group, alpha))
+
+def test_save_load_for_alphas_round_trip(face_pair, tmp_path) :
+    _, _, face1_points, face2_points, delaunay_group = face_pair
+    plan = MorphPlan.build(face1_points, face2_points, delaunay_group, np.linspace(0, 1, 5))
+    path = str(tmp_path / 'plan.npz')
+    plan.save(path)
+    loaded = MorphPlan.load(path)
+
+    assert loaded.face1_points == face1_points and loaded.delaunay_group == delaunay_group
+    for name in ('alphas', 'rects1', 'rects2', 'rects', 'polygons', 'affines1', 'affines2') :
+        assert np.array_equal(getattr(loaded, name), getattr(plan, name))
+
+    # Frames planned already are reused, the others are planned on the spot
+    alphas = np.linspace(0, 1, 9)
+    reused = loaded.for_alphas(alphas)
+    fresh = MorphPlan.build(face1_points, face2_points, delaunay_group, alphas)
+    for alpha in alphas :
+        for (a, b) in zip(reused.frame(alpha), fresh.frame(alpha)) :
+            assert np.array_equal(a, b)
@@ -0,0 +1,40 @@
+import os
+import cv2
+import numpy as np
+import pytest
+from morph_pipeline import morph_sequence
+
+def test_chain_shares_the_junction_frames(face_files, tmp_path) :
+    filenames, cache_dir = face_files
+
+    npy_path = morph_sequence(filenames, 5, 1000, output='npy', cache_dir=cache_dir, tri_cache='')
+    frames = np.load(npy_path)
+
+    assert os.path.basename(npy_path) == 'donald_trump-hillary_clinton-ted_cruz.npy'
+    # Two segments of 5 frames, the middle face is only output once
+    assert len(frames) == 5 + 4
+    for (index, filename) in zip((0, 4, 8), filenames) :
+        assert np.array_equal(frames[index], cv2.imread(filename))
+
+def test_pingpong_plays_the_chain_back_to_the_first_face(face_files, tmp_path) :
+    filenames, cache_dir = face_files
+
+    frames = np.load(morph_sequence(filenames, 3, 1000, output='npy', cache_dir=cache_dir, tri_cache=''))
+    looped = np.load(morph_sequence(filenames, 3, 1000, output='npy', video=str(tmp_path / 'loop.npy'),
+                                    cache_dir=cache_dir, tri_cache='', pingpong=True))
+
+    assert np.array_equal(looped, np.concatenate((frames, frames[-2::-1])))
+
+def test_png_frames_are_numbered_across_segments(face_files) :
+    filenames, cache_dir = face_files
+
+    out_dir = morph_sequence(filenames, 3, 1000, output='png', cache_dir=cache_dir, tri_cache='')
+    names = sorted(name for name in os.listdir(out_dir) if name.startswith('morph-'))
+
+    assert names == [f'morph-donald_trump-hillary_clinton-ted_cruz-{i:04d}.png' for i in range(5)]
+
+def test_at_least_two_faces(face_files) :
+    filenames, cache_dir = face_files
+
+    with pytest.raises(ValueError, match='at least two images') :
+        morph_sequence(filenames[:1], 5, 1000, output='npy', cache_dir=cache_dir)
@@ -0,0 +1,91 @@
+import asyncio
+import json
+import cv2
+import numpy as np
+import pytest
+import morph_server
+from morph_server import Metrics, MorphService, RequestError
+
+def test_metrics_snapshot() :
+    metrics = Metrics()
+    metrics.counters['requests'] += 2
+    for seconds in (0.1, 0.2, 0.3) :
+        metrics.observe('frame', seconds)
+
+    snapshot = metrics.snapshot()
+    assert snapshot['counters'] == {'requests' : 2}
+    assert snapshot['latency_s']['frame'] == {'count' : 3, 'mean' : 0.2, 'p50' : 0.2, 'p95' : 0.29, 'max' : 0.3}
+
+def test_job_parameters_are_validated() :
+    service = MorphService(cache_dir='', max_frames=50)
+    try :
+        job = service.parse_job({'image1' : 'a.jpg', 'image2' : 'b.jpg', 'fps' : '10', 'duration' : '2000', 'align' : 'yes'})
+        assert (job['nframes'], job['align'], job['format']) == (20, True, 'jpg')
+
+        for params in ({'image1' : 'a.jpg'}, {'image1' : 'a', 'image2' : 'b', 'fps' : 'x'},
+                       {'image1' : 'a', 'image2' : 'b', 'renderer' : 'nope'}, {'image1' : 'a', 'image2' : 'b', 'format' : 'gif'},
+                       {'image1' : 'a', 'image2' : 'b', 'nframes' : 51}) :
+            with pytest.raises(RequestError) as error :
+                service.parse_job(params)
+            assert error.value.status == 400
+    finally :
+        service.render_pool.shutdown()
+        service.detect_executor.shutdown()
+
+async def request(port, raw) :
+    """
+    Sends a raw HTTP request and returns (status, headers, body) with the chunked encoding removed
+    """
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(raw)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+
+    head, _, body = response.partition(b'\r\n\r\n')
+    status_line, *header_lines = head.decode('latin-1').split('\r\n')
+    headers = {name.lower() : value.strip() for (name, _, value) in (line.partition(':') for line in header_lines)}
+    if headers.get('transfer-encoding') == 'chunked' :
+        chunks = b''
+        while True :
+            size, _, body = body.partition(b'\r\n')
+            if not int(size, 16) :
+                break
+            chunks += body[:int(size, 16)]
+            body = body[int(size, 16) + 2:]
+        body = chunks
+    return int(status_line.split()[1]), headers, body
+
+def test_morph_frames_are_streamed(face_files, tmp_path, monkeypatch) :
+    (filename1, filename2, _), cache_dir = face_files
+    monkeypatch.setattr(morph_server, 'get_models', lambda : None)
+
+    async def scenario() :
+        service = MorphService(workers=1, cache_dir=cache_dir, tri_cache='')
+        await service.start()
+        server = await asyncio.start_server(service.handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try :
+            query = f'/morph?image1={filename1}&image2={filename2}&nframes=3&format=png'
+            # Two concurrent requests on the same images share one detection batch
+            morphs = await asyncio.gather(*[request(port, f'GET {query} HTTP/1.1\r\n\r\n'.encode()) for _ in range(2)])
+            errors = [await request(port, raw) for raw in (b'GET /morph HTTP/1.1\r\nContent-Length: x\r\n\r\n',
+                                                           b'GET /nope HTTP/1.1\r\n\r\n',
+                                                           b'DELETE /morph HTTP/1.1\r\n\r\n')]
+            metrics = json.loads((await request(port, b'GET /metrics HTTP/1.1\r\n\r\n'))[2])
+        finally :
+            server.close()
+            service.close()
+        return morphs, errors, metrics
+
+    morphs, errors, metrics = asyncio.run(scenario())
+
+    for (status, headers, body) in morphs :
+        assert status == 200 and headers['x-frames'] == '3'
+        parts = body.split(b'--frame')[1:-1]
+        frames = [cv2.imdecode(np.frombuffer(part.partition(b'\r\n\r\n')[2][:-2], np.uint8), cv2.IMREAD_COLOR) for part in parts]
+        assert len(frames) == 3
+        assert np.array_equal(frames[0], cv2.imread(filename1)) and np.array_equal(frames[2], cv2.imread(filename2))
+    assert [status for (status, _, _) in errors] == [400, 404, 405]
+    assert metrics['counters']['morphs'] == 2 and metrics['counters']['frames_rendered'] == 6
+    assert metrics['counters']['detection_batches'] < metrics['counters']['detections_batched'] == 4
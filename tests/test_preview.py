@@ -0,0 +1,40 @@
+import cv2
+import numpy as np
+import pytest
+from faceMorph import addAdditionalPoints, build_delaunay, morph_frame, parse_frames, preview_inputs
+
+def test_preview_inputs_scale_landmarks_and_border(face_pair) :
+    img1, _, face1_points, _, _ = face_pair
+
+    preview, points = preview_inputs(img1, face1_points, 200)
+
+    assert preview.shape == (200, 150, 3)
+    assert len(points) == len(face1_points)
+    # Pixel centers stay aligned: a point at a pixel center of the source is at the matching pixel center
+    assert np.allclose(points[30], ((face1_points[30][0] + 0.5) / 4 - 0.5, (face1_points[30][1] + 0.5) / 4 - 0.5))
+    assert set(points[-8:]) == {(0, 0), (0, 199), (149, 0), (149, 199), (0, 100), (75, 0), (149, 100), (75, 199)}
+    # Images already small enough are not resized
+    assert preview_inputs(img1, face1_points, 1000)[0].shape == img1.shape
+
+def test_preview_frames_line_up_with_full_frames(face_pair) :
+    img1, img2, face1_points, face2_points, _ = face_pair
+    # Border points in the order of addAdditionalPoints, which preview_inputs places again
+    face1_points = addAdditionalPoints(face1_points[:68], img1.shape)
+    face2_points = addAdditionalPoints(face2_points[:68], img2.shape)
+    delaunay_group = build_delaunay(img1, face1_points)
+    preview1, points1 = preview_inputs(np.float32(img1), face1_points, 300)
+    preview2, points2 = preview_inputs(np.float32(img2), face2_points, 300)
+
+    for alpha in (0.25, 0.6) :
+        # The full-resolution triangulation is reused for the preview
+        preview = np.uint8(morph_frame(preview1, preview2, points1, points2, delaunay_group, alpha))
+        full = np.uint8(morph_frame(np.float32(img1), np.float32(img2), face1_points, face2_points, delaunay_group, alpha))
+
+        assert cv2.PSNR(preview, cv2.resize(full, preview.shape[1::-1], interpolation=cv2.INTER_AREA)) > 28
+
+def test_frame_selection() :
+    assert parse_frames('0,5,10-12', 20) == [0, 5, 10, 11, 12]
+    assert parse_frames('3-4,4', 5) == [3, 4]
+    for spec in ('0,20', '-1', '5-2') :
+        with pytest.raises(ValueError) :
+            parse_frames(spec, 20)
@@ -0,0 +1,73 @@
+import sys
+from types import SimpleNamespace
+import cv2
+import numpy as np
+import landmark_detector
+from landmark_detector import detect_faces, detector_params, face_sharpness, SHARPNESS_MAX_SIDE
+
+class Rect :
+    """
+    Stand-in for dlib.rectangle
+    """
+    def __init__(self, left, top, right, bottom) :
+        self.box = (left, top, right, bottom)
+
+    def left(self) :
+        return self.box[0]
+
+    def top(self) :
+        return self.box[1]
+
+    def right(self) :
+        return self.box[2]
+
+    def bottom(self) :
+        return self.box[3]
+
+def test_pyramid_params_are_another_cache_key(tmp_path) :
+    predictor_path = str(tmp_path / 'predictor.dat')
+    (tmp_path / 'predictor.dat').write_bytes(b'model')
+
+    params = detector_params(predictor_path, max_side=800)
+    assert 'max_side' not in detector_params(predictor_path)
+    assert params['max_side'] == 800 and params['sharpness_max_side'] == SHARPNESS_MAX_SIDE
+
+def test_bounded_sharpness_keeps_the_ranking(face_pair) :
+    img1, img2, _, _, _ = face_pair
+    gray1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
+    sharp = cv2.resize(gray1, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+    blurred = cv2.GaussianBlur(sharp, (0, 0), 3)
+    rect = Rect(100, 100, 1000, 1200)
+
+    assert face_sharpness(sharp, rect) > face_sharpness(blurred, rect)
+    assert face_sharpness(sharp, rect, 256) > face_sharpness(blurred, rect, 256)
+    # Small crops are not resized
+    small = Rect(10, 10, 200, 200)
+    assert face_sharpness(sharp, small, 256) == face_sharpness(sharp, small)
+
+def test_faces_are_searched_on_the_downscaled_copy(face_pair, monkeypatch) :
+    img1, _, face1_points, _, _ = face_pair
+    gray = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
+    scale = 300 / max(gray.shape)
+    searched, predicted = [], []
+
+    def detector(image, upsample) :
+        searched.append(image.shape)
+        return [Rect(50, 60, 150, 200)]
+
+    def predictor(image, rect) :
+        predicted.append((image.shape, rect.box))
+        return np.int32(face1_points[:68])
+
+    monkeypatch.setattr(landmark_detector, 'scale_rect',
+                        lambda rect, s : Rect(*(int(round(v * s)) for v in rect.box)))
+    # The predictor above already returns an array
+    monkeypatch.setitem(sys.modules, 'imutils', SimpleNamespace(face_utils=SimpleNamespace(shape_to_np=np.asarray)))
+
+    ((landmarks, rect, _),) = detect_faces(gray, detector, predictor, max_side=300)
+
+    assert max(searched[0]) == 300
+    # The rect is mapped back and the predictor runs on the full resolution image
+    assert rect == tuple(int(round(v / scale)) for v in (50, 60, 150, 200))
+    assert predicted == [(gray.shape, rect)]
+    assert np.array_equal(landmarks, face1_points[:68])
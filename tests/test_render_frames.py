@@ -0,0 +1,22 @@
+import numpy as np
+from faceMorph import morph_frame, render_frames
+
+def test_workers_render_the_same_frames_in_order(face_pair) :
+    img1, img2, face1_points, face2_points, delaunay_group = face_pair
+    img1, img2 = np.float32(img1), np.float32(img2)
+    alphas = np.linspace(0, 1, 7)
+
+    frames = list(render_frames(img1, img2, face1_points, face2_points, delaunay_group, alphas, workers=2))
+
+    assert len(frames) == len(alphas)
+    for (alpha, frame) in zip(alphas, frames) :
+        assert frame.dtype == np.uint8
+        assert np.array_equal(frame, np.uint8(morph_frame(img1, img2, face1_points, face2_points, delaunay_group, float(alpha))))
+
+def test_first_and_last_frames_are_the_sources(face_pair) :
+    img1, img2, face1_points, face2_points, delaunay_group = face_pair
+
+    first, last = render_frames(np.float32(img1), np.float32(img2), face1_points, face2_points, delaunay_group, [0.0, 1.0])
+
+    assert np.array_equal(first, img1)
+    assert np.array_equal(last, img2)
@@ -0,0 +1,46 @@
+import cv2
+import numpy as np
+from faceMorph import morphFrameRemap, morphFrameTiled, morphFrameTriangles, load_image_memmap, render_frames
+
+def memmapped_sources(images, tmp_path) :
+    sources = []
+    for (i, image) in enumerate(images) :
+        cv2.imwrite(str(tmp_path / f'{i}.png'), image)
+        sources.append(load_image_memmap(str(tmp_path / f'{i}.png'), str(tmp_path / f'{i}.npy')))
+
+    return sources
+
+def test_remap_frames_match_triangle_renderer(face_pair) :
+    img1, img2, face1_points, face2_points, delaunay_group = face_pair
+    img1, img2 = np.float32(img1), np.float32(img2)
+
+    for alpha in (0.25, 0.5, 0.75) :
+        frame = morphFrameRemap(img1, img2, face1_points, face2_points, delaunay_group, alpha)
+        expected = morphFrameTriangles(img1, img2, face1_points, face2_points, delaunay_group, alpha)
+        assert cv2.PSNR(np.uint8(frame), np.uint8(expected)) > 40
+
+def test_tiled_frames_from_memmaps_match_remap(face_pair, tmp_path) :
+    img1, img2, face1_points, face2_points, delaunay_group = face_pair
+    sources = memmapped_sources((img1, img2), tmp_path)
+    assert all(isinstance(source, np.memmap) and np.array_equal(source, image) for (source, image) in zip(sources, (img1, img2)))
+
+    for alpha in (0.0, 0.4, 1.0) :
+        expected = np.uint8(morphFrameRemap(np.float32(img1), np.float32(img2), face1_points, face2_points, delaunay_group, alpha))
+        # Small tiles, so that large background triangles make tiles split
+        out = np.lib.format.open_memmap(str(tmp_path / 'frame.npy'), mode='w+', dtype=np.uint8, shape=img1.shape)
+        frame = morphFrameTiled(*sources, face1_points, face2_points, delaunay_group, alpha, tile_size=96, out=out)
+
+        assert frame is out
+        assert np.all(frame == expected, axis=2).mean() > 0.999
+
+def test_workers_share_memmapped_sources(face_pair, tmp_path) :
+    img1, img2, face1_points, face2_points, delaunay_group = face_pair
+    sources = memmapped_sources((img1, img2), tmp_path)
+    alphas = np.linspace(0, 1, 4)
+
+    frames = list(render_frames(*sources, face1_points, face2_points, delaunay_group, alphas, 'tiled', workers=2,
+                                renderer_options={'tile_size' : 256}))
+    expected = [morphFrameTiled(img1, img2, face1_points, face2_points, delaunay_group, float(alpha), 256) for alpha in alphas]
+
+    assert len(frames) == len(alphas)
+    assert all(np.array_equal(frame, e) for (frame, e) in zip(frames, expected))
@@ -0,0 +1,36 @@
+import os
+import numpy as np
+import faceMorph
+from faceMorph import build_delaunay, triangulation_key, readTriangles
+
+def test_triangulation_is_cached_and_reused(face_pair, tmp_path, monkeypatch) :
+    img1, _, face1_points, _, delaunay_group = face_pair
+    cache_dir = str(tmp_path)
+
+    triangles = build_delaunay(img1, face1_points, cache_dir)
+    cache_path = os.path.join(cache_dir, triangulation_key(face1_points, img1.shape) + '.txt')
+    assert triangles == delaunay_group
+    assert os.listdir(cache_dir) == [os.path.basename(cache_path)]
+    assert readTriangles(cache_path) == triangles
+
+    # A hit must not triangulate again
+    def no_subdiv(*args) :
+        raise AssertionError('triangulated on a cache hit')
+    monkeypatch.setattr(faceMorph.cv2, 'Subdiv2D', no_subdiv)
+    assert build_delaunay(img1, face1_points, cache_dir) == triangles
+
+def test_key_depends_on_points_and_size(face_pair) :
+    img1, _, face1_points, _, _ = face_pair
+    key = triangulation_key(face1_points, img1.shape)
+    moved = [(x + 1, y) if i == 30 else (x, y) for (i, (x, y)) in enumerate(face1_points)]
+
+    assert triangulation_key(face1_points, img1.shape) == key
+    assert triangulation_key(moved, img1.shape) != key
+    assert triangulation_key(face1_points, (img1.shape[0] + 1, img1.shape[1])) != key
+
+def test_triangles_index_every_landmark(face_pair) :
+    _, _, face1_points, _, delaunay_group = face_pair
+    indexes = np.int32(delaunay_group)
+
+    assert indexes.min() >= 0 and indexes.max() < len(face1_points)
+    assert set(indexes.ravel()) == set(range(len(face1_points)))